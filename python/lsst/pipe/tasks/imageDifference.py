@@ -21,19 +21,23 @@
 #
 import math
 import random
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 import numpy
 
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
 import lsst.daf.base as dafBase
 import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
 import lsst.afw.math as afwMath
 import lsst.afw.table as afwTable
 from lsst.meas.astrom import AstrometryConfig, AstrometryTask
 from lsst.meas.extensions.astrometryNet import LoadAstrometryNetObjectsTask
 from lsst.pipe.tasks.registerImage import RegisterTask
 from lsst.meas.algorithms import SourceDetectionTask, SingleGaussianPsf, \
-    ObjectSizeStarSelectorTask
+    ObjectSizeStarSelectorTask, WarpedPsf
 from lsst.ip.diffim import DipoleAnalysis, \
     SourceFlagChecker, KernelCandidateF, makeKernelBasisList, \
     KernelCandidateQa, DiaCatalogSourceSelectorTask, DiaCatalogSourceSelectorConfig, \
@@ -70,6 +74,22 @@ class ImageDifferenceConfig(pexConfig.Config):
     useGaussianForPreConvolution = pexConfig.Field(dtype=bool, default=True,
                                                    doc="Use a simple gaussian PSF model for pre-convolution "
                                                        "(else use fit PSF)? Ignored if doPreConvolve false.")
+    preConvolveMethod = pexConfig.ChoiceField(dtype=str, default="auto",
+                                              doc="Method for pre-convolution of the science image",
+                                              allowed={"direct": "Direct convolution (afw.math.convolve)",
+                                                       "fft": "Tiled FFT convolution",
+                                                       "auto": "FFT if the kernel is at least "
+                                                               "preConvolveFftMinKernelSize on a side, "
+                                                               "else direct",
+                                                       })
+    preConvolveFftMinKernelSize = pexConfig.Field(dtype=int, default=9,
+                                                  doc="Minimum kernel width and height for which to use "
+                                                      "FFT pre-convolution when preConvolveMethod='auto' "
+                                                      "(FFT is faster than direct convolution from about "
+                                                      "9x9 pixels)")
+    preConvolveFftTileSize = pexConfig.Field(dtype=int, default=1024,
+                                             doc="Size of tiles (pixels, including the kernel border) "
+                                                 "for FFT pre-convolution")
     doDetection = pexConfig.Field(dtype=bool, default=True, doc="Detect sources?")
     doDecorrelation = pexConfig.Field(dtype=bool, default=False,
                                       doc="Perform diffim decorrelation to undo pixel correlation due to A&L "
@@ -164,6 +184,29 @@ class ImageDifferenceConfig(pexConfig.Config):
     diaSourceMatchRadius = pexConfig.Field(dtype=float, default=0.5,
                                            doc="Match radius (in arcseconds) "
                                                "for DiaSource to Source association")
+    doCacheTemplatePatches = pexConfig.Field(dtype=bool, default=False,
+                                             doc="Keep recently used template coadd patches in memory, "
+                                                 "so that the CCDs of a visit processed by the same process "
+                                                 "don't each read them from disk? Whole patches are read "
+                                                 "rather than cutouts, so this only pays off when each "
+                                                 "process handles several CCDs overlapping the same patches; "
+                                                 "each process holds up to templateCacheSize MB (so -j N "
+                                                 "uses up to N times that)")
+    templateCacheSize = pexConfig.RangeField(dtype=float, default=512.0, min=0.0,
+                                             doc="Maximum size (MB) of the template coadd patch cache in "
+                                                 "each process, if doCacheTemplatePatches")
+    latencyBudget = pexConfig.DictField(keytype=str, itemtype=float,
+                                        default={"template": 2.0, "preConvolve": 2.0, "psfMatch": 10.0,
+                                                 "detection": 2.0, "measurement": 5.0},
+                                        doc="Latency budget (sec) for each stage of runInMemory")
+    latencyOverrunAction = pexConfig.ChoiceField(dtype=str, default="degrade",
+                                                 doc="Action when a stage of runInMemory overruns its budget",
+                                                 allowed={"warn": "Log a warning",
+                                                          "degrade": "Log a warning, and reduce the work "
+                                                                     "done in later stages"})
+    refShardCacheSize = pexConfig.RangeField(dtype=int, default=64, min=0,
+                                             doc="Maximum number of reference catalog shards to keep in "
+                                                 "memory, for loaders that read shards (0 for no cache)")
 
     def setDefaults(self):
         # defaults are OK for catalog and diacatalog
@@ -203,6 +246,394 @@ class ImageDifferenceConfig(pexConfig.Config):
                              "Cannot run RegisterTask without selecting sources.")
 
 
+def setMatchIds(catalog, fieldName, matches):
+    """!Set a field of the records of a catalog to the id of the record each matches
+
+    For each match, the field of the record of catalog with id match.second.getId() is set
+    to match.first.getId(); if a record appears in several matches, the last one is used.
+    Records without a match are unchanged.
+
+    @param[in,out] catalog  Contiguous catalog whose records are the second of each match
+    @param[in] fieldName  Name of the field to set (an integer field)
+    @param[in] matches  Matches (e.g., from afw.table.matchXy)
+    @return number of records of catalog that were matched
+    """
+    if len(matches) == 0 or len(catalog) == 0:
+        return 0
+    packed = afwTable.packMatches(matches)
+    # Keep the last match for each record
+    secondIds, lastIndex = numpy.unique(packed["second"][::-1], return_index=True)
+    firstIds = packed["first"][::-1][lastIndex]
+    ids = catalog["id"]
+    sorter = numpy.argsort(ids)
+    index = numpy.searchsorted(ids, secondIds, sorter=sorter)
+    found = index < len(ids)
+    index[~found] = 0
+    found &= ids[sorter[index]] == secondIds
+    catalog[fieldName][sorter[index[found]]] = firstIds[found]
+    return int(found.sum())
+
+
+def _fftCorrelateValid(array, kernel, tileSize):
+    """!Cross-correlate an array with a kernel by tiled FFT, returning only the fully-overlapping part
+
+    @param[in] array  2-d array
+    @param[in] kernel  2-d kernel array, no larger than array
+    @param[in] tileSize  Size of the tiles of array to transform (including the kernel border)
+    @return array of shape (array.shape - kernel.shape + 1) with
+        result[y, x] = sum(kernel[j, i]*array[y + j, x + i] for all j, i)
+    """
+    kh, kw = kernel.shape
+    outH, outW = array.shape[0] - kh + 1, array.shape[1] - kw + 1
+    stepY = max(tileSize - kh + 1, 1)
+    stepX = max(tileSize - kw + 1, 1)
+    flipped = kernel[::-1, ::-1]
+    kernelFfts = {}  # FFT of kernel, by tile shape
+    result = numpy.empty((outH, outW), dtype=float)
+    for y0 in range(0, outH, stepY):
+        y1 = min(y0 + stepY, outH)
+        for x0 in range(0, outW, stepX):
+            x1 = min(x0 + stepX, outW)
+            tile = array[y0:y1 + kh - 1, x0:x1 + kw - 1]
+            shape = tile.shape
+            if shape not in kernelFfts:
+                kernelFfts[shape] = numpy.fft.rfft2(flipped, shape)
+            # Circular convolution with the flipped kernel; wrapped-around pixels are in the first kh-1 rows
+            # and kw-1 columns, which we discard.
+            convolved = numpy.fft.irfft2(numpy.fft.rfft2(tile)*kernelFfts[shape], shape)
+            result[y0:y1, x0:x1] = convolved[kh - 1:, kw - 1:]
+    return result
+
+
+def _orSpan(array, length, axis):
+    """!OR together runs of consecutive elements of an array along an axis
+
+    The span is doubled at each step, so this takes about log2(length) passes over the array.
+
+    @param[in] array  2-d integer or boolean array
+    @param[in] length  Number of consecutive elements to OR together
+    @param[in] axis  Axis along which to OR
+    @return array, shorter by length - 1 along axis, with
+        result[..., k, ...] = OR(array[..., k + i, ...] for i in range(length))
+    """
+    result = array
+    span = 1
+    while span < length:
+        step = min(span, length - span)
+        num = result.shape[axis] - step
+        if axis == 0:
+            result = result[:num] | result[step:step + num]
+        else:
+            result = result[:, :num] | result[:, step:step + num]
+        span += step
+    return result
+
+
+def _orFootprint(array, footprint):
+    """!OR together the values of an array under a footprint, returning only the fully-overlapping part
+
+    This is a binary dilation which treats each bit of an integer array independently, so all the
+    bits of a mask are grown together.
+
+    @param[in] array  2-d integer or boolean array
+    @param[in] footprint  2-d boolean array, no larger than array
+    @return array of shape (array.shape - footprint.shape + 1) with
+        result[y, x] = OR(array[y + j, x + i] for all j, i where footprint[j, i])
+    """
+    fh, fw = footprint.shape
+    outH, outW = array.shape[0] - fh + 1, array.shape[1] - fw + 1
+    if footprint.all():
+        # Separable
+        return _orSpan(_orSpan(array, fw, 1), fh, 0)
+    # OR each row of the footprint as runs of consecutive pixels
+    result = numpy.zeros((outH, outW), dtype=array.dtype)
+    rowSpans = {}  # array ORed over runs, by run length
+    for j in range(fh):
+        row = numpy.concatenate(([False], footprint[j], [False]))
+        edges = numpy.flatnonzero(row[1:] != row[:-1])
+        for start, stop in zip(edges[::2], edges[1::2]):
+            length = stop - start
+            if length not in rowSpans:
+                rowSpans[length] = _orSpan(array, length, 1)
+            result |= rowSpans[length][j:j + outH, start:start + outW]
+    return result
+
+
+def fftConvolve(destMI, srcMI, kernel, convControl=None, tileSize=1024):
+    """!Convolve a masked image with a fixed kernel using tiled FFTs
+
+    This reproduces afw.math.convolve for a fixed kernel:
+    - the image is convolved with the kernel, and the variance with the square of the kernel;
+    - each output mask pixel is the OR of the input mask pixels under the non-zero kernel pixels;
+    - non-finite input pixels under non-zero kernel pixels make the output non-finite;
+    - pixels too close to the edge to be convolved are copied from the input with the EDGE mask bit
+      set (if convControl.getDoCopyEdge()), else set to NaN with the NO_DATA mask bit and infinite
+      variance.
+
+    @param[out] destMI  Convolved masked image; same dimensions as srcMI
+    @param[in] srcMI  Masked image to convolve
+    @param[in] kernel  Fixed convolution kernel
+    @param[in] convControl  Convolution control parameters (afw.math.ConvolutionControl); None for defaults
+    @param[in] tileSize  Size of the tiles to transform (including the kernel border)
+    """
+    if convControl is None:
+        convControl = afwMath.ConvolutionControl()
+    if destMI.getDimensions() != srcMI.getDimensions():
+        raise RuntimeError("Input and output images have different dimensions: %s vs %s" %
+                           (srcMI.getDimensions(), destMI.getDimensions()))
+    if srcMI.getWidth() < kernel.getWidth() or srcMI.getHeight() < kernel.getHeight():
+        raise RuntimeError("Image (%s) is smaller than kernel (%s)" %
+                           (srcMI.getDimensions(), kernel.getDimensions()))
+    kernelImage = afwImage.ImageD(kernel.getDimensions())
+    kernel.computeImage(kernelImage, convControl.getDoNormalize())
+    kernelArray = kernelImage.getArray()
+    nonzero = kernelArray != 0
+    kh, kw = kernelArray.shape
+    x0, y0 = kernel.getCtrX(), kernel.getCtrY()
+    inner = (slice(y0, y0 + srcMI.getHeight() - kh + 1), slice(x0, x0 + srcMI.getWidth() - kw + 1))
+
+    def convolvePlane(array, kernelArray):
+        """Convolve a plane, propagating non-finite values as a direct convolution would"""
+        good = numpy.isfinite(array)
+        result = _fftCorrelateValid(numpy.where(good, array, 0.0), kernelArray, tileSize)
+        if not good.all():
+            # Flag +inf, -inf and NaN as separate bits, and grow them all at once
+            bad = numpy.zeros(array.shape, dtype=numpy.uint8)
+            bad[numpy.isposinf(array)] = 1
+            bad[numpy.isneginf(array)] = 2
+            bad[numpy.isnan(array)] = 4
+            covered = _orFootprint(bad, nonzero)
+            result[covered == 1] = numpy.inf
+            result[covered == 2] = -numpy.inf
+            result[covered > 2] = numpy.nan  # NaN, or inf - inf
+        return result
+
+    srcImage = srcMI.getImage().getArray()
+    srcMask = srcMI.getMask().getArray()
+    srcVariance = srcMI.getVariance().getArray()
+    destImage = destMI.getImage().getArray()
+    destMask = destMI.getMask().getArray()
+    destVariance = destMI.getVariance().getArray()
+
+    if convControl.getDoCopyEdge():
+        destImage[:] = srcImage
+        destMask[:] = srcMask | destMI.getMask().getPlaneBitMask("EDGE")
+        destVariance[:] = srcVariance
+    else:
+        destImage[:] = numpy.nan
+        destMask[:] = destMI.getMask().getPlaneBitMask("NO_DATA")
+        destVariance[:] = numpy.inf
+
+    destImage[inner] = convolvePlane(srcImage, kernelArray)
+    destVariance[inner] = convolvePlane(srcVariance, kernelArray**2)
+
+    destMask[inner] = _orFootprint(srcMask, nonzero)
+
+
+class TemplatePatchCache(object):
+    """!Size-bounded least-recently-used cache of template coadd patches
+
+    Entries are whole patch exposures (image, mask, variance and PSF), keyed by dataset type,
+    tract, patch and filter.
+    """
+
+    def __init__(self, maxBytes):
+        """!Construct a TemplatePatchCache
+
+        @param[in] maxBytes  Maximum total size of the cached patches (bytes)
+        """
+        self.maxBytes = maxBytes
+        self._patches = OrderedDict()
+        self._numBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytesAvoided = 0
+        self.bytesRead = 0
+
+    @staticmethod
+    def getNumBytes(bbox):
+        """!Return the size (bytes) of the pixels of an ExposureF with the given bbox"""
+        return bbox.getArea()*(4 + 4 + 4)  # float image, MaskPixel, VariancePixel
+
+    def getStats(self):
+        """!Return the cumulative cache statistics, as a dict"""
+        return dict(hits=self.hits, misses=self.misses, bytesAvoided=self.bytesAvoided,
+                    bytesRead=self.bytesRead)
+
+    def contains(self, key):
+        """!Return whether a patch is in the cache"""
+        return key in self._patches
+
+    def get(self, key, bbox, read):
+        """!Return a cutout of a patch, reading the patch if it is not in the cache
+
+        @param[in] key  Cache key for the patch
+        @param[in] bbox  Bounding box of the cutout (PARENT coordinates)
+        @param[in] read  Callable returning the whole patch exposure
+        @return cutout exposure (a view into the cached patch; not to be modified)
+        """
+        if key in self._patches:
+            self._patches.move_to_end(key)
+            patch = self._patches[key]
+            self.hits += 1
+            self.bytesAvoided += self.getNumBytes(bbox)
+        else:
+            patch = read()
+            numBytes = self.getNumBytes(patch.getBBox())
+            self.misses += 1
+            self.bytesRead += numBytes
+            self._patches[key] = patch
+            self._numBytes += numBytes
+            while self._numBytes > self.maxBytes and self._patches:
+                oldKey, oldPatch = self._patches.popitem(last=False)
+                self._numBytes -= self.getNumBytes(oldPatch.getBBox())
+        return patch.Factory(patch, bbox, afwImage.PARENT, False)
+
+
+# Per-process template patch cache, shared by the CCDs processed in this process
+_templatePatchCache = None
+
+# Per-process reference catalog shard cache, shared by the CCDs processed in this process
+_refShardCache = None
+
+
+def getTemplatePatchCache(maxBytes):
+    """!Return the per-process template patch cache, creating it if necessary
+
+    @param[in] maxBytes  Maximum total size of the cached patches (bytes)
+    """
+    global _templatePatchCache
+    if _templatePatchCache is None:
+        _templatePatchCache = TemplatePatchCache(maxBytes)
+    _templatePatchCache.maxBytes = maxBytes
+    return _templatePatchCache
+
+
+class RefShardCache(object):
+    """!Least-recently-used cache of reference catalog shards, keyed by reference catalog and shard id
+    """
+
+    def __init__(self, maxShards):
+        """!Construct a RefShardCache
+
+        @param[in] maxShards  Maximum number of shards to keep
+        """
+        self.maxShards = maxShards
+        self._shards = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def getStats(self):
+        """!Return the cumulative cache statistics, as a dict"""
+        return dict(hits=self.hits, misses=self.misses)
+
+    def get(self, key, read):
+        """!Return a shard, reading it if it is not in the cache
+
+        @param[in] key  Cache key for the shard
+        @param[in] read  Callable returning the shard
+        @return shard (not to be modified)
+        """
+        if key in self._shards:
+            self._shards.move_to_end(key)
+            self.hits += 1
+            return self._shards[key]
+        shard = read()
+        self.misses += 1
+        self._shards[key] = shard
+        while len(self._shards) > self.maxShards:
+            self._shards.popitem(last=False)
+        return shard
+
+
+def getRefShardCache(maxShards):
+    """!Return the per-process reference catalog shard cache, creating it if necessary
+
+    @param[in] maxShards  Maximum number of shards to keep
+    """
+    global _refShardCache
+    if _refShardCache is None:
+        _refShardCache = RefShardCache(maxShards)
+    _refShardCache.maxShards = maxShards
+    return _refShardCache
+
+
+@contextmanager
+def cacheRefShards(refObjLoader, cache):
+    """!Context manager making a reference object loader read its shards through a RefShardCache
+
+    This applies to loaders that read the reference catalog in shards (those with a get_shards
+    method, e.g. LoadIndexedReferenceObjectsTask); other loaders are left unchanged.
+    Shards hold all filters, so they are keyed by reference catalog name and shard id.
+    The loader's own get_shards is restored on exit, even if an exception is raised.
+
+    @param[in,out] refObjLoader  Reference object loader
+    @param[in] cache  RefShardCache, or None to leave the loader unchanged
+    """
+    getShards = getattr(refObjLoader, "get_shards", None)
+    if getShards is None or cache is None:
+        yield
+        return
+    catalogName = getattr(refObjLoader, "ref_dataset_name", type(refObjLoader).__name__)
+    overridden = "get_shards" in vars(refObjLoader)
+
+    def getCachedShards(idList):
+        shards = []
+        for shardId in idList:
+            shards += cache.get((catalogName, shardId), lambda: getShards([shardId]))
+        return shards
+
+    refObjLoader.get_shards = getCachedShards
+    try:
+        yield
+    finally:
+        if overridden:
+            refObjLoader.get_shards = getShards
+        else:
+            del refObjLoader.get_shards
+
+
+class TemplatePatchCacheDataRef(object):
+    """!Data reference proxy serving template coadd patch cutouts from a TemplatePatchCache
+
+    Requests for "<coadd>_sub" datasets with a bbox, tract and patch are served from the cache (reading the
+    whole "<coadd>" patch into it if necessary); everything else is passed to the wrapped data reference.
+    """
+
+    def __init__(self, dataRef, cache):
+        self._dataRef = dataRef
+        self._cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self._dataRef, name)
+
+    def _getKey(self, datasetType, rest):
+        """Return the cache key for a patch request, or None if it's not a patch request"""
+        if datasetType is None or not datasetType.endswith("_sub") or "bbox" not in rest or \
+                "patch" not in rest or "tract" not in rest:
+            return None
+        dataId = self._dataRef.dataId
+        # Patches of the same filter are shared between visits; without the filter, only within a visit
+        band = ("filter", dataId["filter"]) if "filter" in dataId else ("visit", dataId.get("visit"))
+        extra = tuple(sorted((k, v) for k, v in rest.items() if k != "bbox"))
+        return (datasetType[:-len("_sub")], band, extra)
+
+    def get(self, datasetType=None, **rest):
+        key = self._getKey(datasetType, rest)
+        if key is None:
+            return self._dataRef.get(datasetType, **rest)
+        patchArgs = dict(rest)
+        bbox = patchArgs.pop("bbox")
+        return self._cache.get(key, bbox,
+                               lambda: self._dataRef.get(datasetType=key[0], immediate=True, **patchArgs))
+
+    def datasetExists(self, datasetType=None, **rest):
+        key = self._getKey(datasetType, rest)
+        if key is not None and self._cache.contains(key):
+            return True
+        return self._dataRef.datasetExists(datasetType, **rest)
+
+
 class ImageDifferenceTaskRunner(pipeBase.ButlerInitializedTaskRunner):
 
     @staticmethod
@@ -235,9 +666,10 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
             self.makeSubtask("register")
         self.schema = afwTable.SourceTable.makeMinimalSchema()
 
+        if self.config.doSelectSources or self.config.doMatchSources:
+            self.makeSubtask('refObjLoader', butler=butler)
         if self.config.doSelectSources:
             self.makeSubtask("sourceSelector")
-            self.makeSubtask('refObjLoader', butler=butler)
             self.makeSubtask("astrometer", refObjLoader=self.refObjLoader)
 
         self.algMetadata = dafBase.PropertyList()
@@ -249,6 +681,10 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
         if self.config.doMatchSources:
             self.schema.addField("refMatchId", "L", "unique id of reference catalog match")
             self.schema.addField("srcMatchId", "L", "unique id of source match")
+            # Astrometer for matching diaSources to the reference catalog
+            refAstromConfig = AstrometryConfig()
+            refAstromConfig.matcher.maxMatchDistArcSec = self.config.diaSourceMatchRadius
+            self.refAstrometer = AstrometryTask(refObjLoader=self.refObjLoader, config=refAstromConfig)
 
     @pipeBase.timeMethod
     def run(self, sensorRef, templateIdList=None):
@@ -313,7 +749,7 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
         templateExposure = None  # Stitched coadd exposure
         templateSources = None   # Sources on the template image
         if self.config.doSubtract:
-            template = self.getTemplate.run(exposure, sensorRef, templateIdList=templateIdList)
+            template = self.retrieveTemplate(exposure, sensorRef, templateIdList=templateIdList)
             templateExposure = template.exposure
             templateSources = template.sources
 
@@ -349,7 +785,7 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
                     else:
                         # convolve with science exposure's PSF model
                         preConvPsf = srcPsf
-                    afwMath.convolve(destMI, srcMI, preConvPsf.getLocalKernel(), convControl)
+                    self.preConvolve(destMI, srcMI, preConvPsf.getLocalKernel(), convControl)
                     exposure.setMaskedImage(destMI)
                     scienceSigmaPost = scienceSigmaOrig * math.sqrt(2)
                 else:
@@ -383,7 +819,9 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
 
                     if self.config.kernelSourcesFromRef:
                         # match exposure sources to reference catalog
-                        astromRet = self.astrometer.loadAndMatch(exposure=exposure, sourceCat=selectSources)
+                        with self.cacheRefShards():
+                            astromRet = self.astrometer.loadAndMatch(exposure=exposure,
+                                                                     sourceCat=selectSources)
                         matches = astromRet.matches
                     elif templateSources:
                         # match exposure sources to template sources
@@ -397,36 +835,9 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
                                            "sources with template sources. Run process* on data from " +
                                            "which templates are built.")
 
-                    kernelSources = self.sourceSelector.run(selectSources, exposure=exposure,
-                                                            matches=matches).sourceCat
-
-                    random.shuffle(kernelSources, random.random)
-                    controlSources = kernelSources[::self.config.controlStepSize]
-                    kernelSources = [k for i, k in enumerate(kernelSources)
-                                     if i % self.config.controlStepSize]
-
-                    if self.config.doSelectDcrCatalog:
-                        redSelector = DiaCatalogSourceSelectorTask(
-                            DiaCatalogSourceSelectorConfig(grMin=self.sourceSelector.config.grMax,
-                                                           grMax=99.999))
-                        redSources = redSelector.selectStars(exposure, selectSources, matches=matches).starCat
-                        controlSources.extend(redSources)
-
-                        blueSelector = DiaCatalogSourceSelectorTask(
-                            DiaCatalogSourceSelectorConfig(grMin=-99.999,
-                                                           grMax=self.sourceSelector.config.grMin))
-                        blueSources = blueSelector.selectStars(exposure, selectSources,
-                                                               matches=matches).starCat
-                        controlSources.extend(blueSources)
-
-                    if self.config.doSelectVariableCatalog:
-                        varSelector = DiaCatalogSourceSelectorTask(
-                            DiaCatalogSourceSelectorConfig(includeVariable=True))
-                        varSources = varSelector.selectStars(exposure, selectSources, matches=matches).starCat
-                        controlSources.extend(varSources)
-
-                    self.log.info("Selected %d / %d sources for Psf matching (%d for control sample)"
-                                  % (len(kernelSources), len(selectSources), len(controlSources)))
+                    selection = self.selectKernelSources(exposure, selectSources, matches)
+                    kernelSources = selection.kernelSources
+                    controlSources = selection.controlSources
                 allresids = {}
                 if self.config.doUseRegister:
                     self.log.info("Registering images")
@@ -542,8 +953,8 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
                             subtractedExposure.setPsf(exposure.getPsf())
                         else:
                             if templateExposure is None:
-                                template = self.getTemplate.run(exposure, sensorRef,
-                                                                templateIdList=templateIdList)
+                                template = self.retrieveTemplate(exposure, sensorRef,
+                                                                 templateIdList=templateIdList)
                             subtractedExposure.setPsf(template.exposure.getPsf())
 
                 # If doSubtract is False, then subtractedExposure was fetched from disk (above),
@@ -563,81 +974,40 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
             # END (if subtractAlgorithm == 'AL')
 
         if self.config.doDetection:
-            self.log.info("Running diaSource detection")
-            # Erase existing detection mask planes
-            mask = subtractedExposure.getMaskedImage().getMask()
-            mask &= ~(mask.getPlaneBitMask("DETECTED") | mask.getPlaneBitMask("DETECTED_NEGATIVE"))
-
-            table = afwTable.SourceTable.make(self.schema, idFactory)
-            table.setMetadata(self.algMetadata)
-            results = self.detection.makeSourceCatalog(
-                table=table,
-                exposure=subtractedExposure,
-                doSmooth=not self.config.doPreConvolve
-            )
-
-            if self.config.doMerge:
-                fpSet = results.fpSets.positive
-                fpSet.merge(results.fpSets.negative, self.config.growFootprint,
-                            self.config.growFootprint, False)
-                diaSources = afwTable.SourceCatalog(table)
-                fpSet.makeSources(diaSources)
-                self.log.info("Merging detections into %d sources" % (len(diaSources)))
-            else:
-                diaSources = results.sources
+            diaSources = self.detectDiaSources(subtractedExposure, idFactory)
 
             if self.config.doMeasurement:
-                newDipoleFitting = self.config.doDipoleFitting
-                self.log.info("Running diaSource measurement: newDipoleFitting=%r", newDipoleFitting)
-                if not newDipoleFitting:
-                    # Just fit dipole in diffim
-                    self.measurement.run(diaSources, subtractedExposure)
-                else:
-                    # Use (matched) template and science image (if avail.) to constrain dipole fitting
-                    if self.config.doSubtract and 'matchedExposure' in subtractRes.getDict():
-                        self.measurement.run(diaSources, subtractedExposure, exposure,
-                                             subtractRes.matchedExposure)
-                    else:
-                        self.measurement.run(diaSources, subtractedExposure, exposure)
+                self.measureDiaSources(diaSources, subtractedExposure, exposure, subtractRes)
 
             # Match with the calexp sources if possible
             if self.config.doMatchSources:
+                if not diaSources.isContiguous():
+                    diaSources = diaSources.copy(deep=True)
                 if sensorRef.datasetExists("src"):
-                    # Create key,val pair where key=diaSourceId and val=sourceId
+                    # Set srcMatchId of each diaSource to the id of the matching source
                     matchRadAsec = self.config.diaSourceMatchRadius
                     matchRadPixel = matchRadAsec / exposure.getWcs().pixelScale().asArcseconds()
 
                     srcMatches = afwTable.matchXy(sensorRef.get("src"), diaSources, matchRadPixel)
-                    srcMatchDict = dict([(srcMatch.second.getId(), srcMatch.first.getId()) for
-                                         srcMatch in srcMatches])
-                    self.log.info("Matched %d / %d diaSources to sources" % (len(srcMatchDict),
-                                                                             len(diaSources)))
+                    numMatched = setMatchIds(diaSources, "srcMatchId", srcMatches)
+                    self.log.info("Matched %d / %d diaSources to sources" % (numMatched, len(diaSources)))
                 else:
                     self.log.warn("Src product does not exist; cannot match with diaSources")
-                    srcMatchDict = {}
 
-                # Create key,val pair where key=diaSourceId and val=refId
-                refAstromConfig = AstrometryConfig()
-                refAstromConfig.matcher.maxMatchDistArcSec = matchRadAsec
-                refAstrometer = AstrometryTask(refAstromConfig)
-                astromRet = refAstrometer.run(exposure=exposure, sourceCat=diaSources)
+                # Set refMatchId of each diaSource to the id of the matching reference object
+                shardCache = getRefShardCache(self.config.refShardCacheSize)
+                before = shardCache.getStats()
+                with self.cacheRefShards():
+                    astromRet = self.refAstrometer.run(exposure=exposure, sourceCat=diaSources)
+                self.metadata.set("refShardCacheHits", shardCache.hits - before["hits"])
+                self.metadata.set("refShardCacheMisses", shardCache.misses - before["misses"])
                 refMatches = astromRet.matches
                 if refMatches is None:
                     self.log.warn("No diaSource matches with reference catalog")
-                    refMatchDict = {}
                 else:
                     self.log.info("Matched %d / %d diaSources to reference catalog" % (len(refMatches),
                                                                                        len(diaSources)))
-                    refMatchDict = dict([(refMatch.second.getId(), refMatch.first.getId()) for
-                                         refMatch in refMatches])
-
-                # Assign source Ids
-                for diaSource in diaSources:
-                    sid = diaSource.getId()
-                    if sid in srcMatchDict:
-                        diaSource.set("srcMatchId", srcMatchDict[sid])
-                    if sid in refMatchDict:
-                        diaSource.set("refMatchId", refMatchDict[sid])
+                    setMatchIds(diaSources, "refMatchId", refMatches)
 
             if diaSources is not None and self.config.doWriteSources:
                 sensorRef.put(diaSources, self.config.coaddName + "Diff_diaSrc")
@@ -681,6 +1051,324 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
             sources=diaSources,
         )
 
+    def runInMemory(self, exposure, templateExposure, templateSources=None, selectSources=None,
+                    idFactory=None):
+        """!Subtract a template from an exposure and detect and measure diaSources, without butler I/O
+
+        This is a low-latency alternative to run, for use when the science exposure (with its
+        background already included or subtracted as desired), the template exposure and
+        (optionally) source catalogs are already in memory.  Only the Alard & Lupton ('al')
+        subtraction algorithm is supported.  Source matching and metric evaluation are not done.
+
+        Each stage (template warping, pre-convolution, PSF-matching, detection and measurement)
+        is timed, and checked against config.latencyBudget.  If a stage overruns, a warning is
+        logged; if config.latencyOverrunAction is "degrade":
+        - if the total time is already over the total budget when measurement is due, measurement
+          is skipped;
+        - otherwise, if any stage overran, dipole fitting is done on the difference image alone,
+          without the science and template images.
+
+        @param[in,out] exposure  Science exposure; must have a PSF (will be pre-convolved if
+            config.doPreConvolve)
+        @param[in] templateExposure  Template exposure, with PSF; warped (with its PSF) to the
+            science exposure
+        @param[in] templateSources  Sources on the template, for selecting kernel candidates (optional;
+            not used if config.kernelSourcesFromRef)
+        @param[in] selectSources  Sources on the science exposure, for selecting kernel candidates
+            (optional; used only if config.doSelectSources, and matched to the reference catalog if
+            config.kernelSourcesFromRef, else to templateSources)
+        @param[in] idFactory  Source id factory; if None, a simple one is used
+        @return pipe_base Struct containing these fields:
+        - subtractedExposure: exposure after subtracting template
+        - subtractRes: results of subtraction task
+        - sources: detected and possibly measured diaSources; None if detection not run
+        - timings: dict of time (sec) taken by each stage
+        - degraded: list of descriptions of work dropped to recover from overruns
+        """
+        if self.config.subtract.name != "al":
+            raise pipeBase.TaskError("runInMemory only supports subtract.name='al', not '%s'" %
+                                     (self.config.subtract.name,))
+        if not exposure.hasPsf():
+            raise pipeBase.TaskError("Exposure has no psf")
+        if idFactory is None:
+            idFactory = afwTable.IdFactory.makeSimple()
+        budget = self.config.latencyBudget
+        timings = {}
+        overruns = []
+        degraded = []
+
+        def finishStage(stage, start):
+            """Record the time taken by a stage, and check it against the budget"""
+            timings[stage] = time.time() - start
+            self.metadata.set("%sLatency" % stage, timings[stage])
+            if stage in budget and timings[stage] > budget[stage]:
+                overruns.append(stage)
+                self.log.warn("Stage %s took %.3f sec, over its budget of %.3f sec" %
+                              (stage, timings[stage], budget[stage]))
+
+        sciencePsf = exposure.getPsf()
+        scienceSigmaOrig = sciencePsf.computeShape().getDeterminantRadius()
+
+        start = time.time()
+        # Warp PSF before overwriting exposure, as subtractExposures does when warping for run
+        xyTransform = afwGeom.makeWcsPairTransform(templateExposure.getWcs(), exposure.getWcs())
+        templatePsf = WarpedPsf(templateExposure.getPsf(), xyTransform)
+        warper = afwMath.Warper.fromConfig(self.subtract.config.kernel.active.warpingConfig)
+        templateExposure = warper.warpExposure(exposure.getWcs(), templateExposure,
+                                               destBBox=exposure.getBBox())
+        templateExposure.setPsf(templatePsf)
+        finishStage("template", start)
+
+        preConvPsf = None
+        if self.config.doPreConvolve:
+            start = time.time()
+            srcMI = exposure.getMaskedImage()
+            destMI = srcMI.Factory(srcMI.getDimensions())
+            if self.config.useGaussianForPreConvolution:
+                kWidth, kHeight = sciencePsf.getLocalKernel().getDimensions()
+                preConvPsf = SingleGaussianPsf(kWidth, kHeight, scienceSigmaOrig)
+            else:
+                preConvPsf = sciencePsf
+            self.preConvolve(destMI, srcMI, preConvPsf.getLocalKernel(), afwMath.ConvolutionControl())
+            exposure.setMaskedImage(destMI)
+            finishStage("preConvolve", start)
+
+        start = time.time()
+        kernelSources = None
+        if self.config.doSelectSources and selectSources is not None:
+            matches = None
+            if self.config.kernelSourcesFromRef:
+                # match exposure sources to reference catalog
+                with self.cacheRefShards():
+                    matches = self.astrometer.loadAndMatch(exposure=exposure, sourceCat=selectSources).matches
+            elif templateSources is not None:
+                # match exposure sources to template sources
+                mc = afwTable.MatchControl()
+                mc.findOnlyClosest = False
+                matches = afwTable.matchRaDec(templateSources, selectSources, 1.0*afwGeom.arcseconds, mc)
+            else:
+                self.log.warn("kernelSourcesFromRef=False, but template sources not available; "
+                              "selecting kernel candidates from the images")
+            if matches is not None:
+                kernelSources = self.selectKernelSources(exposure, selectSources, matches).kernelSources
+        subtractRes = self.subtract.subtractExposures(
+            templateExposure=templateExposure,
+            scienceExposure=exposure,
+            candidateList=kernelSources,
+            convolveTemplate=self.config.convolveTemplate,
+            doWarping=False,
+        )
+        subtractedExposure = subtractRes.subtractedExposure
+        if not subtractedExposure.hasPsf():
+            subtractedExposure.setPsf(exposure.getPsf() if self.config.convolveTemplate else
+                                      templateExposure.getPsf())
+        if self.config.doDecorrelation:
+            preConvKernel = preConvPsf.getLocalKernel() if preConvPsf is not None else None
+            subtractedExposure = self.decorrelate.run(exposure, templateExposure, subtractedExposure,
+                                                      subtractRes.psfMatchingKernel,
+                                                      spatiallyVarying=self.config.doSpatiallyVarying,
+                                                      preConvKernel=preConvKernel).correctedExposure
+        finishStage("psfMatch", start)
+
+        diaSources = None
+        if self.config.doDetection:
+            start = time.time()
+            diaSources = self.detectDiaSources(subtractedExposure, idFactory)
+            finishStage("detection", start)
+
+            if self.config.doMeasurement:
+                elapsed = sum(timings.values())
+                total = sum(budget.get(stage, 0.0) for stage in list(timings.keys()) + ["measurement"])
+                degrade = self.config.latencyOverrunAction == "degrade"
+                if degrade and elapsed > total:
+                    degraded.append("skipped measurement")
+                    self.log.warn("Skipping diaSource measurement: %.3f sec elapsed; budget is %.3f sec" %
+                                  (elapsed, total))
+                else:
+                    useImages = not (degrade and overruns)
+                    if not useImages and self.config.doDipoleFitting:
+                        degraded.append("dipole fitting on difference image only")
+                    start = time.time()
+                    self.measureDiaSources(diaSources, subtractedExposure, exposure, subtractRes,
+                                           useImages=useImages)
+                    finishStage("measurement", start)
+
+        self.log.info("runInMemory stage timings: %s" %
+                      (", ".join("%s=%.3f" % (stage, t) for stage, t in timings.items()),))
+        return pipeBase.Struct(
+            subtractedExposure=subtractedExposure,
+            subtractRes=subtractRes,
+            sources=diaSources,
+            timings=timings,
+            degraded=degraded,
+        )
+
+    def selectKernelSources(self, exposure, selectSources, matches):
+        """!Select the sources used to determine the PSF-matching kernel, and a control sample
+
+        The sources chosen by the sourceSelector subtask are shuffled, and every
+        config.controlStepSize'th one is held back as a control sample.  Red and blue sources
+        (if config.doSelectDcrCatalog) and variable sources (if config.doSelectVariableCatalog)
+        are added to the control sample.
+
+        @param[in] exposure  Science exposure
+        @param[in] selectSources  Sources on the science exposure
+        @param[in] matches  Matches of selectSources to template or reference sources
+        @return pipe_base Struct containing these fields:
+        - kernelSources: list of sources for determining the PSF-matching kernel
+        - controlSources: list of sources for the control sample
+        """
+        kernelSources = self.sourceSelector.run(selectSources, exposure=exposure,
+                                                matches=matches).sourceCat
+
+        random.shuffle(kernelSources, random.random)
+        controlSources = kernelSources[::self.config.controlStepSize]
+        kernelSources = [k for i, k in enumerate(kernelSources)
+                         if i % self.config.controlStepSize]
+
+        if self.config.doSelectDcrCatalog:
+            redSelector = DiaCatalogSourceSelectorTask(
+                DiaCatalogSourceSelectorConfig(grMin=self.sourceSelector.config.grMax,
+                                               grMax=99.999))
+            redSources = redSelector.selectStars(exposure, selectSources, matches=matches).starCat
+            controlSources.extend(redSources)
+
+            blueSelector = DiaCatalogSourceSelectorTask(
+                DiaCatalogSourceSelectorConfig(grMin=-99.999,
+                                               grMax=self.sourceSelector.config.grMin))
+            blueSources = blueSelector.selectStars(exposure, selectSources,
+                                                   matches=matches).starCat
+            controlSources.extend(blueSources)
+
+        if self.config.doSelectVariableCatalog:
+            varSelector = DiaCatalogSourceSelectorTask(
+                DiaCatalogSourceSelectorConfig(includeVariable=True))
+            varSources = varSelector.selectStars(exposure, selectSources, matches=matches).starCat
+            controlSources.extend(varSources)
+
+        self.log.info("Selected %d / %d sources for Psf matching (%d for control sample)"
+                      % (len(kernelSources), len(selectSources), len(controlSources)))
+        return pipeBase.Struct(
+            kernelSources=kernelSources,
+            controlSources=controlSources,
+        )
+
+    def detectDiaSources(self, subtractedExposure, idFactory):
+        """!Detect diaSources on the difference image, merging positive and negative detections if configured
+
+        @param[in,out] subtractedExposure  Difference exposure; its detection mask planes are reset
+        @param[in] idFactory  Source id factory
+        @return catalog of diaSources
+        """
+        self.log.info("Running diaSource detection")
+        # Erase existing detection mask planes
+        mask = subtractedExposure.getMaskedImage().getMask()
+        mask &= ~(mask.getPlaneBitMask("DETECTED") | mask.getPlaneBitMask("DETECTED_NEGATIVE"))
+
+        table = afwTable.SourceTable.make(self.schema, idFactory)
+        table.setMetadata(self.algMetadata)
+        results = self.detection.makeSourceCatalog(
+            table=table,
+            exposure=subtractedExposure,
+            doSmooth=not self.config.doPreConvolve
+        )
+
+        if self.config.doMerge:
+            fpSet = results.fpSets.positive
+            fpSet.merge(results.fpSets.negative, self.config.growFootprint,
+                        self.config.growFootprint, False)
+            diaSources = afwTable.SourceCatalog(table)
+            fpSet.makeSources(diaSources)
+            self.log.info("Merging detections into %d sources" % (len(diaSources)))
+        else:
+            diaSources = results.sources
+        return diaSources
+
+    def measureDiaSources(self, diaSources, subtractedExposure, exposure, subtractRes, useImages=True):
+        """!Measure diaSources
+
+        @param[in,out] diaSources  Catalog of diaSources to measure
+        @param[in] subtractedExposure  Difference exposure
+        @param[in] exposure  Science exposure
+        @param[in] subtractRes  Results of subtraction (None if subtraction was not run)
+        @param[in] useImages  Use the science and matched template images to constrain dipole fitting
+            (if config.doDipoleFitting)?
+        """
+        newDipoleFitting = self.config.doDipoleFitting
+        self.log.info("Running diaSource measurement: newDipoleFitting=%r", newDipoleFitting)
+        if not newDipoleFitting or not useImages:
+            # Just fit dipole in diffim
+            self.measurement.run(diaSources, subtractedExposure)
+        else:
+            # Use (matched) template and science image (if avail.) to constrain dipole fitting
+            if self.config.doSubtract and 'matchedExposure' in subtractRes.getDict():
+                self.measurement.run(diaSources, subtractedExposure, exposure,
+                                     subtractRes.matchedExposure)
+            else:
+                self.measurement.run(diaSources, subtractedExposure, exposure)
+
+    def preConvolve(self, destMI, srcMI, kernel, convControl):
+        """!Convolve the science image with a fixed kernel, by direct or FFT convolution
+
+        @param[out] destMI  Convolved masked image
+        @param[in] srcMI  Masked image to convolve
+        @param[in] kernel  Fixed convolution kernel
+        @param[in] convControl  Convolution control parameters (afw.math.ConvolutionControl)
+        """
+        method = self.config.preConvolveMethod
+        if method == "auto":
+            minSize = self.config.preConvolveFftMinKernelSize
+            useFft = kernel.getWidth() >= minSize and kernel.getHeight() >= minSize
+        else:
+            useFft = method == "fft"
+        self.log.info("Pre-convolving science image with %dx%d kernel using %s convolution" %
+                      (kernel.getWidth(), kernel.getHeight(), "FFT" if useFft else "direct"))
+        if useFft:
+            fftConvolve(destMI, srcMI, kernel, convControl, tileSize=self.config.preConvolveFftTileSize)
+        else:
+            afwMath.convolve(destMI, srcMI, kernel, convControl)
+
+    def retrieveTemplate(self, exposure, sensorRef, templateIdList=None):
+        """!Retrieve the template exposure and sources, using the template patch cache if enabled
+
+        The getTemplate subtask reads cutouts of the template coadd patches overlapping the exposure.
+        With config.doCacheTemplatePatches, the patches are read whole (once per process, while they remain
+        in the cache), and the cutouts for this and subsequent CCDs are made from memory.
+
+        @param[in] exposure  Science exposure
+        @param[in] sensorRef  Sensor-level butler data reference
+        @param[in] templateIdList  List of data ids for the template (only used by some getTemplate subtasks)
+        @return result of the getTemplate subtask
+        """
+        if not self.config.doCacheTemplatePatches:
+            return self.getTemplate.run(exposure, sensorRef, templateIdList=templateIdList)
+        cache = getTemplatePatchCache(int(self.config.templateCacheSize*1024**2))
+        before = cache.getStats()
+        template = self.getTemplate.run(exposure, TemplatePatchCacheDataRef(sensorRef, cache),
+                                        templateIdList=templateIdList)
+        stats = {key: value - before[key] for key, value in cache.getStats().items()}
+        numRequests = stats["hits"] + stats["misses"]
+        self.metadata.set("templateCacheHits", stats["hits"])
+        self.metadata.set("templateCacheMisses", stats["misses"])
+        self.metadata.set("templateCacheHitRate", stats["hits"]/numRequests if numRequests > 0 else 0.0)
+        self.metadata.set("templateCacheBytesAvoided", stats["bytesAvoided"])
+        self.metadata.set("templateCacheBytesRead", stats["bytesRead"])
+        if numRequests > 0:
+            self.log.info("Template patch cache: %d/%d hits; %.1f MB read, %.1f MB of reads avoided" %
+                          (stats["hits"], numRequests, stats["bytesRead"]/1024**2,
+                           stats["bytesAvoided"]/1024**2))
+        return template
+
+    def cacheRefShards(self):
+        """!Return a context manager in which refObjLoader reads its shards through the per-process cache
+
+        The cache is not used if config.refShardCacheSize is 0.
+        """
+        cache = None
+        if self.config.refShardCacheSize > 0:
+            cache = getRefShardCache(self.config.refShardCacheSize)
+        return cacheRefShards(self.refObjLoader, cache)
+
     def fitAstrometry(self, templateSources, templateExposure, selectSources):
         """Fit the relative astrometry between templateSources and selectSources
 
@@ -753,8 +1441,11 @@ class ImageDifferenceTask(pipeBase.CmdLineTask):
                                        origVariance=True)
         if display and showDiaSources:
             flagChecker = SourceFlagChecker(diaSources)
-            isFlagged = [flagChecker(x) for x in diaSources]
-            isDipole = [x.get("classification.dipole") for x in diaSources]
+            if not diaSources.isContiguous():
+                diaSources = diaSources.copy(deep=True)
+            # Vectorized equivalent of [flagChecker(x) for x in diaSources]
+            isFlagged = numpy.logical_not(numpy.any([diaSources[key] for key in flagChecker.keys], axis=0))
+            isDipole = diaSources["classification.dipole"]
             diUtils.showDiaSources(diaSources, subtractRes.subtractedExposure, isFlagged, isDipole,
                                    frame=lsstDebug.frame)
             lsstDebug.frame += 1
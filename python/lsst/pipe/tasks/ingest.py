@@ -1,16 +1,22 @@
 from past.builtins import basestring
+import collections
+import errno
+import hashlib
+import json
+import multiprocessing
 import os
 import shutil
 import tempfile
+import time
 import sqlite3
 from fnmatch import fnmatch
 from glob import glob
 from contextlib import contextmanager
 
-from lsst.pex.config import Config, Field, DictField, ListField, ConfigurableField
+from lsst.pex.config import Config, Field, DictField, ListField, ConfigurableField, ChoiceField
 import lsst.pex.exceptions
-from lsst.afw.fits import readMetadata
-from lsst.pipe.base import Task, InputOnlyArgumentParser
+from lsst.afw.fits import readMetadata, Fits
+from lsst.pipe.base import Task, InputOnlyArgumentParser, Struct
 from lsst.afw.fits import DEFAULT_HDU
 
 
@@ -21,7 +27,8 @@ class IngestArgumentParser(InputOnlyArgumentParser):
         super(IngestArgumentParser, self).__init__(*args, **kwargs)
         self.add_argument("-n", "--dry-run", dest="dryrun", action="store_true", default=False,
                           help="Don't perform any action?")
-        self.add_argument("--mode", choices=["move", "copy", "link", "skip"], default="link",
+        self.add_argument("--mode", choices=["move", "copy", "link", "hardlink", "reflink", "skip"],
+                          default="link",
                           help="Mode of delivering the files to their destination")
         self.add_argument("--create", action="store_true", help="Create new registry (clobber old)?")
         self.add_argument("--ignore-ingested", dest="ignoreIngested", action="store_true",
@@ -55,33 +62,41 @@ class ParseTask(Task):
         Here, we open the image and parse the header, but one could also look at the filename itself
         and derive information from that, or set values from the configuration.
 
+        The file is opened once, and the extension headers are read in sequence from the open file.
+
         @param filename    Name of file to inspect
         @return File properties; list of file properties for each extension
         """
-        md = readMetadata(filename, self.config.hdu)
-        phuInfo = self.getInfoFromMetadata(md)
-        if len(self.config.extnames) == 0:
-            # No extensions to worry about
-            return phuInfo, [phuInfo]
-        # Look in the provided extensions
-        extnames = set(self.config.extnames)
-        extnum = 0
-        infoList = []
-        while len(extnames) > 0:
-            extnum += 1
-            try:
-                md = readMetadata(filename, extnum)
-            except Exception as e:
-                self.log.warn("Error reading %s extensions %s: %s" % (filename, extnames, e))
-                break
-            ext = self.getExtensionName(md)
-            if ext in extnames:
-                hduInfo = self.getInfoFromMetadata(md, info=phuInfo.copy())
-                # We need the HDU number when registering MEF files.
-                hduInfo["hdu"] = extnum
-                infoList.append(hduInfo)
-                extnames.discard(ext)
-        return phuInfo, infoList
+        fits = Fits(filename, "r")
+        try:
+            fits.setHdu(self.config.hdu)
+            md = readMetadata(fits)
+            phuInfo = self.getInfoFromMetadata(md)
+            if len(self.config.extnames) == 0:
+                # No extensions to worry about
+                return phuInfo, [phuInfo]
+            # Look in the provided extensions
+            extnames = set(self.config.extnames)
+            extnum = 0
+            infoList = []
+            while len(extnames) > 0:
+                extnum += 1
+                try:
+                    fits.setHdu(extnum)
+                    md = readMetadata(fits)
+                except Exception as e:
+                    self.log.warn("Error reading %s extensions %s: %s" % (filename, extnames, e))
+                    break
+                ext = self.getExtensionName(md)
+                if ext in extnames:
+                    hduInfo = self.getInfoFromMetadata(md, info=phuInfo.copy())
+                    # We need the HDU number when registering MEF files.
+                    hduInfo["hdu"] = extnum
+                    infoList.append(hduInfo)
+                    extnames.discard(ext)
+            return phuInfo, infoList
+        finally:
+            fits.closeFile()
 
     @staticmethod
     def getExtensionName(md):
@@ -194,6 +209,22 @@ class RegisterConfig(Config):
                       doc="List of columns for raw_visit table")
     ignore = Field(dtype=bool, default=False, doc="Ignore duplicates in the table?")
     permissions = Field(dtype=int, default=0o664, doc="Permissions mode for registry; 0o664 = rw-rw-r--")
+    journalMode = ChoiceField(dtype=str, optional=True, default=None,
+                              doc="SQLite journal mode for the registry; None for the SQLite default",
+                              allowed={"DELETE": "Delete the rollback journal at the end of each transaction",
+                                       "TRUNCATE": "Truncate the rollback journal",
+                                       "PERSIST": "Overwrite the rollback journal header",
+                                       "MEMORY": "Keep the rollback journal in memory",
+                                       "WAL": "Use a write-ahead log",
+                                       "OFF": "No rollback journal",
+                                       })
+    synchronous = ChoiceField(dtype=str, optional=True, default=None,
+                              doc="SQLite synchronous setting for the registry; None for the SQLite default",
+                              allowed={"OFF": "Don't wait for data to reach the disk",
+                                       "NORMAL": "Sync at the most critical moments",
+                                       "FULL": "Sync after every transaction",
+                                       "EXTRA": "Also sync the directory after deleting the journal",
+                                       })
 
 
 class RegistryContext:
@@ -247,6 +278,136 @@ class RegistryContext:
         return False  # Don't suppress any exceptions
 
 
+class IngestJournal:
+    """Record of the progress of an ingest, allowing an interrupted ingest to be resumed
+
+    The journal is an SQLite database alongside the registry, with a row for each file
+    recording its path, size and modification time, the parsed file properties, its
+    destination and its state:
+    * 'transferring': the file has been parsed, and its transfer has started;
+    * 'transferred': the file is in the repository, but not yet in the registry;
+    * 'registered': the file is in the registry.
+
+    Because the registry is only written on successful completion of the ingest (see
+    RegistryContext), files are marked 'registered' only once the registry is closed.
+    """
+
+    def __init__(self, filename, clear=False):
+        """Open the journal
+
+        @param filename: Name of journal file
+        @param clear: Discard any existing entries (e.g., because the registry is being re-created)?
+        """
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INT, mtime DOUBLE, "
+                          "state TEXT, info TEXT, outfile TEXT, outfileExisted INT)")
+        if clear:
+            self.conn.execute("DELETE FROM files")
+        self.conn.commit()
+
+    def close(self):
+        """Close the journal"""
+        self.conn.close()
+
+    def isRegistered(self, infile):
+        """Return whether the file has already been registered
+
+        The file must be unchanged (same size and modification time) since it was registered.
+
+        @param infile: Name of input file
+        """
+        row = self.conn.execute("SELECT size, mtime FROM files WHERE path = ? AND state = 'registered'",
+                                (os.path.abspath(infile),)).fetchone()
+        if row is None:
+            return False
+        stat = os.stat(infile)
+        return (stat.st_size, stat.st_mtime) == tuple(row)
+
+    def startTransfer(self, infile, hduInfoList, outfile):
+        """Record that a file has been parsed, and is about to be transferred
+
+        @param infile: Name of input file
+        @param hduInfoList: List of file properties for each extension
+        @param outfile: Name of output file (file in repository)
+        """
+        stat = os.stat(infile)
+        self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, 'transferring', ?, ?, ?)",
+                          (os.path.abspath(infile), stat.st_size, stat.st_mtime, json.dumps(hduInfoList),
+                           outfile, os.path.lexists(outfile)))
+        self.conn.commit()
+
+    def abortTransfer(self, infile):
+        """Record that a file was not transferred
+
+        @param infile: Name of input file
+        """
+        self.conn.execute("DELETE FROM files WHERE path = ?", (os.path.abspath(infile),))
+        self.conn.commit()
+
+    def finishTransfer(self, infile, hduInfoList):
+        """Record that a file has been transferred into the repository
+
+        @param infile: Name of input file
+        @param hduInfoList: List of file properties for each extension (as registered)
+        """
+        self.conn.execute("UPDATE files SET state = 'transferred', info = ? WHERE path = ?",
+                          (json.dumps(hduInfoList), os.path.abspath(infile)))
+        self.conn.commit()
+
+    def reconcile(self, log, isRegistered=None):
+        """Reconcile files left half-done by an interrupted ingest
+
+        Files that were transferred but not registered are returned for registration,
+        unless they are already in the registry: the ingest may have been interrupted
+        after the registry was written but before finishRegistration was called, in which
+        case they are marked registered.  A file whose transfer was interrupted is treated
+        as transferred if it was moved (the input is gone but the output exists); otherwise
+        any partial output (but not a file that was already there before the transfer) is
+        removed so that the file can be ingested afresh.
+
+        @param log: Logger
+        @param isRegistered: Function returning whether the file properties of an extension are
+            already in the registry, or None to assume they are not
+        @return Struct with:
+            - filenames: set of (absolute) names of the input files that need not be parsed or
+                transferred again (those to register, and those found in the registry)
+            - hduInfoList: list of file properties for each extension of the files to register
+        """
+        filenames = set()
+        hduInfoList = []
+        rows = self.conn.execute("SELECT path, state, info, outfile, outfileExisted FROM files "
+                                 "WHERE state != 'registered'").fetchall()
+        for path, state, info, outfile, outfileExisted in rows:
+            if state == "transferring":
+                if os.path.lexists(path) or not os.path.lexists(outfile):
+                    if os.path.lexists(path) and os.path.lexists(outfile) and not outfileExisted:
+                        log.info("Removing incomplete transfer of %s to %s" % (path, outfile))
+                        os.unlink(outfile)
+                    self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+                    continue
+            elif not os.path.lexists(outfile):
+                self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+                continue
+            filenames.add(path)
+            infoList = json.loads(info)
+            if isRegistered is not None and infoList and all(isRegistered(row) for row in infoList):
+                log.info("%s was registered by an earlier ingest" % (path,))
+                self.conn.execute("UPDATE files SET state = 'registered' WHERE path = ?", (path,))
+                continue
+            log.info("Registering %s, transferred by an earlier ingest" % (path,))
+            self.conn.execute("UPDATE files SET state = 'transferred' WHERE path = ?", (path,))
+            hduInfoList += infoList
+        self.conn.commit()
+        return Struct(filenames=filenames, hduInfoList=hduInfoList)
+
+    def finishRegistration(self):
+        """Record that all transferred files have been registered"""
+        self.conn.execute("UPDATE files SET state = 'registered' WHERE state = 'transferred'")
+        self.conn.commit()
+
+
 @contextmanager
 def fakeContext():
     """A context manager that doesn't provide any context
@@ -276,8 +437,19 @@ class RegisterTask(Task):
 
         registryName = os.path.join(directory, name)
         context = RegistryContext(registryName, self.createTable, create, self.config.permissions)
+        self.configureConnection(context.conn)
         return context
 
+    def configureConnection(self, conn):
+        """Apply the configured journal mode and synchronous setting to the registry connection
+
+        @param conn    Database connection
+        """
+        if self.config.journalMode is not None:
+            conn.cursor().execute("PRAGMA journal_mode = %s" % self.config.journalMode)
+        if self.config.synchronous is not None:
+            conn.cursor().execute("PRAGMA synchronous = %s" % self.config.synchronous)
+
     def createTable(self, conn, table=None):
         """Create the registry tables
 
@@ -304,15 +476,23 @@ class RegisterTask(Task):
 
         conn.commit()
 
-    def check(self, conn, info, table=None):
+    def check(self, conn, info, table=None, pendingKeys=None):
         """Check for the presence of a row already
 
         Not sure this is required, given the 'ignore' configuration option.
+
+        @param conn    Database connection
+        @param info    File properties
+        @param table   Name of table in database
+        @param pendingKeys  Set of unique keys (from getUniqueKey) of rows that are not yet
+                       in the database but will be added by addRows, or None
         """
         if table is None:
             table = self.config.table
         if self.config.ignore or len(self.config.unique) == 0:
             return False  # Our entry could already be there, but we don't care
+        if pendingKeys is not None and self.getUniqueKey(info) in pendingKeys:
+            return True
         cursor = conn.cursor()
         sql = "SELECT COUNT(*) FROM %s WHERE " % table
         sql += " AND ".join(["%s = %s" % (col, self.placeHolder) for col in self.config.unique])
@@ -323,6 +503,13 @@ class RegisterTask(Task):
             return True
         return False
 
+    def getUniqueKey(self, info):
+        """Return the values of the 'unique' columns for a row, as used by check
+
+        @param info    File properties
+        """
+        return tuple(self.typemap[self.config.columns[col]](info[col]) for col in self.config.unique)
+
     def addRow(self, conn, info, dryrun=False, create=False, table=None):
         """Add a row to the file table (typically 'raw').
 
@@ -332,39 +519,166 @@ class RegisterTask(Task):
         """
         if table is None:
             table = self.config.table
+        sql = self.getInsertSql(table)
+        values = self.getInsertValues(info)
+        if dryrun:
+            print("Would execute: '%s' with %s" % (sql, ",".join([str(value) for value in values])))
+        else:
+            conn.cursor().execute(sql, values)
+
+    def addRows(self, conn, infoList, dryrun=False, create=False, table=None):
+        """Add multiple rows to the file table (typically 'raw') with a single prepared statement.
+
+        The statement is the same as for addRow, so the rows (and their ids) are the same as
+        for calling addRow on each.  When duplicates are being ignored, a unique index on the
+        'unique' columns is created if necessary, to serve the check for an existing row.
+
+        @param conn      Database connection
+        @param infoList  List of file properties to add to database
+        @param table     Name of table in database
+        """
+        if table is None:
+            table = self.config.table
+        infoList = list(infoList)
+        if not infoList:
+            return
+        if self.config.ignore and len(self.config.unique) > 0 and not dryrun:
+            try:
+                self.createUniqueIndex(conn, table)
+            except sqlite3.IntegrityError:
+                pass  # Existing table contains duplicates: the check is slower, but still works
+        sql = self.getInsertSql(table)
+        valuesList = [self.getInsertValues(info) for info in infoList]
+        if dryrun:
+            for values in valuesList:
+                print("Would execute: '%s' with %s" % (sql, ",".join([str(value) for value in values])))
+        else:
+            conn.cursor().executemany(sql, valuesList)
+
+    def getInsertSql(self, table):
+        """Return the SQL statement used by addRow and addRows to add a row
+
+        @param table   Name of table in database
+        """
         sql = "INSERT INTO %s (%s) SELECT " % (table, ",".join(self.config.columns))
         sql += ",".join([self.placeHolder] * len(self.config.columns))
-        values = [self.typemap[tt](info[col]) for col, tt in self.config.columns.items()]
-
         if self.config.ignore:
             sql += " WHERE NOT EXISTS (SELECT 1 FROM %s WHERE " % table
             sql += " AND ".join(["%s=%s" % (col, self.placeHolder) for col in self.config.unique])
             sql += ")"
+        return sql
+
+    def getInsertValues(self, info):
+        """Return the values for the SQL statement from getInsertSql
+
+        @param info    File properties to add to database
+        """
+        values = [self.typemap[tt](info[col]) for col, tt in self.config.columns.items()]
+        if self.config.ignore:
             values += [info[col] for col in self.config.unique]
+        return values
 
-        if dryrun:
-            print("Would execute: '%s' with %s" % (sql, ",".join([str(value) for value in values])))
-        else:
-            conn.cursor().execute(sql, values)
+    def createUniqueIndex(self, conn, table=None):
+        """Create a unique index on the 'unique' columns, if not already present
+
+        Tables made by createTable already have one (from the 'unique' constraint),
+        so no index is added to them; this covers registries created by other means.
+
+        @param conn    Database connection
+        @param table   Name of table in database
+        """
+        if table is None:
+            table = self.config.table
+        unique = set(self.config.unique)
+        for name, isUnique, columns in self.getIndexes(conn, table):
+            if isUnique and set(columns) == unique:
+                return
+        conn.cursor().execute("CREATE UNIQUE INDEX IF NOT EXISTS %s_unique ON %s (%s)" %
+                              (table, table, ",".join(self.config.unique)))
+
+    def getIndexes(self, conn, table):
+        """Return the indexes on a table
+
+        @param conn    Database connection
+        @param table   Name of table in database
+        @return list of (name, isUnique, columns) for each index, where columns is the list of
+            indexed columns in order
+        """
+        cursor = conn.cursor()
+        indexes = []
+        for row in cursor.execute("PRAGMA index_list(%s)" % table).fetchall():
+            name, isUnique = row[1], bool(row[2])
+            info = cursor.execute('PRAGMA index_info("%s")' % name).fetchall()
+            indexes.append((name, isUnique, [col[2] for col in sorted(info)]))
+        return indexes
+
+    def getLastId(self, conn, table=None):
+        """Return the largest row id in the file table (typically 'raw'), or 0 if it is empty
 
-    def addVisits(self, conn, dryrun=False, table=None):
+        Rows added after this call have larger ids, which allows addVisits to consider only those.
+
+        @param conn    Database connection
+        @param table   Name of table in database
+        """
+        if table is None:
+            table = self.config.table
+        cursor = conn.cursor()
+        cursor.execute("SELECT MAX(id) FROM %s" % table)
+        lastId = cursor.fetchone()[0]
+        return lastId if lastId is not None else 0
+
+    def addVisits(self, conn, dryrun=False, table=None, sinceId=None):
         """Generate the visits table (typically 'raw_visits') from the
         file table (typically 'raw').
 
+        If sinceId is provided, only rows of the file table with a larger id
+        (i.e., those added since getLastId returned sinceId) are examined, so
+        the cost scales with the size of the ingest rather than of the registry.
+
         @param conn    Database connection
         @param table   Name of table in database
+        @param sinceId Only consider rows with id greater than this (None: all rows)
         """
         if table is None:
             table = self.config.table
         sql = "INSERT INTO %s_visit SELECT DISTINCT " % table
         sql += ",".join(self.config.visit)
         sql += " FROM %s AS vv1" % table
-        sql += " WHERE NOT EXISTS "
+        sql += " WHERE "
+        values = []
+        if sinceId is not None:
+            sql += "vv1.id > %s AND " % self.placeHolder
+            values.append(sinceId)
+        sql += "NOT EXISTS "
         sql += "(SELECT vv2.visit FROM %s_visit AS vv2 WHERE vv1.visit = vv2.visit)" % (table,)
         if dryrun:
-            print("Would execute: %s" % sql)
+            print("Would execute: %s with %s" % (sql, values))
         else:
-            conn.cursor().execute(sql)
+            self.createVisitIndex(conn, table)
+            conn.cursor().execute(sql, values)
+
+    def createVisitIndex(self, conn, table=None):
+        """Create an index on the visit column of the visits table, if no index covers it
+
+        Tables made by createTable already have a unique index with visit as its first
+        column (from the 'unique' constraint), so no index is added to them.  For other
+        registries, a unique index is created; if the visits table already contains
+        duplicate visits (as some legacy registries do), a non-unique index is created
+        instead, which still serves the lookup on visit in addVisits.
+
+        @param conn    Database connection
+        @param table   Name of file table in database (the visits table is this with '_visit' appended)
+        """
+        if table is None:
+            table = self.config.table
+        visitTable = "%s_visit" % (table,)
+        for name, isUnique, columns in self.getIndexes(conn, visitTable):
+            if columns and columns[0] == "visit":
+                return
+        try:
+            conn.cursor().execute("CREATE UNIQUE INDEX %s_visit ON %s (visit)" % (visitTable, visitTable))
+        except sqlite3.IntegrityError:
+            conn.cursor().execute("CREATE INDEX %s_visit ON %s (visit)" % (visitTable, visitTable))
 
 
 class IngestConfig(Config):
@@ -373,6 +687,23 @@ class IngestConfig(Config):
     register = ConfigurableField(target=RegisterTask, doc="Registry entry")
     allowError = Field(dtype=bool, default=False, doc="Allow error in ingestion?")
     clobber = Field(dtype=bool, default=False, doc="Clobber existing file?")
+    numProcesses = Field(dtype=int, default=1,
+                         doc="Number of processes for parsing headers, and the number for "
+                         "transferring files; if 1, files are ingested serially")
+    commitBatchSize = Field(dtype=int, default=1000,
+                            doc="Number of rows to accumulate before adding them to the registry")
+    journal = Field(dtype=str, optional=True, default=None,
+                    doc="Name of journal file (in the repository) recording the progress of the ingest, "
+                    "so that an interrupted ingest may be resumed; None for no journal")
+    copyBufferSize = Field(dtype=int, default=16*1024**2, doc="Buffer size (bytes) for copying files")
+    checksum = ChoiceField(dtype=str, optional=True, default=None,
+                           doc="Checksum to record in the registry 'checksum' column; None for no checksum",
+                           allowed={"md5": "MD5 digest", "sha1": "SHA-1 digest", "sha256": "SHA-256 digest"})
+
+    def validate(self):
+        Config.validate(self)
+        if self.checksum is not None and "checksum" not in self.register.columns:
+            raise ValueError("register.columns must include 'checksum' when checksum=%s" % (self.checksum,))
 
 
 class IngestTask(Task):
@@ -383,6 +714,7 @@ class IngestTask(Task):
 
     def __init__(self, *args, **kwargs):
         super(IngestTask, self).__init__(*args, **kwargs)
+        self.journal = None
         self.makeSubtask("parse")
         self.makeSubtask("register")
 
@@ -400,15 +732,32 @@ class IngestTask(Task):
 
         @param infile  Name of input file
         @param outfile Name of output file (file in repository)
-        @param mode    Mode of ingest (copy/link/move/skip)
+        @param mode    Mode of ingest (copy/link/hardlink/reflink/move/skip)
         @param dryrun  Only report what would occur?
         @param Success boolean
         """
+        return self.ingestFile(infile, outfile, mode=mode, dryrun=dryrun).success
+
+    def ingestFile(self, infile, outfile, mode="move", dryrun=False):
+        """Ingest a file into the image repository, and calculate its checksum.
+
+        The 'hardlink' and 'reflink' (copy-on-write clone) modes fall back to
+        copying if the filesystem doesn't support them (e.g., if infile and
+        outfile are on different filesystems).
+
+        @param infile  Name of input file
+        @param outfile Name of output file (file in repository)
+        @param mode    Mode of ingest (copy/link/hardlink/reflink/move/skip)
+        @param dryrun  Only report what would occur?
+        @return Struct with success boolean and checksum (hex digest of the file
+            contents if config.checksum is set, otherwise None)
+        """
         if mode == "skip":
-            return True
+            doChecksum = self.config.checksum is not None and not dryrun
+            return Struct(success=True, checksum=self.calculateChecksum(infile) if doChecksum else None)
         if dryrun:
             self.log.info("Would %s from %s to %s" % (mode, infile, outfile))
-            return True
+            return Struct(success=True, checksum=None)
         try:
             outdir = os.path.dirname(outfile)
             if not os.path.isdir(outdir):
@@ -424,23 +773,77 @@ class IngestTask(Task):
                 else:
                     raise RuntimeError("File %s already exists; consider --config clobber=True" % outfile)
 
+            start = time.time()
+            checksum = None
             if mode == "copy":
-                assertCanCopy(infile, outfile)
-                shutil.copyfile(infile, outfile)
+                checksum = self.copyFile(infile, outfile)
             elif mode == "link":
                 os.symlink(os.path.abspath(infile), outfile)
+            elif mode == "hardlink":
+                try:
+                    os.link(infile, outfile)
+                except OSError as e:
+                    self.log.debug("Unable to hard link %s to %s (%s); copying" % (infile, outfile, e))
+                    checksum = self.copyFile(infile, outfile)
+            elif mode == "reflink":
+                if not cloneFile(infile, outfile):
+                    self.log.debug("Unable to clone %s to %s; copying" % (infile, outfile))
+                    checksum = self.copyFile(infile, outfile)
             elif mode == "move":
                 assertCanCopy(infile, outfile)
                 os.rename(infile, outfile)
             else:
                 raise AssertionError("Unknown mode: %s" % mode)
-            self.log.info("%s --<%s>--> %s" % (infile, mode, outfile))
+            if self.config.checksum is not None and checksum is None:
+                checksum = self.calculateChecksum(outfile)
+            elapsed = time.time() - start
+            size = os.stat(outfile).st_size
+            self.log.info("%s --<%s>--> %s (%d bytes in %.3f sec: %.1f MB/s)" %
+                          (infile, mode, outfile, size, elapsed, size/max(elapsed, 1.0e-6)/1.0e6))
         except Exception as e:
             self.log.warn("Failed to %s %s to %s: %s" % (mode, infile, outfile, e))
             if not self.config.allowError:
                 raise
-            return False
-        return True
+            return Struct(success=False, checksum=None)
+        return Struct(success=True, checksum=checksum)
+
+    def copyFile(self, infile, outfile):
+        """Copy a file using a large buffer, calculating the checksum as we go
+
+        @param infile  Name of input file
+        @param outfile Name of output file
+        @return checksum (hex digest) if config.checksum is set, otherwise None
+        """
+        assertCanCopy(infile, outfile)
+        digest = hashlib.new(self.config.checksum) if self.config.checksum is not None else None
+        buf = bytearray(self.config.copyBufferSize)
+        view = memoryview(buf)
+        with open(infile, "rb") as fin, open(outfile, "wb") as fout:
+            while True:
+                num = fin.readinto(buf)
+                if not num:
+                    break
+                fout.write(view[:num])
+                if digest is not None:
+                    digest.update(view[:num])
+        return digest.hexdigest() if digest is not None else None
+
+    def calculateChecksum(self, filename):
+        """Calculate the configured checksum of a file
+
+        @param filename  Name of file
+        @return checksum (hex digest)
+        """
+        digest = hashlib.new(self.config.checksum)
+        buf = bytearray(self.config.copyBufferSize)
+        view = memoryview(buf)
+        with open(filename, "rb") as fin:
+            while True:
+                num = fin.readinto(buf)
+                if not num:
+                    break
+                digest.update(view[:num])
+        return digest.hexdigest()
 
     def isBadFile(self, filename, badFileList):
         """Return whether the file qualifies as bad
@@ -486,11 +889,13 @@ class IngestTask(Task):
 
         return filenameList
 
-    def runFile(self, infile, registry, args):
+    def runFile(self, infile, registry, args, pendingKeys=None):
         """!Examine and ingest a single file
 
         @param infile: File to process
         @param args: Parsed command-line arguments
+        @param pendingKeys: Set of unique keys of rows awaiting addition to the registry, which is
+            checked along with the registry and updated if the file is ingested; or None
         @return parsed information from FITS HDUs or None
         """
         if self.isBadFile(infile, args.badFile):
@@ -506,32 +911,229 @@ class IngestTask(Task):
         if self.isBadId(fileInfo, args.badId.idList):
             self.log.info("Skipping declared bad file %s: %s" % (infile, fileInfo))
             return
-        if registry is not None and self.register.check(registry, fileInfo):
+        if registry is not None and self.register.check(registry, fileInfo, pendingKeys=pendingKeys):
             if args.ignoreIngested:
                 return None
             self.log.warn("%s: already ingested: %s" % (infile, fileInfo))
         outfile = self.parse.getDestination(args.butler, fileInfo, infile)
-        if not self.ingest(infile, outfile, mode=args.mode, dryrun=args.dryrun):
+        if self.journal is not None:
+            self.journal.startTransfer(infile, hduInfoList, outfile)
+        try:
+            result = self.ingestFile(infile, outfile, mode=args.mode, dryrun=args.dryrun)
+        except Exception:
+            if self.journal is not None:
+                self.journal.abortTransfer(infile)
+            raise
+        if not result.success:
+            if self.journal is not None:
+                self.journal.abortTransfer(infile)
             return None
+        if result.checksum is not None:
+            for info in hduInfoList:
+                info["checksum"] = result.checksum
+        if self.journal is not None:
+            self.journal.finishTransfer(infile, hduInfoList)
+        if pendingKeys is not None:
+            pendingKeys.add(self.register.getUniqueKey(fileInfo))
         return hduInfoList
 
     def run(self, args):
-        """Ingest all specified files and add them to the registry"""
+        """Ingest all specified files and add them to the registry
+
+        If config.journal is set, files registered by an earlier ingest (as recorded
+        in the journal) are skipped without reading their headers, and files that an
+        interrupted ingest left transferred but not registered are registered (again
+        without reading their headers or transferring them again).
+        """
         filenameList = self.expandFiles(args.files)
         root = args.input
-        context = self.register.openRegistry(root, create=args.create, dryrun=args.dryrun)
-        with context as registry:
-            for infile in filenameList:
+        if self.config.journal is not None and not args.dryrun:
+            self.journal = IngestJournal(os.path.join(root, self.config.journal), clear=args.create)
+        try:
+            if self.journal is not None:
+                numFiles = len(filenameList)
+                filenameList = [infile for infile in filenameList if not self.journal.isRegistered(infile)]
+                if len(filenameList) < numFiles:
+                    self.log.info("Skipping %d files registered by an earlier ingest" %
+                                  (numFiles - len(filenameList),))
+            context = self.register.openRegistry(root, create=args.create, dryrun=args.dryrun)
+            with context as registry:
+                rows = []  # Rows transferred by an earlier ingest, awaiting registration
+                if self.journal is not None:
+                    reconciled = self.journal.reconcile(
+                        self.log, isRegistered=lambda info: self.register.check(registry, info))
+                    filenameList = [infile for infile in filenameList if
+                                    os.path.abspath(infile) not in reconciled.filenames]
+                    rows = reconciled.hduInfoList
+                lastId = self.register.getLastId(registry) if registry is not None else None
+                self.register.addRows(registry, rows, dryrun=args.dryrun, create=args.create)
+                if self.config.numProcesses > 1:
+                    self.runPipelined(filenameList, registry, args)
+                else:
+                    self.runSerial(filenameList, registry, args)
+                self.register.addVisits(registry, dryrun=args.dryrun, sinceId=lastId)
+            if self.journal is not None:
+                self.journal.finishRegistration()
+        finally:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+    def runSerial(self, filenameList, registry, args):
+        """!Ingest files one at a time, and add them to the registry
+
+        @param filenameList: List of files to ingest
+        @param registry: Registry connection (None for a dry run)
+        @param args: Parsed command-line arguments
+        """
+        rows = []
+        pendingKeys = set()  # Unique keys of rows in 'rows', which check() can't find in the registry
+        for infile in filenameList:
+            try:
+                hduInfoList = self.runFile(infile, registry, args, pendingKeys=pendingKeys)
+            except Exception as exc:
+                self.log.warn("Failed to ingest file %s: %s", infile, exc)
+                continue
+            if hduInfoList is None:
+                continue
+            rows.extend(hduInfoList)
+            if len(rows) >= self.config.commitBatchSize:
+                self.register.addRows(registry, rows, dryrun=args.dryrun, create=args.create)
+                rows = []
+                pendingKeys.clear()
+        self.register.addRows(registry, rows, dryrun=args.dryrun, create=args.create)
+
+    def runPipelined(self, filenameList, registry, args):
+        """!Ingest files, parsing headers and transferring files in parallel
+
+        Headers are parsed by one pool of config.numProcesses worker processes, and files are transferred by
+        another, so that transfers proceed while later headers are being parsed.  This (main) process is the
+        only one that uses the registry: it checks each parsed file against the registry and the files
+        already transferred, queues the transfer, and adds the registry rows as transfers complete.  Rows are
+        added in the order of filenameList, regardless of the order in which the workers finish, so the
+        registry contents are the same as for a serial ingest.  A file with the same unique key or
+        destination as a queued transfer waits for that transfer to finish before it is checked, so that
+        the check sees the outcome of the transfer, and two transfers never write the same file.
+
+        @param filenameList: List of files to ingest
+        @param registry: Registry connection (None for a dry run)
+        @param args: Parsed command-line arguments
+        """
+        global _ingestTask
+        _ingestTask = self
+        filenameList = [infile for infile in filenameList if not self._isDeclaredBadFile(infile, args)]
+        pendingKeys = set()  # Unique keys of rows transferred and awaiting addition to the registry
+        transfers = collections.deque()  # (infile, key, outfile, hduInfoList, AsyncResult) in file order
+        queuedKeys = set()  # Unique keys of files in transfers
+        queuedOutfiles = set()  # Destinations of files in transfers
+        rows = []  # Rows for completed transfers, to be added to the registry
+
+        def finishTransfer():
+            """Wait for the earliest queued transfer to complete, and accumulate its rows"""
+            infile, key, outfile, hduInfoList, result = transfers.popleft()
+            queuedKeys.discard(key)
+            queuedOutfiles.discard(outfile)
+            ingested, error = result.get()
+            if error is not None or not ingested.success:
+                if self.journal is not None:
+                    self.journal.abortTransfer(infile)
+                if error is not None:
+                    self.log.warn("Failed to ingest file %s: %s", infile, error)
+                return
+            if ingested.checksum is not None:
+                for info in hduInfoList:
+                    info["checksum"] = ingested.checksum
+            if self.journal is not None:
+                self.journal.finishTransfer(infile, hduInfoList)
+            pendingKeys.add(key)
+            rows.extend(hduInfoList)
+
+        def register(block):
+            """Accumulate the rows for completed transfers, in order"""
+            while transfers and (block or transfers[0][-1].ready()):
+                finishTransfer()
+
+        context = multiprocessing.get_context("fork")
+        parsePool = context.Pool(self.config.numProcesses)
+        transferPool = context.Pool(self.config.numProcesses)
+        try:
+            for infile, (parsed, error) in zip(filenameList, parsePool.imap(_parseFile, filenameList)):
+                if error is not None:
+                    if not self.config.allowError:
+                        self.log.warn("Failed to ingest file %s: %s", infile, error)
+                    else:
+                        self.log.warn("Error parsing %s (%s); skipping" % (infile, error))
+                    continue
+                fileInfo, hduInfoList = parsed
                 try:
-                    hduInfoList = self.runFile(infile, registry, args)
+                    if self.isBadId(fileInfo, args.badId.idList):
+                        self.log.info("Skipping declared bad file %s: %s" % (infile, fileInfo))
+                        continue
+                    key = self.register.getUniqueKey(fileInfo)
+                    outfile = self.parse.getDestination(args.butler, fileInfo, infile)
+                    while (key and key in queuedKeys) or outfile in queuedOutfiles:
+                        finishTransfer()
+                    if registry is not None and self.register.check(registry, fileInfo,
+                                                                    pendingKeys=pendingKeys):
+                        if args.ignoreIngested:
+                            continue
+                        self.log.warn("%s: already ingested: %s" % (infile, fileInfo))
                 except Exception as exc:
                     self.log.warn("Failed to ingest file %s: %s", infile, exc)
                     continue
-                if hduInfoList is None:
-                    continue
-                for info in hduInfoList:
-                    self.register.addRow(registry, info, dryrun=args.dryrun, create=args.create)
-            self.register.addVisits(registry, dryrun=args.dryrun)
+                if self.journal is not None:
+                    self.journal.startTransfer(infile, hduInfoList, outfile)
+                transfers.append((infile, key, outfile, hduInfoList,
+                                  transferPool.apply_async(_transferFile,
+                                                           (infile, outfile, args.mode, args.dryrun))))
+                if key:
+                    queuedKeys.add(key)
+                queuedOutfiles.add(outfile)
+                register(block=False)
+                if len(rows) >= self.config.commitBatchSize:
+                    self.register.addRows(registry, rows, dryrun=args.dryrun, create=args.create)
+                    del rows[:]
+                    pendingKeys.clear()
+            register(block=True)
+            self.register.addRows(registry, rows, dryrun=args.dryrun, create=args.create)
+        finally:
+            for pool in (parsePool, transferPool):
+                pool.close()
+                pool.join()
+            _ingestTask = None
+
+    def _isDeclaredBadFile(self, infile, args):
+        """Return whether the file is declared bad, logging if so"""
+        if self.isBadFile(infile, args.badFile):
+            self.log.info("Skipping declared bad file %s" % infile)
+            return True
+        return False
+
+
+# IngestTask shared with forked IngestTask.runPipelined worker processes
+_ingestTask = None
+
+
+def _parseFile(infile):
+    """Parse a file's headers in an IngestTask.runPipelined worker process
+
+    @return (fileInfo, hduInfoList) or None, and an error message or None
+    """
+    try:
+        return _ingestTask.parse.getInfo(infile), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _transferFile(infile, outfile, mode, dryrun):
+    """Transfer a file in an IngestTask.runPipelined worker process
+
+    @return result of IngestTask.ingestFile, and an error message or None
+    """
+    try:
+        return _ingestTask.ingestFile(infile, outfile, mode=mode, dryrun=dryrun), None
+    except Exception as e:
+        return Struct(success=False, checksum=None), str(e)
 
 
 def assertCanCopy(fromPath, toPath):
@@ -545,3 +1147,30 @@ def assertCanCopy(fromPath, toPath):
     avail = st.f_bavail * st.f_frsize
     if avail < req:
         raise RuntimeError("Insufficient space: %d vs %d" % (req, avail))
+
+
+# ioctl request code for cloning a file on Linux (FICLONE = _IOW(0x94, 9, int))
+_FICLONE = 0x40049409
+
+
+def cloneFile(fromPath, toPath):
+    """Make a copy-on-write clone (reflink) of a file, if the filesystem supports it
+
+    @param fromPath    Path of file to clone
+    @param toPath      Path of clone
+    @return whether the clone was made; if not, toPath does not exist
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    try:
+        with open(fromPath, "rb") as fin, open(toPath, "wb") as fout:
+            fcntl.ioctl(fout.fileno(), _FICLONE, fin.fileno())
+    except (IOError, OSError) as e:
+        if os.path.lexists(toPath):
+            os.unlink(toPath)
+        if e.errno in (errno.ENOENT, errno.EACCES):
+            raise
+        return False
+    return True
@@ -73,6 +73,9 @@ class CalibsRegisterConfig(RegisterConfig):
                                         doc="Tables for which to set validity for a calib from when it is "
                                         "taken until it is superseded by the next; validity in other tables "
                                         "is calculated by applying the validity range.")
+    validityTable = Field(dtype=str, default="calibValidity",
+                          doc="Name of table recording the validity range (days) last applied, so that "
+                          "all validity ranges are recalculated if it changes")
 
 
 class CalibsRegisterTask(RegisterTask):
@@ -94,25 +97,111 @@ class CalibsRegisterTask(RegisterTask):
         info[self.config.validEnd] = None
         RegisterTask.addRow(self, conn, info, *args, **kwargs)
 
-    def updateValidityRanges(self, conn, validity):
+    def addRows(self, conn, infoList, *args, **kwargs):
+        """Add multiple rows to the file table"""
+        for info in infoList:
+            info[self.config.validStart] = None
+            info[self.config.validEnd] = None
+        RegisterTask.addRows(self, conn, infoList, *args, **kwargs)
+
+    def getDetectorData(self, info):
+        """Return the values identifying the detector of a calib, as stored in the registry
+
+        @param info: File properties
+        @return tuple of values for the columns in self.config.detector
+        """
+        return tuple(self.typemap[self.config.columns[col]](info[col]) if col in self.config.columns else
+                     info[col] for col in self.config.detector)
+
+    def updateValidityRanges(self, conn, validity, detectorsByTable=None):
         """Loop over all tables, filters, and ccdnums,
         and update the validity ranges in the registry.
 
+        The validity ranges of a calib depend only on the validity range (days) and
+        the other calibs for the same detector, so after an ingest with the same validity
+        range as before only the detectors that received new calibs need be recomputed;
+        the results are identical to recomputing everything. The validity range applied is
+        recorded in the registry, and if it differs (or was not recorded) all detectors
+        are updated.
+
         @param conn: Database connection
         @param validity: Validity range (days)
+        @param detectorsByTable: Mapping of table name to a set of detectors (tuples of
+            values for the columns in self.config.detector) whose validity ranges should
+            be updated; if None, all detectors in all tables are updated.
         """
+        lastValidity = self.getRecordedValidity(conn)
+        if detectorsByTable is not None and lastValidity != validity:
+            self.log.info("Validity range changed from %s to %d days; updating all validity ranges" %
+                          (lastValidity, validity))
+            detectorsByTable = None
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         for table in self.config.tables:
-            sql = "SELECT DISTINCT %s FROM %s" % (", ".join(self.config.detector), table)
-            cursor.execute(sql)
-            rows = cursor.fetchall()
-            for row in rows:
-                self.fixSubsetValidity(conn, table, row, validity)
+            if detectorsByTable is None:
+                sql = "SELECT DISTINCT %s FROM %s" % (", ".join(self.config.detector), table)
+                cursor.execute(sql)
+                detectors = cursor.fetchall()
+            else:
+                detectors = detectorsByTable.get(table, ())
+            updates = []
+            for detectorData in detectors:
+                updates += self.calculateSubsetValidity(conn, table, detectorData, validity)
+            self.writeValidity(conn, table, updates)
+        self.recordValidity(conn, validity)
+
+    def getRecordedValidity(self, conn):
+        """Return the validity range (days) recorded by recordValidity, or None
+
+        @param conn: Database connection
+        """
+        cursor = conn.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?",
+                       (self.config.validityTable,))
+        if cursor.fetchone() is None:
+            return None
+        cursor.execute("SELECT validity FROM %s" % self.config.validityTable)
+        row = cursor.fetchone()
+        return row[0] if row is not None else None
+
+    def recordValidity(self, conn, validity):
+        """Record the validity range (days) applied to the registry
+
+        @param conn: Database connection
+        @param validity: Validity range (days)
+        """
+        cursor = conn.cursor()
+        cursor.execute("CREATE TABLE IF NOT EXISTS %s (validity INT)" % self.config.validityTable)
+        cursor.execute("DELETE FROM %s" % self.config.validityTable)
+        cursor.execute("INSERT INTO %s VALUES (?)" % self.config.validityTable, (validity,))
 
     def fixSubsetValidity(self, conn, table, detectorData, validity):
         """Update the validity ranges among selected rows in the registry.
 
+        @param conn: Database connection
+        @param table: Name of table to be selected
+        @param detectorData: Values identifying a detector (from columns in self.config.detector)
+        @param validity: Validity range (days)
+        """
+        self.writeValidity(conn, table, self.calculateSubsetValidity(conn, table, detectorData, validity))
+
+    def writeValidity(self, conn, table, updates):
+        """Write validity ranges to the registry with a single statement
+
+        @param conn: Database connection
+        @param table: Name of table to update
+        @param updates: List of (validStart, validEnd, id) tuples
+        """
+        if not updates:
+            return
+        sql = "UPDATE %s" % table
+        sql += " SET %s=?, %s=?" % (self.config.validStart, self.config.validEnd)
+        sql += " WHERE id=?"
+        conn.executemany(sql, updates)
+
+    def calculateSubsetValidity(self, conn, table, detectorData, validity):
+        """Calculate the validity ranges among selected rows in the registry.
+
         For defects, the products are valid from their start date until
         they are superseded by subsequent defect data.
         For other calibration products, the validity ranges are checked and
@@ -124,6 +213,7 @@ class CalibsRegisterTask(RegisterTask):
         @param table: Name of table to be selected
         @param detectorData: Values identifying a detector (from columns in self.config.detector)
         @param validity: Validity range (days)
+        @return list of (validStart, validEnd, id) tuples for rows whose validity range has changed
         """
         columns = ", ".join([self.config.calibDate, self.config.validStart, self.config.validEnd])
         sql = "SELECT id, %s FROM %s" % (columns, table)
@@ -132,6 +222,8 @@ class CalibsRegisterTask(RegisterTask):
         cursor = conn.cursor()
         cursor.execute(sql, detectorData)
         rows = cursor.fetchall()
+        if not rows:
+            return []
 
         try:
             valids = collections.OrderedDict([(_convertToDate(row[self.config.calibDate]), [None, None]) for
@@ -141,7 +233,7 @@ class CalibsRegisterTask(RegisterTask):
             # Sqlite returns unicode strings, which cannot be passed through SWIG.
             self.log.warn(str("Skipped setting the validity overlaps for %s %s: missing calibration dates" %
                               (table, det)))
-            return
+            return []
         dates = list(valids.keys())
         if table in self.config.validityUntilSuperseded:
             # A calib is valid until it is superseded
@@ -164,15 +256,15 @@ class CalibsRegisterTask(RegisterTask):
                     valids[date][1] = midpoint
             del midpoints
         del dates
-        # Update the validity data in the registry
+        # Collect the validity data that need to be updated in the registry
+        updates = []
         for row in rows:
             calibDate = _convertToDate(row[self.config.calibDate])
             validStart = valids[calibDate][0].isoformat()
             validEnd = valids[calibDate][1].isoformat()
-            sql = "UPDATE %s" % table
-            sql += " SET %s=?, %s=?" % (self.config.validStart, self.config.validEnd)
-            sql += " WHERE id=?"
-            conn.execute(sql, (validStart, validEnd, row["id"]))
+            if (validStart, validEnd) != (row[self.config.validStart], row[self.config.validEnd]):
+                updates.append((validStart, validEnd, row["id"]))
+        return updates
 
 
 class IngestCalibsArgumentParser(InputOnlyArgumentParser):
@@ -214,6 +306,7 @@ class IngestCalibsTask(IngestTask):
         """Ingest all specified files and add them to the registry"""
         calibRoot = args.calib if args.calib is not None else args.output
         filenameList = self.expandFiles(args.files)
+        detectorsByTable = collections.defaultdict(set)  # Detectors receiving new calibs, by table
         with self.register.openRegistry(calibRoot, create=args.create, dryrun=args.dryrun) as registry:
             for infile in filenameList:
                 fileInfo, hduInfoList = self.parse.getInfo(infile)
@@ -241,7 +334,8 @@ class IngestCalibsTask(IngestTask):
                 for info in hduInfoList:
                     self.register.addRow(registry, info, dryrun=args.dryrun,
                                          create=args.create, table=calibType)
+                    detectorsByTable[calibType].add(self.register.getDetectorData(info))
             if not args.dryrun:
-                self.register.updateValidityRanges(registry, args.validity)
+                self.register.updateValidityRanges(registry, args.validity, detectorsByTable)
             else:
                 self.log.info("Would update validity ranges here, but dryrun")
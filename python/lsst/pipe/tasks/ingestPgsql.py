@@ -100,6 +100,33 @@ class PgsqlRegisterTask(RegisterTask):
         del cur
         conn.commit()
 
+    def getIndexes(self, conn, table):
+        """Return the indexes on a table
+
+        This method is required because PostgreSQL lists indexes in its system
+        catalogs rather than through PRAGMA statements.
+
+        @param conn    Database connection
+        @param table   Name of table in database
+        @return list of (name, isUnique, columns) for each index, where columns is the list of
+            indexed columns in order
+        """
+        cur = conn.cursor()
+        cur.execute("SELECT ii.relname, ix.indisunique, ix.indkey, tt.oid FROM pg_index AS ix "
+                    "JOIN pg_class AS tt ON tt.oid = ix.indrelid "
+                    "JOIN pg_class AS ii ON ii.oid = ix.indexrelid WHERE tt.relname = %s", (table,))
+        indexes = []
+        for name, isUnique, indkey, tableOid in cur.fetchall():
+            columns = []
+            for attnum in (int(num) for num in str(indkey).split()):
+                cur.execute("SELECT attname FROM pg_attribute WHERE attrelid = %s AND attnum = %s",
+                            (tableOid, attnum))
+                row = cur.fetchone()
+                columns.append(row[0] if row is not None else None)
+            indexes.append((name, isUnique, columns))
+        del cur
+        return indexes
+
 
 class PgsqlIngestConfig(IngestConfig):
     register = ConfigurableField(target=PgsqlRegisterTask, doc="Registry entry")
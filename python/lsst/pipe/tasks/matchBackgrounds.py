@@ -55,6 +55,15 @@ class MatchBackgroundsConfig(pexConfig.Config):
             "MEANCLIP": "clipped mean"
         }
     )
+    gridMethod = pexConfig.ChoiceField(
+        dtype=str,
+        doc="How to compute the statistics of the grid bins used to fit and evaluate the model",
+        default="VECTORIZED",
+        allowed={
+            "VECTORIZED": "compute the statistics of a whole row of bins at once with numpy",
+            "PER_BIN": "call afw.math.makeStatistics on each bin",
+        }
+    )
     undersampleStyle = pexConfig.ChoiceField(
         doc="Behaviour if there are too few points in grid for requested interpolation style. "
         "Note: INCREASE_NXNYSAMPLE only allowed for usePolynomial=True.",
@@ -139,6 +148,9 @@ class MatchBackgroundsTask(pipeBase.Task):
     ConfigClass = MatchBackgroundsConfig
     _DefaultName = "matchBackgrounds"
 
+    # Ratio of the standard deviation to the interquartile range of a Gaussian, as used by afw.math
+    _IQ_TO_STDEV = 0.741301109252802
+
     def __init__(self, *args, **kwargs):
         pipeBase.Task.__init__(self, *args, **kwargs)
 
@@ -448,7 +460,11 @@ class MatchBackgroundsTask(pipeBase.Task):
 
         # Need RMS from fit: 2895 will replace this:
         rms = 0.0
-        X, Y, Z, dZ = self._gridImage(diffMI, self.config.binSize, statsFlag)
+        if self.config.usePolynomial:
+            # diffMI has not changed since it was gridded for the fit
+            X, Y, Z, dZ = bgX, bgY, bgZ, bgdZ
+        else:
+            X, Y, Z, dZ = self._gridImage(diffMI, self.config.binSize, statsFlag)
         x0, y0 = diffMI.getXY0()
         modelValueArr = numpy.empty(len(Z))
         for i in range(len(X)):
@@ -537,7 +553,96 @@ class MatchBackgroundsTask(pipeBase.Task):
             plt.clf()
 
     def _gridImage(self, maskedImage, binsize, statsFlag):
-        """Private method to grid an image for debugging"""
+        """Private method to grid an image for debugging
+
+        Dispatches to _gridImageVectorized or _gridImagePerBin according to config.gridMethod;
+        both return the same bins and statistics.
+        """
+        if self.config.gridMethod == "VECTORIZED":
+            return self._gridImageVectorized(maskedImage, binsize, statsFlag)
+        return self._gridImagePerBin(maskedImage, binsize, statsFlag)
+
+    def _gridImageVectorized(self, maskedImage, binsize, statsFlag):
+        """Grid an image with numpy, computing the statistics of a row of bins at a time
+
+        Pixels rejected by self.sctrl (masked by its andMask, or NaN) are set to NaN and each row
+        of bins is reshaped to (number of bins, pixels per bin), so that the number of points,
+        standard deviation and the requested statistic reproduce what afw.math.makeStatistics
+        returns for each bin without a Python-level call per bin.
+        """
+        width, height = maskedImage.getDimensions()
+        x0, y0 = maskedImage.getXY0()
+        image = maskedImage.getImage().getArray()
+        mask = maskedImage.getMask().getArray()
+        andMask = self.sctrl.getAndMask()
+
+        nx = (width + binsize - 1)//binsize
+        xedges = numpy.minimum(numpy.arange(nx + 1)*binsize, width)
+        xCenters = 0.5*(x0 + xedges[:-1] + x0 + xedges[1:])
+
+        bgX = []
+        bgY = []
+        bgZ = []
+        bgdZ = []
+
+        for ymin in range(0, height, binsize):
+            ymax = min(ymin + binsize, height)
+            # Pad the last bin of the row with NaN so that every bin has binsize columns
+            rows = numpy.full((ymax - ymin, nx*binsize), numpy.nan)
+            rows[:, :width] = image[ymin:ymax]
+            rows[:, :width][(mask[ymin:ymax] & andMask) != 0] = numpy.nan
+            values = rows.reshape(ymax - ymin, nx, binsize).transpose(1, 0, 2).reshape(nx, -1)
+
+            npoints = numpy.sum(~numpy.isnan(values), axis=1)
+            good = npoints >= 2
+            if not numpy.any(good):
+                continue
+            values = values[good]
+            npoints = npoints[good]
+
+            stdev = numpy.maximum(numpy.nanstd(values, axis=1, ddof=1), self.config.gridStdevEpsilon)
+            bgX.append(xCenters[good])
+            bgY.append(numpy.full(len(values), 0.5*(y0 + ymin + y0 + ymax)))
+            bgdZ.append(stdev/numpy.sqrt(npoints))
+            bgZ.append(self._binStatistic(values, statsFlag))
+
+        if not bgZ:
+            return numpy.array([]), numpy.array([]), numpy.array([]), numpy.array([])
+        return numpy.hstack(bgX), numpy.hstack(bgY), numpy.hstack(bgZ), numpy.hstack(bgdZ)
+
+    def _binStatistic(self, values, statsFlag):
+        """Compute a statistic of each row of a 2-d array, ignoring NaN
+
+        MEANCLIP follows afw.math: starting from the median and a width of numSigmaClip times the
+        interquartile-range estimate of sigma, each of numIter iterations replaces the center and
+        width with the mean and numSigmaClip times the standard deviation of the pixels within it.
+
+        @param[in] values: array of shape (number of bins, pixels per bin); rejected pixels are NaN
+        @param[in] statsFlag: afw.math.MEAN, afw.math.MEDIAN or afw.math.MEANCLIP
+        @return array of the statistic of each bin
+        """
+        if statsFlag == afwMath.MEAN:
+            return numpy.nanmean(values, axis=1)
+        if statsFlag == afwMath.MEDIAN:
+            return numpy.nanmedian(values, axis=1)
+        if statsFlag != afwMath.MEANCLIP:
+            raise ValueError("Unsupported grid statistic: %s" % (statsFlag,))
+
+        numSigmaClip = self.sctrl.getNumSigmaClip()
+        upperQuartile, center, lowerQuartile = numpy.nanpercentile(values, [75, 50, 25], axis=1)
+        hwidth = numSigmaClip*self._IQ_TO_STDEV*(upperQuartile - lowerQuartile)
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            for _ in range(self.sctrl.getNumIter()):
+                keep = numpy.abs(values - center[:, numpy.newaxis]) <= hwidth[:, numpy.newaxis]
+                clipped = numpy.where(keep, values, numpy.nan)
+                nClipped = numpy.sum(keep, axis=1)
+                center = numpy.nansum(clipped, axis=1)/nClipped
+                variance = numpy.nansum((clipped - center[:, numpy.newaxis])**2, axis=1)/(nClipped - 1)
+                hwidth = numSigmaClip*numpy.sqrt(variance)
+        return center
+
+    def _gridImagePerBin(self, maskedImage, binsize, statsFlag):
+        """Grid an image by calling afw.math.makeStatistics on each bin"""
         width, height = maskedImage.getDimensions()
         x0, y0 = maskedImage.getXY0()
         xedges = numpy.arange(0, width, binsize)
@@ -20,13 +20,19 @@
 # the GNU General Public License along with this program.  If not,
 # see <https://www.lsstcorp.org/LegalNotices/>.
 #
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import time
+
 import numpy
 
 from lsst.coadd.utils.coaddDataIdContainer import ExistingCoaddDataIdContainer
 from lsst.pipe.base import CmdLineTask, Struct, TaskRunner, ArgumentParser, ButlerInitializedTaskRunner
 from lsst.pex.config import Config, Field, ListField, ConfigurableField, RangeField, ConfigField
 from lsst.meas.algorithms import DynamicDetectionTask, SkyObjectsTask
-from lsst.meas.base import SingleFrameMeasurementTask, ApplyApCorrTask, CatalogCalculationTask
+from lsst.meas.base import SingleFrameMeasurementTask, ApplyApCorrTask, CatalogCalculationTask, NoiseReplacer
 from lsst.meas.deblender import SourceDeblendTask
 from lsst.pipe.tasks.coaddBase import getSkyInfo
 from lsst.pipe.tasks.scaleVariance import ScaleVarianceTask
@@ -34,6 +40,7 @@ from lsst.meas.astrom import DirectMatchTask, denormalizeMatches
 from lsst.pipe.tasks.fakes import BaseFakeSourcesTask
 from lsst.pipe.tasks.setPrimaryFlags import SetPrimaryFlagsTask
 from lsst.pipe.tasks.propagateVisitFlags import PropagateVisitFlagsTask
+import lsst.afw.geom as afwGeom
 import lsst.afw.image as afwImage
 import lsst.afw.table as afwTable
 import lsst.afw.math as afwMath
@@ -385,6 +392,9 @@ class MergeSourcesConfig(Config):
     priorityList = ListField(dtype=str, default=[],
                              doc="Priority-ordered list of bands for the merge.")
     coaddName = Field(dtype=str, default="deep", doc="Name of coadd")
+    numReadThreads = RangeField(dtype=int, default=1, min=1,
+                                doc="Maximum number of threads used to read the per-band input catalogs "
+                                "concurrently")
 
     def validate(self):
         Config.validate(self)
@@ -468,10 +478,45 @@ class MergeSourcesTask(CmdLineTask):
 
         @param[in] patchRefList list of data references for each filter
         """
-        catalogs = dict(self.readCatalog(patchRef) for patchRef in patchRefList)
+        catalogs = self.readCatalogs(patchRefList)
         mergedCatalog = self.mergeCatalogs(catalogs, patchRefList[0])
         self.write(patchRefList[0], mergedCatalog)
 
+    def readCatalogs(self, patchRefList):
+        """!
+        @brief Read the input catalogs for all filters.
+
+        The catalogs are read with @ref readCatalog, using up to config.numReadThreads concurrent threads.
+        The wall-clock time spent reading and the total size of the input files are recorded in the
+        task metadata as readTime and readBytes.
+
+        @param[in] patchRefList list of data references for each filter
+        @return dict mapping filter name to catalog
+        """
+        startTime = time.time()
+        numThreads = min(self.config.numReadThreads, len(patchRefList))
+        if numThreads > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=numThreads) as executor:
+                catalogs = dict(executor.map(self.readCatalog, patchRefList))
+        else:
+            catalogs = dict(self.readCatalog(patchRef) for patchRef in patchRefList)
+        readTime = time.time() - startTime
+        readBytes = sum(self.getInputSize(patchRef) for patchRef in patchRefList)
+        self.log.info("Read %d catalogs (%d bytes) in %.2f sec using %d threads" %
+                      (len(catalogs), readBytes, readTime, numThreads))
+        self.metadata.set("readTime", readTime)
+        self.metadata.set("readBytes", readBytes)
+        return catalogs
+
+    def getInputSize(self, patchRef):
+        """!
+        @brief Return the size (bytes) of the input catalog file, or 0 if it is not a local file.
+
+        @param[in]  patchRef   data reference for patch
+        """
+        filenames = patchRef.get(self.config.coaddName + "Coadd_" + self.inputDataset + "_filename")
+        return sum(os.path.getsize(filename) for filename in filenames if os.path.exists(filename))
+
     def readCatalog(self, patchRef):
         """!
         @brief Read input catalog.
@@ -575,6 +620,14 @@ class MergeDetectionsConfig(MergeSourcesConfig):
                           doc="Name of `filter' used to label sky objects (e.g. flag merge_peak_sky is set)\n"
                           "(N.b. should be in MergeMeasurementsConfig.pseudoFilterList)")
     skyObjects = ConfigurableField(target=SkyObjectsTask, doc="Generate sky objects")
+    doBinnedSkyObjects = Field(dtype=bool, default=False,
+                               doc="Place sky objects using a binned occupancy grid built from the merged "
+                               "footprint spans instead of a full-resolution mask? The sky object "
+                               "parameters (nSources, sourceRadius, growMask, ...) are taken from "
+                               "skyObjects.")
+    skyObjectsBinSize = RangeField(dtype=int, default=8, min=1,
+                                   doc="Size (pixels) of the occupancy grid cells used when "
+                                   "doBinnedSkyObjects is set")
 
     def setDefaults(self):
         MergeSourcesConfig.setDefaults(self)
@@ -751,28 +804,51 @@ class MergeDetectionsTask(MergeSourcesTask):
         """!
         @brief Attempt to remove garbage peaks (mostly on the outskirts of large blends).
 
+        The peaks of all footprints are flattened into a single contiguous PeakCatalog so that the
+        per-band detection counts and in-family ranks can be computed as columns; the footprint peak
+        lists are then rebuilt from the resulting selection in a single pass.
+
         @param[in] catalog Source catalog
         """
         keys = [item.key for item in self.merged.getPeakSchema().extract("merge_peak_*").values()]
         assert len(keys) > 0, "Error finding flags that associate peaks with their detection bands."
-        totalPeaks = 0
-        culledPeaks = 0
-        for parentSource in catalog:
-            # Make a list copy so we can clear the attached PeakCatalog and append the ones we're keeping
-            # to it (which is easier than deleting as we iterate).
-            keptPeaks = parentSource.getFootprint().getPeaks()
-            oldPeaks = list(keptPeaks)
-            keptPeaks.clear()
-            familySize = len(oldPeaks)
-            totalPeaks += familySize
-            for rank, peak in enumerate(oldPeaks):
-                if ((rank < self.config.cullPeaks.rankSufficient) or
-                    (sum([peak.get(k) for k in keys]) >= self.config.cullPeaks.nBandsSufficient) or
-                    (rank < self.config.cullPeaks.rankConsidered and
-                     rank < self.config.cullPeaks.rankNormalizedConsidered * familySize)):
-                    keptPeaks.append(peak)
-                else:
-                    culledPeaks += 1
+        footprints = [parentSource.getFootprint() for parentSource in catalog]
+        familySizes = numpy.array([len(footprint.getPeaks()) for footprint in footprints], dtype=int)
+        totalPeaks = int(familySizes.sum())
+        if totalPeaks == 0:
+            self.log.info("Culled 0 of 0 peaks")
+            return
+
+        allPeaks = afwDetect.PeakCatalog(self.merged.getPeakSchema())
+        allPeaks.reserve(totalPeaks)
+        for footprint in footprints:
+            allPeaks.extend(footprint.getPeaks(), deep=True)
+        if not allPeaks.isContiguous():
+            allPeaks = allPeaks.copy(deep=True)
+
+        config = self.config.cullPeaks
+        starts = numpy.cumsum(familySizes) - familySizes
+        rank = numpy.arange(totalPeaks) - numpy.repeat(starts, familySizes)
+        familySize = numpy.repeat(familySizes, familySizes)
+        nBands = numpy.zeros(totalPeaks, dtype=int)
+        for k in keys:
+            nBands += allPeaks[k]
+        keep = ((rank < config.rankSufficient) |
+                (nBands >= config.nBandsSufficient) |
+                ((rank < config.rankConsidered) & (rank < config.rankNormalizedConsidered*familySize)))
+
+        # Only footprints that lose peaks need their (non-contiguous) peak lists rebuilt; the kept
+        # records are the originals, so the peaks that survive are unchanged.
+        for footprint, start, size in zip(footprints, starts, familySizes):
+            keepFamily = keep[start:start + size]
+            if keepFamily.all():
+                continue
+            peaks = footprint.getPeaks()
+            keptPeaks = peaks.subset(keepFamily)
+            peaks.clear()
+            peaks.extend(keptPeaks, deep=False)
+
+        culledPeaks = totalPeaks - int(keep.sum())
         self.log.info("Culled %d of %d peaks" % (culledPeaks, totalPeaks))
 
     def getSchemaCatalogs(self):
@@ -790,10 +866,17 @@ class MergeDetectionsTask(MergeSourcesTask):
         """!
         @brief Return a list of Footprints of sky objects which don't overlap with anything in mergedList
 
+        If config.doBinnedSkyObjects is set the positions are chosen by @ref getBinnedSkySourceFootprints,
+        otherwise the footprints are rendered into a full-resolution mask and handed to the skyObjects
+        subtask.
+
         @param mergedList  The merged Footprints from all the input bands
         @param skyInfo     A description of the patch
         @param seed        Seed for the random number generator
         """
+        if self.config.doBinnedSkyObjects:
+            return self.getBinnedSkySourceFootprints(mergedList, skyInfo, seed)
+
         mask = afwImage.Mask(skyInfo.patchInfo.getOuterBBox())
         detected = mask.getPlaneBitMask("DETECTED")
         for s in mergedList:
@@ -817,6 +900,104 @@ class MergeDetectionsTask(MergeSourcesTask):
 
         return converted
 
+    def getBinnedSkySourceFootprints(self, mergedList, skyInfo, seed):
+        """!
+        @brief Return a list of sky object Footprints placed using a binned occupancy grid
+
+        Each cell of the grid (config.skyObjectsBinSize pixels on a side) is marked as occupied if any
+        span of a merged Footprint touches it; the grid is then dilated by enough cells to cover the
+        sky object radius plus skyObjects.growMask. A trial position is accepted only if its cell is
+        free in the dilated grid and it does not overlap a previously accepted sky object, so the sky
+        objects avoid the detections at least as strictly as the full-resolution placement does.
+        Trial positions are drawn in the same way as by the skyObjects subtask.
+
+        @param mergedList  The merged Footprints from all the input bands
+        @param skyInfo     A description of the patch
+        @param seed        Seed for the random number generator
+        """
+        skyConfig = self.config.skyObjects
+        binSize = self.config.skyObjectsBinSize
+        radius = int(skyConfig.sourceRadius)
+        nSources = skyConfig.nSources
+        nTrials = skyConfig.nTrialSources
+        if nTrials is None:
+            nTrials = nSources*skyConfig.nTrialSourcesMultiplier
+
+        outerBBox = skyInfo.patchInfo.getOuterBBox()
+        x0, y0 = outerBBox.getMinX(), outerBBox.getMinY()
+        occupied = self.makeOccupancyGrid(mergedList, outerBBox, binSize)
+        nGrow = int(numpy.ceil((radius + skyConfig.growMask)/binSize))
+        blocked = _dilateGrid(occupied, nGrow)
+
+        bbox = afwGeom.Box2I(outerBBox)
+        bbox.grow(-radius)
+        rng = afwMath.Random(seed=seed)
+        schema = self.merged.getPeakSchema()
+        mergeKey = schema.find("merge_peak_%s" % self.config.skyFilterName).key
+        minSeparation2 = (2*radius + 1)**2
+        centers = numpy.empty((0, 2), dtype=int)
+        footprints = []
+        for _ in range(nTrials):
+            if len(footprints) == nSources:
+                break
+            x = int(rng.flat(bbox.getMinX(), bbox.getMaxX()))
+            y = int(rng.flat(bbox.getMinY(), bbox.getMaxY()))
+            if blocked[(y - y0)//binSize, (x - x0)//binSize]:
+                continue
+            if len(centers) > 0 and (((centers - (x, y))**2).sum(axis=1) < minSeparation2).any():
+                continue
+            footprint = afwDetect.Footprint(afwGeom.SpanSet.fromShape(radius, offset=(x, y)), schema)
+            footprint.addPeak(x, y, 0)
+            footprint.getPeaks()[0].set(mergeKey, True)
+            footprints.append(footprint)
+            centers = numpy.vstack((centers, (x, y)))
+
+        self.log.info("Added %d of %d requested sky sources (%d%% of %dx%d cells blocked)" %
+                      (len(footprints), nSources, round(100*blocked.mean()), blocked.shape[1],
+                       blocked.shape[0]))
+        return footprints
+
+    @staticmethod
+    def makeOccupancyGrid(mergedList, bbox, binSize):
+        """!
+        @brief Return a boolean grid of binSize x binSize cells that are touched by any Footprint
+
+        The grid is built directly from the span sets of the Footprints, without rasterizing them.
+
+        @param mergedList  Catalog of sources with Footprints
+        @param bbox        Bounding box (lsst.afw.geom.Box2I) covered by the grid
+        @param binSize     Size of a grid cell (pixels)
+        @return numpy bool array of shape (ny, nx), indexed by (y - bbox.getMinY())//binSize, etc.
+        """
+        nx = (bbox.getWidth() + binSize - 1)//binSize
+        ny = (bbox.getHeight() + binSize - 1)//binSize
+        spans = numpy.array([(span.getY(), span.getMinX(), span.getMaxX()) for s in mergedList
+                             for span in s.getFootprint().spans], dtype=int).reshape(-1, 3)
+        y = spans[:, 0] - bbox.getMinY()
+        xMin = numpy.maximum(spans[:, 1] - bbox.getMinX(), 0)
+        xMax = numpy.minimum(spans[:, 2] - bbox.getMinX(), bbox.getWidth() - 1)
+        good = (y >= 0) & (y < bbox.getHeight()) & (xMin <= xMax)
+        rows = y[good]//binSize
+        # Mark each span as a +1/-1 pair in a row-wise difference array; a cumulative sum along the rows
+        # then counts the spans covering each cell.
+        counts = numpy.zeros((ny, nx + 1), dtype=int)
+        numpy.add.at(counts, (rows, xMin[good]//binSize), 1)
+        numpy.add.at(counts, (rows, xMax[good]//binSize + 1), -1)
+        return counts.cumsum(axis=1)[:, :nx] > 0
+
+
+def _dilateGrid(grid, nGrow):
+    """Return a copy of a boolean grid with each True cell grown by nGrow cells in every direction
+
+    The dilation (by a square of side 2*nGrow + 1) is computed with a summed-area table.
+    """
+    if nGrow <= 0:
+        return grid.copy()
+    size = 2*nGrow + 1
+    table = numpy.pad(grid.astype(int), nGrow, mode="constant").cumsum(axis=0).cumsum(axis=1)
+    table = numpy.pad(table, ((1, 0), (1, 0)), mode="constant")
+    return (table[size:, size:] - table[:-size, size:] - table[size:, :-size] + table[:-size, :-size]) > 0
+
 
 class MeasureMergedCoaddSourcesConfig(Config):
     """!
@@ -827,6 +1008,27 @@ class MeasureMergedCoaddSourcesConfig(Config):
     doDeblend = Field(dtype=bool, default=True, doc="Deblend sources?")
     deblend = ConfigurableField(target=SourceDeblendTask, doc="Deblend sources")
     measurement = ConfigurableField(target=SingleFrameMeasurementTask, doc="Source measurement")
+    measurementProcesses = RangeField(dtype=int, default=1, min=1,
+                                      doc="Number of worker processes used to measure independent parent "
+                                      "groups (a parent and its deblended children) concurrently; "
+                                      "1 measures the whole catalog serially")
+    measurementChunksPerProcess = RangeField(dtype=int, default=4, min=1,
+                                             doc="Number of chunks of parent groups handed to each worker "
+                                             "process when measurementProcesses > 1")
+    doAdaptivePsfCache = Field(dtype=bool, default=False,
+                               doc="Size the CoaddPsf cache from the number of coadd inputs and sources, "
+                               "using the psfCache argument as a lower bound?")
+    psfCachePerInput = Field(dtype=float, default=1.0,
+                             doc="CoaddPsf cache entries per coadd input, if doAdaptivePsfCache")
+    psfCachePerSource = Field(dtype=float, default=0.05,
+                              doc="CoaddPsf cache entries per peak to be deblended and measured, "
+                              "if doAdaptivePsfCache")
+    psfCacheMax = RangeField(dtype=int, default=5000, min=1,
+                             doc="Maximum size of the CoaddPsf cache, if doAdaptivePsfCache")
+    doPsfEvaluationStats = Field(dtype=bool, default=False,
+                                 doc="Time and count the PSF evaluations made while deblending, and the "
+                                 "hits and misses they would incur in a modelled LRU cache, recording them "
+                                 "in the task metadata?")
     setPrimaryFlags = ConfigurableField(target=SetPrimaryFlagsTask, doc="Set flags for primary tract/patch")
     doPropagateFlags = Field(
         dtype=bool, default=True,
@@ -1064,16 +1266,20 @@ class MeasureMergedCoaddSourcesTask(CmdLineTask):
         @brief Deblend and measure.
 
         @param[in] patchRef: Patch reference.
+        @param[in] psfCache: Size of CoaddPsf cache (the minimum size, if config.doAdaptivePsfCache).
 
         Deblend each source in every coadd and measure. Set 'is-primary' and related flags. Propagate flags
         from individual visits. Optionally match the sources to a reference catalog and write the matches.
         Finally, write the deblended sources and measurements out.
         """
         exposure = patchRef.get(self.config.coaddName + "Coadd_calexp", immediate=True)
-        exposure.getPsf().setCacheCapacity(psfCache)
         sources = self.readSources(patchRef)
+        capacity = self.setupPsfCache(exposure, sources, psfCache)
         if self.config.doDeblend:
-            self.deblend.run(exposure, sources)
+            if self.config.doPsfEvaluationStats:
+                self.deblendWithPsfStats(exposure, sources, capacity)
+            else:
+                self.deblend.run(exposure, sources)
 
             bigKey = sources.schema["deblend_parentTooBig"].asKey()
             # catalog is non-contiguous so can't extract column
@@ -1085,7 +1291,11 @@ class MeasureMergedCoaddSourcesTask(CmdLineTask):
         table = sources.getTable()
         table.setMetadata(self.algMetadata)  # Capture algorithm metadata to write out to the source catalog.
 
-        self.measurement.run(sources, exposure, exposureId=self.getExposureId(patchRef))
+        exposureId = self.getExposureId(patchRef)
+        if self.config.measurementProcesses > 1:
+            self.runParallelMeasurement(sources, exposure, exposureId)
+        else:
+            self.measurement.run(sources, exposure, exposureId=exposureId)
 
         if self.config.doApCorr:
             self.applyApCorr.run(
@@ -1106,6 +1316,130 @@ class MeasureMergedCoaddSourcesTask(CmdLineTask):
             self.writeMatches(patchRef, exposure, sources)
         self.write(patchRef, sources)
 
+    def setupPsfCache(self, exposure, sources, psfCache):
+        """!
+        @brief Set the capacity of the coadd PSF cache.
+
+        If config.doAdaptivePsfCache is set, the capacity scales with the number of coadd inputs
+        (psfCachePerInput) and the number of peaks that will be deblended and measured
+        (psfCachePerSource), bounded below by psfCache and above by config.psfCacheMax. Otherwise the
+        capacity is psfCache. The capacity is recorded in the task metadata as psfCacheCapacity.
+
+        @param[in] exposure  Coadd exposure, whose PSF cache is set
+        @param[in] sources   Catalog of merged detections to be measured
+        @param[in] psfCache  Requested cache capacity (the lower bound, if doAdaptivePsfCache)
+        @return cache capacity
+        """
+        capacity = psfCache
+        if self.config.doAdaptivePsfCache:
+            coaddInputs = exposure.getInfo().getCoaddInputs()
+            numInputs = len(coaddInputs.ccds) if coaddInputs is not None else 0
+            numPeaks = sum(len(source.getFootprint().getPeaks()) for source in sources)
+            capacity = int(self.config.psfCachePerInput*numInputs + self.config.psfCachePerSource*numPeaks)
+            capacity = min(max(capacity, psfCache), self.config.psfCacheMax)
+            self.log.info("Setting PSF cache capacity to %d for %d inputs and %d peaks" %
+                          (capacity, numInputs, numPeaks))
+            self.metadata.set("psfCacheInputs", numInputs)
+            self.metadata.set("psfCachePeaks", numPeaks)
+        exposure.getPsf().setCacheCapacity(capacity)
+        self.metadata.set("psfCacheCapacity", capacity)
+        return capacity
+
+    def deblendWithPsfStats(self, exposure, sources, capacity):
+        """!
+        @brief Deblend, timing and counting the PSF evaluations.
+
+        The deblender is given a PsfEvaluationRecorder wrapping the exposure's PSF. The number of
+        evaluations and the time spent in them are recorded in the task metadata as psfDeblendEvalCount
+        and psfDeblendEvalTime. The hits and misses that those evaluations would incur in an LRU cache of
+        the given capacity are recorded as psfDeblendModelCacheHits and psfDeblendModelCacheMisses; these
+        come from a model of the cache, not from afw's PSF cache itself.
+
+        Measurement plugins evaluate the PSF in C++ through the exposure, where the wrapper can't see them,
+        so only the deblender's evaluations are recorded.
+
+        @param[in]     exposure  Exposure to deblend
+        @param[in,out] sources   Catalog of sources to deblend
+        @param[in]     capacity  Capacity of the PSF cache
+        """
+        recorder = PsfEvaluationRecorder(exposure.getPsf(), capacity)
+        self.deblend.deblend(exposure, sources, recorder)
+        self.log.info("Deblending made %d PSF evaluations (%d modelled cache hits, %d misses) in %.3f sec" %
+                      (recorder.count, recorder.hits, recorder.count - recorder.hits, recorder.time))
+        self.metadata.set("psfDeblendEvalCount", recorder.count)
+        self.metadata.set("psfDeblendEvalTime", recorder.time)
+        self.metadata.set("psfDeblendModelCacheHits", recorder.hits)
+        self.metadata.set("psfDeblendModelCacheMisses", recorder.count - recorder.hits)
+
+    def runParallelMeasurement(self, sources, exposure, exposureId):
+        """!
+        @brief Measure sources with parent groups distributed over worker processes.
+
+        The catalog is partitioned into groups of a parent and its deblended children, which are
+        independent measurement units. The groups are measured in config.measurementProcesses forked
+        worker processes that share the exposure and catalog read-only; each worker replaces all the
+        sources with noise using the same exposureId-seeded NoiseReplacer as a serial measurement, so the
+        noise is the same regardless of which worker measures a parent. The measured records are copied
+        back into the input catalog in place, so its order is unchanged. As in a serial measurement, the
+        blendedness child pixels are then measured over the whole catalog on the unmodified exposure.
+
+        Falls back to a serial measurement if undeblended plugins are configured, as those need the
+        whole catalog at once.
+
+        @param[in,out] sources     Catalog of sources to measure
+        @param[in]     exposure    Exposure on which to measure
+        @param[in]     exposureId  Exposure identifier, used to seed the noise replacement
+        """
+        if getattr(self.measurement, "undeblendedPlugins", None):
+            self.log.warn("Undeblended measurement plugins configured; measuring serially")
+            self.measurement.run(sources, exposure, exposureId=exposureId)
+            return
+
+        # Chunks of parent groups, balanced by the number of records
+        parents = sources.getChildren(0)
+        nProcesses = self.config.measurementProcesses
+        nChunks = min(len(parents), nProcesses*self.config.measurementChunksPerProcess)
+        if nChunks == 0:
+            return
+        parentIndex = {parent.getId(): i for i, parent in enumerate(parents)}
+        groupSizes = numpy.zeros(len(parents), dtype=int)
+        for record in sources:
+            groupSizes[parentIndex[record.getParent() or record.getId()]] += 1
+        chunkIndex = (numpy.cumsum(groupSizes) - groupSizes)*nChunks//len(sources)
+        chunks = [numpy.flatnonzero(chunkIndex == n).tolist() for n in range(nChunks)]
+
+        self.log.info("Measuring %d sources (%d parents) in %d chunks with %d processes" %
+                      (len(sources), len(parents), nChunks, nProcesses))
+        global _parallelMeasurementState
+        _parallelMeasurementState = Struct(measurement=self.measurement, exposure=exposure, sources=sources,
+                                           parents=parents, exposureId=exposureId, noiseReplacer=None)
+        try:
+            pool = multiprocessing.get_context("fork").Pool(nProcesses, initializer=_initMeasurementWorker)
+            try:
+                recordIndex = {record.getId(): i for i, record in enumerate(sources)}
+                for measured in pool.imap_unordered(_measureParentGroups, chunks):
+                    for record in measured:
+                        sources[recordIndex[record.getId()]].assign(record)
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            _parallelMeasurementState = None
+
+        if getattr(self.measurement, "doBlendedness", False):
+            for source in sources:
+                self.measurement.blendPlugin.cpp.measureChildPixels(exposure.getMaskedImage(), source)
+
+        # Record the noise replacement parameters, as the serial measurement does
+        algMetadata = sources.getMetadata()
+        if self.measurement.config.doReplaceWithNoise and algMetadata is not None:
+            noiseConfig = self.measurement.config.noiseReplacer
+            algMetadata.addInt("NOISE_SEED_MULTIPLIER", noiseConfig.noiseSeedMultiplier)
+            algMetadata.addString("NOISE_SOURCE", noiseConfig.noiseSource)
+            algMetadata.addDouble("NOISE_OFFSET", noiseConfig.noiseOffset)
+            if exposureId is not None:
+                algMetadata.addLong("NOISE_EXPOSURE_ID", exposureId)
+
     def readSources(self, dataRef):
         """!
         @brief Read input sources.
@@ -1159,6 +1493,116 @@ class MeasureMergedCoaddSourcesTask(CmdLineTask):
         return int(dataRef.get(self.config.coaddName + "CoaddId"))
 
 
+class PsfEvaluationRecorder:
+    """Wrap a Psf, timing and counting its image evaluations
+
+    Each computeImage and computeKernelImage call is also passed through a model of the Psf's caches
+    (least-recently-used caches of the same capacity, keyed on the exact position) to count the calls
+    that are cache hits. All other attributes are those of the wrapped Psf.
+    """
+
+    def __init__(self, psf, capacity):
+        """Construct a PsfEvaluationRecorder
+
+        @param[in] psf       Psf to wrap
+        @param[in] capacity  Capacity of the Psf's caches
+        """
+        self.psf = psf
+        self.capacity = capacity
+        self.count = 0
+        self.hits = 0
+        self.time = 0.0
+        self._cache = collections.OrderedDict()
+
+    def __getattr__(self, name):
+        return getattr(self.psf, name)
+
+    def computeImage(self, *args, **kwargs):
+        return self._evaluate("computeImage", args, kwargs)
+
+    def computeKernelImage(self, *args, **kwargs):
+        return self._evaluate("computeKernelImage", args, kwargs)
+
+    def _evaluate(self, methodName, args, kwargs):
+        """Call a Psf method, recording the time taken and whether it would be a cache hit"""
+        key = (methodName,) + self._getPosition(args, kwargs)
+        if key in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        else:
+            self._cache[key] = None
+            if len(self._cache) > self.capacity:
+                self._cache.popitem(last=False)
+        self.count += 1
+        startTime = time.time()
+        try:
+            return getattr(self.psf, methodName)(*args, **kwargs)
+        finally:
+            self.time += time.time() - startTime
+
+    def _getPosition(self, args, kwargs):
+        """Return the position of an evaluation as a tuple, which is empty for the average position"""
+        position = kwargs.get("position", args[0] if args else None)
+        if position is None:
+            return ()
+        if hasattr(position, "getX"):
+            return (position.getX(), position.getY())
+        return (position, kwargs.get("y", args[1] if len(args) > 1 else None))
+
+
+# Measurement state shared with forked measurement worker processes
+_parallelMeasurementState = None
+
+
+def _initMeasurementWorker():
+    """Replace all the sources with noise in a newly-forked measurement worker process
+
+    The NoiseReplacer is seeded from the exposure ID exactly as in a serial measurement, so every worker
+    (and hence every parent group) sees the same noise realization.
+    """
+    state = _parallelMeasurementState
+    if state.measurement.config.doReplaceWithNoise:
+        footprints = {record.getId(): (record.getParent(), record.getFootprint())
+                      for record in state.sources}
+        state.noiseReplacer = NoiseReplacer(state.measurement.config.noiseReplacer, state.exposure,
+                                            footprints, log=state.measurement.log,
+                                            exposureId=state.exposureId)
+
+
+def _measureParentGroups(parentIndices):
+    """Measure a chunk of parents and their children in a measurement worker process
+
+    This follows the per-parent loop of SingleFrameMeasurementTask.run, but only for the requested
+    parent groups; the whole-catalog blendedness pass is left to runParallelMeasurement.
+
+    @param parentIndices  Indices of the parents to measure in the catalog of parents
+    @return SourceCatalog of the measured parents and children
+    """
+    state = _parallelMeasurementState
+    measurement, exposure, noiseReplacer = state.measurement, state.exposure, state.noiseReplacer
+    measured = afwTable.SourceCatalog(state.sources.getTable())
+    for index in parentIndices:
+        parentCat = state.parents[index:index + 1]
+        parent = parentCat[0]
+        children = state.sources.getChildren(parent.getId())
+        for child in children:
+            if noiseReplacer is not None:
+                noiseReplacer.insertSource(child.getId())
+            measurement.callMeasure(child, exposure)
+            if noiseReplacer is not None:
+                noiseReplacer.removeSource(child.getId())
+        if noiseReplacer is not None:
+            noiseReplacer.insertSource(parent.getId())
+        measurement.callMeasure(parent, exposure)
+        measurement.callMeasureN(parentCat, exposure)
+        measurement.callMeasureN(children, exposure)
+        if noiseReplacer is not None:
+            noiseReplacer.removeSource(parent.getId())
+        measured.append(parent)
+        measured.extend(children)
+    return measured
+
+
 class MergeMeasurementsConfig(MergeSourcesConfig):
     """!
     @anchor MergeMeasurementsConfig_
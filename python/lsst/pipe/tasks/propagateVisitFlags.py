@@ -20,6 +20,8 @@
 # the GNU General Public License along with this program.  If not,
 # see <http://www.lsstcorp.org/LegalNotices/>.
 #
+from collections import OrderedDict
+
 import numpy
 from lsst.pex.config import Config, Field, DictField
 from lsst.pipe.base import Task
@@ -33,6 +35,106 @@ class PropagateVisitFlagsConfig(Config):
                       default={"calib_psfCandidate": 0.2, "calib_psfUsed": 0.2, },
                       doc="Source catalog flags to propagate, with the threshold of relative occurrence.")
     matchRadius = Field(dtype=float, default=0.2, doc="Source matching radius (arcsec)")
+    doProjectedRead = Field(dtype=bool, default=False,
+                            doc="Read the input source catalogs without footprints, and keep only the "
+                            "coordinates and propagated flags of the sources with any of those flags set?")
+    edgeSubdivisions = Field(dtype=int, default=10,
+                             doc="Number of segments into which each edge of an input's bounding box and "
+                             "valid polygon is divided when it is transformed into coadd pixels for "
+                             "counting the inputs overlapping each source")
+    edgeMargin = Field(dtype=float, default=1.0,
+                       doc="Distance (coadd pixels) from the approximate boundary of an input within which "
+                       "sources are tested exactly for overlap with the input")
+    ccdCacheSize = Field(dtype=int, default=0,
+                         doc="Number of projected input catalogs to keep in memory for subsequent patches "
+                         "(only used with doProjectedRead)")
+
+
+def countInputOverlaps(ccdInputs, coaddWcs, x, y, includeValidPolygon=True, edgeSubdivisions=10,
+                       edgeMargin=1.0):
+    """!Count the inputs overlapping each of a set of coadd pixel positions
+
+    This is a bulk equivalent of len(ccdInputs.subsetContaining(point, coaddWcs, includeValidPolygon))
+    for each point.  Rather than transforming every point into the pixel frame of every input, the
+    bounding box (and, optionally, the valid polygon) of each input is transformed once into coadd pixels,
+    with each edge divided into edgeSubdivisions segments to follow any distortion, and the points are
+    tested against the resulting polygons with array operations.  Because the transformed polygons only
+    approximate the boundaries of the inputs, points within edgeMargin coadd pixels of a polygon edge are
+    tested exactly with ExposureRecord.contains, so the results are the same as for subsetContaining
+    provided the approximation is good to edgeMargin.
+
+    @param[in] ccdInputs  Table of CCDs that contribute to the coadd (lsst.afw.table.ExposureCatalog)
+    @param[in] coaddWcs  Wcs for coadd
+    @param[in] x  Array of coadd x pixel positions
+    @param[in] y  Array of coadd y pixel positions
+    @param[in] includeValidPolygon  Require points to be within the valid polygon of an input, if it has one?
+    @param[in] edgeSubdivisions  Number of segments per polygon edge
+    @param[in] edgeMargin  Distance (coadd pixels) from a polygon edge within which points are tested exactly
+    @return numpy array of the number of overlapping inputs for each position
+    """
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    counts = numpy.zeros(len(x), dtype=int)
+    for ccdRecord in ccdInputs:
+        ccdWcs = ccdRecord.getWcs()
+        polygons = [afwGeom.Box2D(ccdRecord.getBBox()).getCorners()]
+        validPolygon = ccdRecord.getValidPolygon()
+        if includeValidPolygon and validPolygon is not None:
+            polygons.append(validPolygon.getVertices())
+        contained = numpy.ones(len(x), dtype=bool)
+        nearEdge = numpy.zeros(len(x), dtype=bool)
+        for vertices in polygons:
+            ccdPoints = _subdivideRing(numpy.array([tuple(v) for v in vertices], dtype=float),
+                                       edgeSubdivisions)
+            coaddPoints = coaddWcs.skyToPixel(ccdWcs.pixelToSky([afwGeom.Point2D(*p) for p in ccdPoints]))
+            ring = numpy.array([tuple(p) for p in coaddPoints], dtype=float)
+            candidates = numpy.flatnonzero((contained | nearEdge) &
+                                           (x >= ring[:, 0].min() - edgeMargin) &
+                                           (x <= ring[:, 0].max() + edgeMargin) &
+                                           (y >= ring[:, 1].min() - edgeMargin) &
+                                           (y <= ring[:, 1].max() + edgeMargin))
+            nearEdge[candidates] |= _pointsNearRing(x[candidates], y[candidates], ring, edgeMargin)
+            inside = numpy.zeros(len(x), dtype=bool)
+            inside[candidates] = _pointsInRing(x[candidates], y[candidates], ring)
+            contained &= inside
+        for index in numpy.flatnonzero(nearEdge):
+            contained[index] = ccdRecord.contains(afwGeom.Point2D(x[index], y[index]), coaddWcs,
+                                                  includeValidPolygon)
+        counts += contained
+    return counts
+
+
+def _subdivideRing(vertices, numSubdivisions):
+    """Return the vertices of a closed ring with each edge divided into numSubdivisions segments"""
+    numSubdivisions = max(int(numSubdivisions), 1)
+    ends = numpy.roll(vertices, -1, axis=0)
+    steps = numpy.arange(numSubdivisions, dtype=float)/numSubdivisions
+    offsets = steps[numpy.newaxis, :, numpy.newaxis]*(ends - vertices)[:, numpy.newaxis, :]
+    return (vertices[:, numpy.newaxis, :] + offsets).reshape(-1, 2)
+
+
+def _pointsNearRing(x, y, ring, margin):
+    """Return whether each point is within margin of any edge of a closed ring of vertices"""
+    near = numpy.zeros(len(x), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(ring, numpy.roll(ring, -1, axis=0)):
+        dx, dy = x2 - x1, y2 - y1
+        lengthSq = dx*dx + dy*dy
+        # Fractional position along the edge of the closest point on it
+        t = numpy.clip(((x - x1)*dx + (y - y1)*dy)/lengthSq, 0.0, 1.0) if lengthSq > 0 else 0.0
+        near |= (x - x1 - t*dx)**2 + (y - y1 - t*dy)**2 <= margin**2
+    return near
+
+
+def _pointsInRing(x, y, ring):
+    """Return whether each point is inside a closed ring of vertices, using the even-odd rule"""
+    inside = numpy.zeros(len(x), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(ring, numpy.roll(ring, -1, axis=0)):
+        crosses = (y1 > y) != (y2 > y)
+        if not crosses.any():
+            continue
+        xCross = x1 + (y[crosses] - y1)*(x2 - x1)/(y2 - y1)
+        inside[crosses] ^= x[crosses] < xCross
+    return inside
 
 
 ## \addtogroup LSST_task_documentation
@@ -129,6 +231,7 @@ task.run(butler, coaddCatalog, ccdInputs, coaddExposure.getWcs())
         self.schema = schema
         self._keys = dict((f, self.schema.addField(f, type="Flag", doc="Propagated from visits")) for
                           f in self.config.flags)
+        self._ccdCache = OrderedDict()
 
     @staticmethod
     def getCcdInputs(coaddExposure):
@@ -164,39 +267,95 @@ task.run(butler, coaddCatalog, ccdInputs, coaddExposure.getWcs())
         if len(self.config.flags) == 0:
             return
 
-        flags = self._keys.keys()
+        flags = list(self._keys.keys())
         visitKey = ccdInputs.schema.find("visit").key
         ccdKey = ccdInputs.schema.find("ccd").key
         radius = self.config.matchRadius*afwGeom.arcseconds
 
         self.log.info("Propagating flags %s from inputs" % (flags,))
 
-        counts = dict((f, numpy.zeros(len(coaddSources), dtype=int)) for f in flags)
+        counts = numpy.zeros((len(flags), len(coaddSources)), dtype=int)
         indices = numpy.array([s.getId() for s in coaddSources])  # Allowing for non-contiguous data
+        indexSorter = numpy.argsort(indices)
 
         # Accumulate counts of flags being set
+        mc = afwTable.MatchControl()
+        mc.findOnlyClosest = False
         for ccdRecord in ccdInputs:
             v = ccdRecord.get(visitKey)
             c = ccdRecord.get(ccdKey)
-            ccdSources = butler.get("src", visit=int(v), ccd=int(c), immediate=True)
-            for sourceRecord in ccdSources:
-                sourceRecord.updateCoord(ccdRecord.getWcs())
-            for flag in flags:
-                # We assume that the flags will be relatively rare, so it is more efficient to match
-                # against a subset of the input catalog for each flag than it is to match once against
-                # the entire catalog.  It would be best to have built a kd-tree on coaddSources and
-                # keep reusing that for the matching, but we don't have a suitable implementation.
-                mc = afwTable.MatchControl()
-                mc.findOnlyClosest = False
-                matches = afwTable.matchRaDec(coaddSources, ccdSources[ccdSources.get(flag)], radius, mc)
-                for m in matches:
-                    index = (numpy.where(indices == m.first.getId()))[0][0]
-                    counts[flag][index] += 1
+            if self.config.doProjectedRead:
+                ccdSources = self.readProjectedSources(butler, int(v), int(c), ccdRecord.getWcs(), flags)
+            else:
+                ccdSources = butler.get("src", visit=int(v), ccd=int(c), immediate=True)
+                for sourceRecord in ccdSources:
+                    sourceRecord.updateCoord(ccdRecord.getWcs())
+            # We assume that the flags will be relatively rare, so we match once against the subset of the
+            # input catalog with any of the flags set, and then count each flag over the matched pairs.
+            ccdFlags = numpy.array([ccdSources.get(f) for f in flags], dtype=int)
+            flagged = ccdFlags.any(axis=0)
+            if not flagged.any():
+                continue
+            matches = afwTable.matchRaDec(coaddSources, ccdSources[flagged], radius, mc)
+            if len(matches) == 0:
+                continue
+            packed = afwTable.packMatches(matches)
+            coaddIndex = indexSorter[numpy.searchsorted(indices, packed["first"], sorter=indexSorter)]
+            ccdIds = ccdSources.get("id")
+            ccdSorter = numpy.argsort(ccdIds)
+            ccdIndex = ccdSorter[numpy.searchsorted(ccdIds, packed["second"], sorter=ccdSorter)]
+            numpy.add.at(counts, (slice(None), coaddIndex), ccdFlags[:, ccdIndex])
 
         # Apply threshold
-        for f in flags:
+        centroids = numpy.array([tuple(s.getCentroid()) for s in coaddSources], dtype=float).reshape(-1, 2)
+        numOverlaps = countInputOverlaps(ccdInputs, coaddWcs, centroids[:, 0], centroids[:, 1],
+                                         includeValidPolygon=True,
+                                         edgeSubdivisions=self.config.edgeSubdivisions,
+                                         edgeMargin=self.config.edgeMargin)
+        for f, flagCounts in zip(flags, counts):
             key = self._keys[f]
-            for s, num in zip(coaddSources, counts[f]):
-                numOverlaps = len(ccdInputs.subsetContaining(s.getCentroid(), coaddWcs, True))
-                s.setFlag(key, bool(num > numOverlaps*self.config.flags[f]))
-            self.log.info("Propagated %d sources with flag %s" % (sum(s.get(key) for s in coaddSources), f))
+            values = flagCounts > numOverlaps*self.config.flags[f]
+            for s, value in zip(coaddSources, values):
+                s.setFlag(key, bool(value))
+            self.log.info("Propagated %d sources with flag %s" % (values.sum(), f))
+
+    def readProjectedSources(self, butler, visit, ccd, wcs, flags):
+        """!Read the flagged sources of an input catalog, with only their coordinates and flags
+
+        The catalog is read without footprints, and only the sources with any of the flags set are kept.
+        Their coordinates are computed in bulk from the centroids using the supplied Wcs, and the catalog
+        is projected onto the minimal source schema plus the flag columns.  Up to config.ccdCacheSize
+        projected catalogs are cached, so that patches sharing input CCDs do not re-read them.
+
+        @param[in] butler  Data butler, for retrieving the input source catalog
+        @param[in] visit  Visit identifier
+        @param[in] ccd  CCD identifier
+        @param[in] wcs  Wcs of the CCD, used to compute the source coordinates
+        @param[in] flags  Names of the flags to propagate
+        @return projected source catalog
+        """
+        cacheKey = (visit, ccd)
+        if cacheKey in self._ccdCache:
+            self._ccdCache.move_to_end(cacheKey)
+            return self._ccdCache[cacheKey]
+
+        ccdSources = butler.get("src", visit=visit, ccd=ccd, immediate=True,
+                                flags=afwTable.SOURCE_IO_NO_FOOTPRINTS)
+        flagged = numpy.array([ccdSources.get(f) for f in flags]).any(axis=0)
+        subset = ccdSources[flagged]
+        afwTable.updateSourceCoords(wcs, subset)
+
+        mapper = afwTable.SchemaMapper(ccdSources.schema)
+        mapper.addMinimalSchema(afwTable.SourceTable.makeMinimalSchema(), True)
+        for f in flags:
+            mapper.addMapping(ccdSources.schema.find(f).key)
+        projected = afwTable.SourceCatalog(mapper.getOutputSchema())
+        projected.extend(subset, mapper=mapper)
+        if not projected.isContiguous():
+            projected = projected.copy(deep=True)
+
+        if self.config.ccdCacheSize > 0:
+            self._ccdCache[cacheKey] = projected
+            while len(self._ccdCache) > self.config.ccdCacheSize:
+                self._ccdCache.popitem(last=False)
+        return projected
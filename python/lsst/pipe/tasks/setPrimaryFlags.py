@@ -23,7 +23,8 @@
 import numpy
 from lsst.pex.config import Config, Field, ListField
 from lsst.pipe.base import Task
-from lsst.afw.geom import Box2D
+from lsst.afw.geom import Box2D, SpherePoint, radians
+from lsst.skymap import BaseSkyMap
 
 
 class SetPrimaryFlagsConfig(Config):
@@ -87,29 +88,89 @@ class SetPrimaryFlagsTask(Task):
             except Exception:
                 self.log.warn("merge_peak is not set for pseudo-filter %s" % filt)
 
-        tractId = tractInfo.getId()
-        for source in sources:
-            centroidPos = source.getCentroid()
-            if numpy.any(numpy.isnan(centroidPos)):
+        # Gather the per-source quantities into arrays; the catalog may not be contiguous
+        values = numpy.array([tuple(source.getCentroid()) +
+                              (source.getCentroidFlag(),
+                               source.getCoord().getRa().asRadians(),
+                               source.getCoord().getDec().asRadians(),
+                               nChildKey is None or source.get(nChildKey) == 0,
+                               any(source.get(key) for key in pseudoFilterKeys))
+                              for source in sources], dtype=float).reshape(-1, 7)
+        x, y, centroidFlag, ra, dec, noChildren, isPseudo = values.T
+        # As for afw's Box2D.contains, infinite centroids are outside the patch, but still flagged
+        good = ~numpy.isnan(x) & ~numpy.isnan(y)
+
+        # Use a slightly smaller box to guard against bad centroids (see above)
+        isPatchInner = numpy.where(centroidFlag.astype(bool),
+                                   _boxContains(shrunkInnerFloatBBox, x, y),
+                                   _boxContains(innerFloatBBox, x, y))
+        isTractInner = numpy.zeros(len(values), dtype=bool)
+        isTractInner[good] = findTractIds(skyMap, ra[good], dec[good]) == tractInfo.getId()
+        isPrimary = isPatchInner & isTractInner & ~isPseudo.astype(bool)
+        setPrimary = noChildren.astype(bool)
+
+        for source, isGood, patchInner, tractInner, primary, doSetPrimary in zip(
+                sources, good, isPatchInner, isTractInner, isPrimary, setPrimary):
+            if not isGood:
                 continue
-            if source.getCentroidFlag():
-                # Use a slightly smaller box to guard against bad centroids (see above)
-                isPatchInner = shrunkInnerFloatBBox.contains(centroidPos)
-            else:
-                isPatchInner = innerFloatBBox.contains(centroidPos)
-            source.setFlag(self.isPatchInnerKey, isPatchInner)
-
-            skyPos = source.getCoord()
-            sourceInnerTractId = skyMap.findTract(skyPos).getId()
-            isTractInner = sourceInnerTractId == tractId
-            source.setFlag(self.isTractInnerKey, isTractInner)
-
-            if nChildKey is None or source.get(nChildKey) == 0:
-                for pseudoFilterKey in pseudoFilterKeys:
-                    if source.get(pseudoFilterKey):
-                        isPseudo = True
-                        break
-                else:
-                    isPseudo = False
-
-                source.setFlag(self.isPrimaryKey, isPatchInner and isTractInner and not isPseudo)
+            source.setFlag(self.isPatchInnerKey, bool(patchInner))
+            source.setFlag(self.isTractInnerKey, bool(tractInner))
+            if doSetPrimary:
+                source.setFlag(self.isPrimaryKey, bool(primary))
+
+
+def _boxContains(box, x, y):
+    """Vectorized equivalent of lsst.afw.geom.Box2D.contains for arrays of x and y"""
+    return ((x >= box.getMinX()) & (x < box.getMaxX()) &
+            (y >= box.getMinY()) & (y < box.getMaxY()))
+
+
+def findTractIds(skyMap, ra, dec, maxPairs=10000000):
+    """Return the ID of the tract that skyMap.findTract would return for each of a set of positions
+
+    If the sky map uses the default BaseSkyMap.findTract (the tract with the closest center, with ties
+    resolved in favor of the first tract) this is computed as the maximum dot product between the unit
+    vectors of the positions and tract centers; positions for which the two closest tracts are too close
+    to call at floating-point precision (or which are not finite) are passed to findTract individually so
+    that ties are resolved identically.  Sky maps that override findTract are always queried one position
+    at a time.
+
+    @param[in] skyMap   sky tessellation object (subclass of lsst.skymap.BaseSkyMap)
+    @param[in] ra   array of right ascensions (radians)
+    @param[in] dec   array of declinations (radians)
+    @param[in] maxPairs   maximum number of position-tract pairs to evaluate at once
+    @return numpy array of tract IDs
+    """
+    ra = numpy.asarray(ra, dtype=float)
+    dec = numpy.asarray(dec, dtype=float)
+    tractIds = numpy.empty(len(ra), dtype=int)
+    if type(skyMap).findTract is not BaseSkyMap.findTract:
+        for i, (r, d) in enumerate(zip(ra, dec)):
+            tractIds[i] = skyMap.findTract(SpherePoint(r, d, radians)).getId()
+        return tractIds
+
+    tractInfoList = list(skyMap)
+    ids = numpy.array([tractInfo.getId() for tractInfo in tractInfoList], dtype=int)
+    centers = numpy.array([(tractInfo.getCtrCoord().getRa().asRadians(),
+                            tractInfo.getCtrCoord().getDec().asRadians()) for tractInfo in tractInfoList])
+    centerVectors = _unitVectors(centers[:, 0], centers[:, 1])
+    chunkSize = max(1, maxPairs//len(tractInfoList))
+    for start in range(0, len(ra), chunkSize):
+        stop = min(start + chunkSize, len(ra))
+        dots = _unitVectors(ra[start:stop], dec[start:stop]) @ centerVectors.T
+        best = numpy.argmax(dots, axis=1)
+        tractIds[start:stop] = ids[best]
+        if len(tractInfoList) > 1:
+            bestDots = dots[numpy.arange(len(best)), best]
+            dots[numpy.arange(len(best)), best] = -numpy.inf
+            ambiguous = numpy.flatnonzero(~(bestDots - dots.max(axis=1) >= 1.0e-12))  # Including NaN
+            for i in ambiguous:
+                coord = SpherePoint(ra[start + i], dec[start + i], radians)
+                tractIds[start + i] = skyMap.findTract(coord).getId()
+    return tractIds
+
+
+def _unitVectors(ra, dec):
+    """Return an array of shape (N, 3) of the unit vectors for arrays of ra, dec (radians)"""
+    cosDec = numpy.cos(dec)
+    return numpy.stack([cosDec*numpy.cos(ra), cosDec*numpy.sin(ra), numpy.sin(dec)], axis=-1)
@@ -22,6 +22,16 @@
 """
 Tasks for transforming raw measurement outputs to calibrated quantities.
 """
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures.process import BrokenProcessPool
+
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
 import lsst.afw.table as afwTable
 import lsst.pex.config as pexConfig
 import lsst.pipe.base as pipeBase
@@ -149,6 +159,32 @@ class TransformTask(pipeBase.Task):
             transform(inputCat, outputCat, wcs, calib)
         return outputCat
 
+    def runBatch(self, inputs):
+        """!Transform raw source measurements from many catalogs into a single catalog.
+
+        The output catalog is allocated once for the total number of input records, so that it is
+        contiguous in memory as it is filled: the records of each input catalog are copied into it through
+        the mapper, and the transforms are then applied to the corresponding slice of it (a view, not a
+        copy) with that input's WCS and calibration.
+
+        @param[in] inputs  Iterable of (inputCat, wcs, calib) tuples, with inputCat the SourceCatalog of
+                           sources to transform, and wcs and calib the world coordinate system and the
+                           calibration under which the transformations of that catalog will take place.
+
+        @return A contiguous BaseCatalog containing the transformed measurements of all the input
+                catalogs, in order.
+        """
+        inputs = [(makeContiguous(inputCat), wcs, calib) for inputCat, wcs, calib in inputs]
+        outputCat = afwTable.BaseCatalog(self.mapper.getOutputSchema())
+        outputCat.reserve(sum(len(inputCat) for inputCat, _, _ in inputs))
+        for inputCat, wcs, calib in inputs:
+            start = len(outputCat)
+            outputCat.extend(inputCat, mapper=self.mapper)
+            outputSlice = outputCat[start:]
+            for transform in self.transforms:
+                transform(inputCat, outputSlice, wcs, calib)
+        return makeContiguous(outputCat)
+
 
 class RunTransformConfig(pexConfig.Config):
     """!Configuration for RunTransformTaskBase derivatives."""
@@ -160,6 +196,12 @@ class RunTransformConfig(pexConfig.Config):
         dtype=str,
         doc="Dataset type of measurement operation configuration",
     )
+    doReadCalexpHeader = pexConfig.Field(
+        dtype=bool,
+        default=True,
+        doc="Construct the WCS and calibration from the header of the calibrated exposure, rather than "
+            "reading the full exposure? This requires the WCS to be representable in the FITS header.",
+    )
 
 
 class RunTransformTaskBase(pipeBase.CmdLineTask):
@@ -255,12 +297,194 @@ class RunTransformTaskBase(pipeBase.CmdLineTask):
         @returns A BaseCatalog containing the transformed measurements.
         """
         inputCat = dataRef.get(self.sourceType)
-        wcs = dataRef.get(self.calexpType).getWcs()
-        calib = dataRef.get(self.calexpType).getCalib()
-        outputCat = self.transform.run(inputCat, wcs, calib)
+        calibration = self.readCalibration(dataRef)
+        outputCat = self.transform.run(inputCat, calibration.wcs, calibration.calib)
         dataRef.put(outputCat, self.outputDataset)
+        self.metadata.set("readBytes", getFileSize(dataRef, self.sourceType) + calibration.readBytes)
+        return outputCat
+
+    def readCalibration(self, dataRef):
+        """!Read the WCS and calibration of the calibrated exposure referred to by dataRef.
+
+        If config.doReadCalexpHeader is set, only the header of the exposure is read (as the "_md"
+        component), and the WCS and calibration are constructed from it. The header has FITS-WCS cards
+        only if they represent the exposure's SkyWcs exactly; if not (or if the header can't otherwise be
+        interpreted), or if doReadCalexpHeader is not set, the full exposure is read.
+
+        @param[in] dataRef  Data reference for calibrated exposure.
+
+        @returns A Struct with components:
+            - wcs: the world coordinate system (lsst.afw.geom.SkyWcs)
+            - calib: the calibration (lsst.afw.image.Calib)
+            - readBytes: approximate number of bytes read
+        """
+        if self.config.doReadCalexpHeader:
+            metadata = dataRef.get(self.calexpType + "_md", immediate=True)
+            # A FITS header is made of 80-byte cards in 2880-byte blocks
+            readBytes = 2880*((80*(metadata.nameCount() + 1) + 2879)//2880)
+            try:
+                wcs = afwGeom.makeSkyWcs(metadata)
+                calib = afwImage.Calib(metadata)
+            except Exception as e:
+                self.log.info("Unable to read WCS and calibration from header of %s %s (%s); "
+                              "reading full exposure" % (self.calexpType, dataRef.dataId, e))
+            else:
+                return pipeBase.Struct(wcs=wcs, calib=calib, readBytes=readBytes)
+        else:
+            readBytes = 0
+        calexp = dataRef.get(self.calexpType, immediate=True)
+        return pipeBase.Struct(wcs=calexp.getWcs(), calib=calexp.getCalib(),
+                               readBytes=readBytes + getFileSize(dataRef, self.calexpType))
+
+    def runBatch(self, dataRefList, filename=None):
+        """!Transform the source catalogs referred to by a list of data references into a single catalog.
+
+        The catalogs (e.g. all the CCDs of a visit, or all the patches of a tract) are transformed by
+        TransformTask.runBatch into one contiguous catalog, which is returned and optionally written to a
+        single FITS table.
+
+        @param[in] dataRefList  Data references for source catalogs & calibrated exposures.
+        @param[in] filename     Name of FITS file to which to write the result, or None.
+
+        @returns A BaseCatalog containing the transformed measurements of all the catalogs.
+        """
+        inputs = []
+        for dataRef in dataRefList:
+            calibration = self.readCalibration(dataRef)
+            inputs.append((dataRef.get(self.sourceType, immediate=True), calibration.wcs, calibration.calib))
+        outputCat = self.transform.runBatch(inputs)
+        self.log.info("Transformed %d sources from %d catalogs" % (len(outputCat), len(dataRefList)))
+        if filename is not None:
+            outputCat.writeFits(filename)
         return outputCat
 
+    def runDataIds(self, dataIdList, numProcesses=1, maxTasksPerChild=None):
+        """!Transform and write the source catalogs for a list of data IDs.
+
+        This is a bulk alternative to running the command line task once per data reference: the
+        transform task (and its mapper) is constructed once, and the data IDs are distributed over a pool
+        of numProcesses forked worker processes which inherit it. Each worker handles one data ID at a time
+        and returns only a summary, so memory use is bounded by one catalog per process; the pool may also
+        be replaced after every numProcesses*maxTasksPerChild data IDs, so that each worker handles about
+        maxTasksPerChild. A failure to transform one data ID is logged and reported, but does not abort
+        the others. If a worker process dies (e.g., killed for running out of memory), the data IDs it
+        and the other workers were handling are retried one at a time, each in a new process, and any
+        whose process dies again is reported as failed.
+
+        @param[in] dataIdList        List of data IDs (dicts) of the source catalogs to transform.
+        @param[in] numProcesses      Number of worker processes; if 1, run in this process.
+        @param[in] maxTasksPerChild  Number of data IDs after which the worker processes are replaced, or
+                                     None.
+
+        @returns A list of Structs, in the order of dataIdList, with components:
+            - dataId: the data ID
+            - numSources: number of transformed sources (None on failure)
+            - elapsed: time spent (seconds)
+            - error: a description of the failure, or None on success
+        """
+        global _transformTask
+        _transformTask = self
+        try:
+            if numProcesses > 1 and len(dataIdList) > 1:
+                results = _runPool(dataIdList, numProcesses, maxTasksPerChild)
+            else:
+                results = [_transformDataId(dataId) for dataId in dataIdList]
+        finally:
+            _transformTask = None
+
+        numFailed = sum(result.error is not None for result in results)
+        for result in results:
+            if result.error is not None:
+                self.log.warn("Failed to transform %s: %s" % (result.dataId, result.error))
+        self.log.info("Transformed %d of %d catalogs in %.1f sec total" %
+                      (len(results) - numFailed, len(results), sum(result.elapsed for result in results)))
+        return results
+
+
+# RunTransformTaskBase shared with forked runDataIds worker processes
+_transformTask = None
+
+
+def _runPool(dataIdList, numProcesses, maxTasksPerChild):
+    """!Run _transformDataId on each of a list of data IDs in a pool of forked worker processes.
+
+    At most numProcesses data IDs are in progress at once, so if a worker dies (breaking the pool), only
+    those are lost; the remaining data IDs go to a new pool, and the lost ones are retried one at a time,
+    each in a new process, so that the one responsible can be identified.
+
+    @param[in] dataIdList        List of data IDs (dicts) of the source catalogs to transform.
+    @param[in] numProcesses      Number of worker processes.
+    @param[in] maxTasksPerChild  Number of data IDs after which the worker processes are replaced, or None.
+    @returns a list of the results of _transformDataId, in the order of dataIdList.
+    """
+    context = multiprocessing.get_context("fork")
+    maxTasks = numProcesses*maxTasksPerChild if maxTasksPerChild else None
+    results = [None]*len(dataIdList)
+    pending = collections.deque(range(len(dataIdList)))
+    lost = []  # Indices of data IDs in progress when a worker died
+
+    def collect(future, index):
+        """Record the result of a data ID, returning whether it was lost"""
+        try:
+            results[index] = future.result()
+        except BrokenProcessPool:
+            lost.append(index)
+            return True
+        return False
+
+    while pending:
+        numTasks = 0
+        with concurrent.futures.ProcessPoolExecutor(numProcesses, mp_context=context) as pool:
+            running = {}  # future: index
+            while pending or running:
+                while pending and len(running) < numProcesses and (maxTasks is None or numTasks < maxTasks):
+                    index = pending.popleft()
+                    running[pool.submit(_transformDataId, dataIdList[index])] = index
+                    numTasks += 1
+                if not running:
+                    break  # Replace the workers
+                done, notDone = concurrent.futures.wait(running,
+                                                        return_when=concurrent.futures.FIRST_COMPLETED)
+                if any([collect(future, running.pop(future)) for future in done]):
+                    for future in concurrent.futures.as_completed(notDone):
+                        collect(future, running.pop(future))
+                    break
+
+    for index in sorted(lost):
+        startTime = time.time()
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as pool:
+            try:
+                results[index] = pool.submit(_transformDataId, dataIdList[index]).result()
+            except BrokenProcessPool as e:
+                results[index] = pipeBase.Struct(dataId=dataIdList[index], numSources=None,
+                                                 elapsed=time.time() - startTime,
+                                                 error="Worker process died: %s" % (e,))
+    return results
+
+
+def _transformDataId(dataId):
+    """!Transform and write the source catalog for one data ID, for RunTransformTaskBase.runDataIds.
+
+    @param[in] dataId  Data ID of the source catalog.
+    @returns a Struct with dataId, numSources, elapsed and error components.
+    """
+    startTime = time.time()
+    try:
+        dataRef = _transformTask.butler.dataRef(_transformTask.sourceType, dataId=dataId)
+        numSources = len(_transformTask.run(dataRef))
+        error = None
+    except Exception as e:
+        numSources = None
+        error = "%s\n%s" % (e, traceback.format_exc())
+    return pipeBase.Struct(dataId=dataId, numSources=numSources, elapsed=time.time() - startTime,
+                           error=error)
+
+
+def getFileSize(dataRef, datasetType):
+    """!Return the total size (bytes) of the files of a dataset, or 0 if they are not local files."""
+    filenames = dataRef.get(datasetType + "_filename")
+    return sum(os.path.getsize(filename) for filename in filenames if os.path.exists(filename))
+
 
 ## \addtogroup LSST_task_documentation
 ## \{
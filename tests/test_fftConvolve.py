@@ -0,0 +1,82 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.image as afwImage
+import lsst.afw.math as afwMath
+from lsst.meas.algorithms import SingleGaussianPsf
+from lsst.pipe.tasks.imageDifference import fftConvolve
+
+
+class FftConvolveTestCase(lsst.utils.tests.TestCase):
+    """Test that fftConvolve matches afw.math.convolve"""
+
+    def setUp(self):
+        np.random.seed(12345)
+        self.maskedImage = afwImage.MaskedImageF(173, 211)
+        self.maskedImage.getImage().getArray()[:] = np.random.normal(100.0, 10.0, (211, 173))
+        self.maskedImage.getVariance().getArray()[:] = np.random.uniform(90.0, 110.0, (211, 173))
+        mask = self.maskedImage.getMask()
+        mask.getArray()[50:53, 60:64] = mask.getPlaneBitMask("SAT")
+        mask.getArray()[120, 100] |= mask.getPlaneBitMask("CR")
+        mask.getArray()[51:56, 62] |= mask.getPlaneBitMask("BAD")  # Overlaps SAT
+        self.maskedImage.getImage().getArray()[150, 30] = np.nan
+
+    def tearDown(self):
+        del self.maskedImage
+
+    def checkKernel(self, kernel, tileSize):
+        for doCopyEdge in (False, True):
+            convControl = afwMath.ConvolutionControl()
+            convControl.setDoCopyEdge(doCopyEdge)
+            expected = self.maskedImage.Factory(self.maskedImage.getDimensions())
+            afwMath.convolve(expected, self.maskedImage, kernel, convControl)
+            result = self.maskedImage.Factory(self.maskedImage.getDimensions())
+            fftConvolve(result, self.maskedImage, kernel, convControl, tileSize=tileSize)
+            self.assertMaskedImagesAlmostEqual(result, expected, rtol=1.0e-5)
+
+    def testGaussian(self):
+        kernel = SingleGaussianPsf(21, 21, 2.5).getLocalKernel()
+        for tileSize in (64, 1024):
+            self.checkKernel(kernel, tileSize)
+
+    def testAsymmetric(self):
+        kernelImage = afwImage.ImageD(15, 11)
+        kernelImage.getArray()[:] = np.random.uniform(0.0, 1.0, (11, 15))
+        kernelImage.getArray()[2, 3] = 0.0
+        self.checkKernel(afwMath.FixedKernel(kernelImage), 64)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,299 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.table as afwTable
+from lsst.pipe.tasks.imageDifference import (TemplatePatchCache, TemplatePatchCacheDataRef,
+                                             RefShardCache, cacheRefShards, setMatchIds)
+
+
+def makePatch(x0, y0, value, size=10):
+    """Make a size x size patch exposure with origin (x0, y0), filled with value"""
+    patch = afwImage.ExposureF(afwGeom.Box2I(afwGeom.Point2I(x0, y0), afwGeom.Extent2I(size, size)))
+    patch.getMaskedImage().getImage().set(value)
+    return patch
+
+
+class PatchReader(object):
+    """Read patches, recording which were read"""
+
+    def __init__(self):
+        self.reads = []
+
+    def __call__(self, key):
+        def read():
+            self.reads.append(key)
+            return makePatch(10*key, 20*key, float(key))
+        return read
+
+
+class TemplatePatchCacheTestCase(lsst.utils.tests.TestCase):
+    """Test the least-recently-used template patch cache"""
+
+    def setUp(self):
+        self.patchBytes = TemplatePatchCache.getNumBytes(makePatch(0, 0, 0.0).getBBox())
+        self.reader = PatchReader()
+
+    def getCutout(self, cache, key):
+        """Return a 3x3 cutout of a patch through the cache"""
+        bbox = afwGeom.Box2I(afwGeom.Point2I(10*key + 2, 20*key + 4), afwGeom.Extent2I(3, 3))
+        cutout = cache.get(key, bbox, self.reader(key))
+        self.assertEqual(cutout.getBBox(), bbox)
+        self.assertFloatsEqual(cutout.getMaskedImage().getImage().getArray(), float(key))
+        return cutout
+
+    def testEviction(self):
+        """The least recently used patches are evicted to keep within maxBytes"""
+        cache = TemplatePatchCache(int(2.5*self.patchBytes))
+        for key in (1, 2, 1, 3, 2, 1):
+            self.getCutout(cache, key)
+        # 2 was evicted by 3 (1 having been used more recently), then 1 by 2, and 3 by 1
+        self.assertEqual(self.reader.reads, [1, 2, 3, 2, 1])
+        self.assertEqual(list(cache._patches.keys()), [2, 1])
+        self.assertEqual(cache._numBytes, 2*self.patchBytes)
+        self.assertTrue(cache.contains(1))
+        self.assertFalse(cache.contains(3))
+        cutoutBytes = TemplatePatchCache.getNumBytes(afwGeom.Box2I(afwGeom.Point2I(0, 0),
+                                                                   afwGeom.Extent2I(3, 3)))
+        self.assertEqual(cache.getStats(), dict(hits=1, misses=5, bytesAvoided=cutoutBytes,
+                                                bytesRead=5*self.patchBytes))
+
+    def testCutoutIsView(self):
+        cache = TemplatePatchCache(10*self.patchBytes)
+        cutout = self.getCutout(cache, 1)
+        cutout.getMaskedImage().getImage().set(5.0)
+        self.assertFloatsEqual(self.getCutout(cache, 1).getMaskedImage().getImage().getArray(), 5.0)
+        self.assertEqual(self.reader.reads, [1])
+
+    def testZeroSize(self):
+        """Nothing is kept in a cache of size zero, or of less than a patch"""
+        for maxBytes in (0, self.patchBytes - 1):
+            self.reader.reads = []
+            cache = TemplatePatchCache(maxBytes)
+            for key in (1, 1, 2, 1):
+                self.getCutout(cache, key)
+            self.assertEqual(self.reader.reads, [1, 1, 2, 1])
+            self.assertEqual(len(cache._patches), 0)
+            self.assertEqual(cache._numBytes, 0)
+            self.assertEqual(cache.getStats()["hits"], 0)
+
+
+class DummyDataRef(object):
+    """A data reference serving patches of a coadd"""
+
+    def __init__(self, dataId):
+        self.dataId = dataId
+        self.gets = []
+
+    def get(self, datasetType=None, **rest):
+        self.gets.append((datasetType, rest))
+        if datasetType == "deepCoadd":
+            return makePatch(0, 0, float(rest["patch"]), size=100)
+        return datasetType
+
+    def datasetExists(self, datasetType=None, **rest):
+        return False
+
+
+class TemplatePatchCacheDataRefTestCase(lsst.utils.tests.TestCase):
+    """Test that patch cutouts are served from the cache, shared between visits of a filter"""
+
+    def testDataRef(self):
+        patchBytes = TemplatePatchCache.getNumBytes(makePatch(0, 0, 0.0, size=100).getBBox())
+        cache = TemplatePatchCache(10*patchBytes)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(10, 20), afwGeom.Extent2I(30, 40))
+        dataRefs = [DummyDataRef(dict(visit=visit, filter="r")) for visit in (1, 2)]
+        for dataRef in dataRefs:
+            proxy = TemplatePatchCacheDataRef(dataRef, cache)
+            # The patch is only in the cache once the first visit has read it
+            self.assertEqual(proxy.datasetExists("deepCoadd_sub", bbox=bbox, tract=0, patch=3),
+                             dataRef is not dataRefs[0])
+            cutout = proxy.get("deepCoadd_sub", bbox=bbox, tract=0, patch=3)
+            self.assertEqual(cutout.getBBox(), bbox)
+            self.assertTrue(proxy.datasetExists("deepCoadd_sub", bbox=bbox, tract=0, patch=3))
+            self.assertEqual(proxy.get("calexp"), "calexp")
+        self.assertEqual(dataRefs[0].gets, [("deepCoadd", dict(immediate=True, tract=0, patch=3)),
+                                            ("calexp", {})])
+        self.assertEqual(dataRefs[1].gets, [("calexp", {})])
+        self.assertEqual(cache.getStats()["hits"], 1)
+
+
+class ShardLoader(object):
+    """A reference object loader reading shards that are lists of their ids"""
+    ref_dataset_name = "dummy_ref"
+
+    def __init__(self):
+        self.reads = []
+
+    def get_shards(self, idList):
+        self.reads += idList
+        return [[shardId] for shardId in idList]
+
+
+class RefShardCacheTestCase(lsst.utils.tests.TestCase):
+    """Test the least-recently-used reference shard cache, and reading shards through it"""
+
+    def testEviction(self):
+        reads = []
+
+        def reader(key):
+            return lambda: reads.append(key) or [key]
+
+        cache = RefShardCache(2)
+        for key in (1, 2, 1, 3, 2, 1):
+            self.assertEqual(cache.get(key, reader(key)), [key])
+        self.assertEqual(reads, [1, 2, 3, 2, 1])
+        self.assertEqual(list(cache._shards.keys()), [2, 1])
+        self.assertEqual(cache.getStats(), dict(hits=1, misses=5))
+
+        reads = []
+        cache = RefShardCache(0)
+        for key in (1, 1):
+            self.assertEqual(cache.get(key, reader(key)), [key])
+        self.assertEqual(reads, [1, 1])
+        self.assertEqual(len(cache._shards), 0)
+
+    def testCacheRefShards(self):
+        loader = ShardLoader()
+        cache = RefShardCache(10)
+        with cacheRefShards(loader, cache):
+            self.assertEqual(loader.get_shards([1, 2]), [[1], [2]])
+            self.assertEqual(loader.get_shards([2, 3]), [[2], [3]])
+        self.assertEqual(loader.reads, [1, 2, 3])
+        self.assertEqual(list(cache._shards.keys()), [("dummy_ref", 1), ("dummy_ref", 2), ("dummy_ref", 3)])
+        # The loader's own get_shards is restored
+        self.assertNotIn("get_shards", vars(loader))
+        self.assertEqual(loader.get_shards([1]), [[1]])
+        self.assertEqual(loader.reads, [1, 2, 3, 1])
+
+    def testRestoreOnException(self):
+        loader = ShardLoader()
+        with self.assertRaises(RuntimeError):
+            with cacheRefShards(loader, RefShardCache(10)):
+                loader.get_shards([1])
+                raise RuntimeError("Failed to match")
+        self.assertNotIn("get_shards", vars(loader))
+
+        # A get_shards set on the loader itself is restored too
+        def getShards(idList):
+            return []
+        loader.get_shards = getShards
+        with self.assertRaises(RuntimeError):
+            with cacheRefShards(loader, RefShardCache(10)):
+                self.assertIsNot(loader.get_shards, getShards)
+                raise RuntimeError("Failed to match")
+        self.assertIs(loader.get_shards, getShards)
+
+    def testUnchanged(self):
+        """Loaders without get_shards, or without a cache, are left unchanged"""
+        loader = ShardLoader()
+        with cacheRefShards(loader, None):
+            self.assertNotIn("get_shards", vars(loader))
+        other = object()
+        with cacheRefShards(other, RefShardCache(10)):
+            self.assertFalse(hasattr(other, "get_shards"))
+
+
+def setMatchIdsLoop(catalog, fieldName, matches):
+    """Set match ids as the original implementation in ImageDifferenceTask.run did
+
+    @return number of records of catalog that were matched
+    """
+    matchDict = dict([(match.second.getId(), match.first.getId()) for match in matches])
+    numMatched = 0
+    for record in catalog:
+        if record.getId() in matchDict:
+            record.set(fieldName, matchDict[record.getId()])
+            numMatched += 1
+    return numMatched
+
+
+class SetMatchIdsTestCase(lsst.utils.tests.TestCase):
+    """Test that setMatchIds sets the same ids as the original loop over the matches"""
+
+    def setUp(self):
+        rng = np.random.RandomState(12345)
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        schema.addField("srcMatchId", "L", "unique id of source match")
+        catalog = afwTable.SourceCatalog(schema)
+        for sourceId in rng.permutation(np.arange(200)*2 + 1):
+            catalog.addNew().setId(int(sourceId))
+        self.catalog = catalog.copy(deep=True)  # Contiguous
+        self.others = afwTable.SourceCatalog(afwTable.SourceTable.makeMinimalSchema())
+        for sourceId in range(5000, 5300):
+            self.others.addNew().setId(sourceId)
+        # Matches to the catalog (some records matched several times, many not at all) and to records
+        # that are not in the catalog
+        notInCatalog = afwTable.SourceCatalog(schema)
+        for sourceId in (0, 2, 1000):
+            notInCatalog.addNew().setId(sourceId)
+        seconds = [self.catalog[int(i)] for i in rng.randint(0, len(self.catalog), 150)] + list(notInCatalog)
+        rng.shuffle(seconds)
+        self.matches = [afwTable.SourceMatch(self.others[int(i)], second, 0.0) for i, second in
+                        zip(rng.randint(0, len(self.others), len(seconds)), seconds)]
+
+    def tearDown(self):
+        del self.catalog
+        del self.others
+        del self.matches
+
+    def check(self, matches):
+        expected = self.catalog.copy(deep=True)
+        numExpected = setMatchIdsLoop(expected, "srcMatchId", matches)
+        numMatched = setMatchIds(self.catalog, "srcMatchId", matches)
+        self.assertEqual(numMatched, numExpected)
+        self.assertEqual(list(self.catalog["srcMatchId"]), list(expected["srcMatchId"]))
+        return numMatched
+
+    def testSetMatchIds(self):
+        numMatched = self.check(self.matches)
+        self.assertGreater(numMatched, 0)
+        self.assertLess(numMatched, len(self.catalog))
+        # Records matched several times have the id of their last match
+        self.assertGreater(len(self.matches) - 3, numMatched)
+        lastMatch = {}
+        for match in self.matches:
+            lastMatch[match.second.getId()] = match.first.getId()
+        for record in self.catalog:
+            self.assertEqual(record.get("srcMatchId"), lastMatch.get(record.getId(), 0))
+
+    def testNoMatches(self):
+        self.assertEqual(self.check([]), 0)
+        self.assertTrue((self.catalog["srcMatchId"] == 0).all())
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
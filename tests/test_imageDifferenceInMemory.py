@@ -0,0 +1,112 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+import unittest.mock
+
+import lsst.utils.tests
+import lsst.afw.geom as afwGeom
+from lsst.meas.algorithms import WarpedPsf
+from lsst.meas.base.tests import TestDataset
+from lsst.pipe.tasks.imageDifference import ImageDifferenceConfig, ImageDifferenceTask
+
+
+def makeExposure(psfSigma, transient=False, randomSeed=1):
+    """Make an exposure of a grid of stars, optionally with an extra (transient) source"""
+    bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(300, 300))
+    dataset = TestDataset(bbox, psfSigma=psfSigma)
+    for x in range(30, 300, 60):
+        for y in range(30, 300, 60):
+            dataset.addSource(50000.0, afwGeom.Point2D(x + 0.3, y + 0.6))
+    if transient:
+        dataset.addSource(50000.0, afwGeom.Point2D(150.2, 120.7))
+    exposure, catalog = dataset.realize(10.0, TestDataset.makeMinimalSchema(), randomSeed=randomSeed)
+    return exposure
+
+
+class RunInMemoryTestCase(lsst.utils.tests.TestCase):
+    """Test the latency budget of ImageDifferenceTask.runInMemory"""
+
+    def setUp(self):
+        self.exposure = makeExposure(2.5, transient=True, randomSeed=1)
+        self.template = makeExposure(1.5, randomSeed=2)
+
+    def tearDown(self):
+        del self.exposure
+        del self.template
+
+    def runInMemory(self, latencyBudget, latencyOverrunAction="degrade"):
+        config = ImageDifferenceConfig()
+        config.doSelectSources = False  # Needs a reference catalog
+        config.latencyBudget = latencyBudget
+        config.latencyOverrunAction = latencyOverrunAction
+        task = ImageDifferenceTask(config=config)
+        return task.runInMemory(self.exposure.clone(), self.template.clone())
+
+    def testSkipMeasurement(self):
+        """Measurement is skipped if the total budget is already used up"""
+        result = self.runInMemory({"template": 0.0, "psfMatch": 0.0, "detection": 0.0, "measurement": 0.0})
+        self.assertEqual(result.degraded, ["skipped measurement"])
+        self.assertEqual(set(result.timings.keys()), set(["template", "psfMatch", "detection"]))
+        self.assertIsNotNone(result.sources)
+        self.assertGreater(len(result.sources), 0)
+
+    def testDifferenceImageDipoles(self):
+        """Dipoles are fit on the difference image alone if a stage overran"""
+        result = self.runInMemory({"template": 0.0, "psfMatch": 1000.0, "detection": 1000.0,
+                                   "measurement": 1000.0})
+        self.assertEqual(result.degraded, ["dipole fitting on difference image only"])
+        self.assertIn("measurement", result.timings)
+
+    def testWarn(self):
+        """Overruns are only reported if latencyOverrunAction is 'warn'"""
+        result = self.runInMemory({"template": 0.0, "psfMatch": 0.0, "detection": 0.0, "measurement": 0.0},
+                                  latencyOverrunAction="warn")
+        self.assertEqual(result.degraded, [])
+        self.assertIn("measurement", result.timings)
+
+    def testWarpedTemplatePsf(self):
+        """The template PSF is warped along with the template"""
+        config = ImageDifferenceConfig()
+        config.doSelectSources = False
+        task = ImageDifferenceTask(config=config)
+        subtractExposures = task.subtract.subtractExposures
+        with unittest.mock.patch.object(task.subtract, "subtractExposures",
+                                        side_effect=subtractExposures) as mockSubtract:
+            task.runInMemory(self.exposure.clone(), self.template.clone())
+        templateExposure = mockSubtract.call_args[1]["templateExposure"]
+        self.assertIsInstance(templateExposure.getPsf(), WarpedPsf)
+        self.assertFloatsAlmostEqual(templateExposure.getPsf().computeShape().getDeterminantRadius(),
+                                     self.template.getPsf().computeShape().getDeterminantRadius(),
+                                     rtol=1.0e-3)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
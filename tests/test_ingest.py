@@ -0,0 +1,277 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import unittest.mock
+
+import lsst.utils.tests
+import lsst.pipe.base as pipeBase
+from lsst.pipe.tasks.ingest import (IngestConfig, IngestJournal, IngestTask, ParseTask, RegisterConfig,
+                                    RegisterTask)
+
+# Names of the files parsed by DummyParseTask
+parsedFiles = []
+
+
+class DummyParseTask(ParseTask):
+    """Parse the visit and ccd from the contents of a text file, rather than from FITS headers"""
+
+    def getInfo(self, filename):
+        parsedFiles.append(os.path.basename(filename))
+        with open(filename) as ff:
+            visit, ccd = (int(value) for value in ff.read().split())
+        info = dict(visit=visit, ccd=ccd, filter="r")
+        return info, [info]
+
+    def getDestination(self, butler, info, filename):
+        if os.path.basename(filename).startswith("fail"):
+            # The "blocker" file prevents the creation of the destination directory
+            return os.path.join(butler.root, "blocker", "%(visit)d-%(ccd)d.fits" % info)
+        return os.path.join(butler.root, "raw", "%(visit)d-%(ccd)d.fits" % info)
+
+
+def setRegisterConfig(config):
+    config.columns = {"visit": "int", "ccd": "int", "filter": "text"}
+    config.unique = ["visit", "ccd"]
+    config.visit = ["visit", "filter"]
+
+
+class RegisterTestCase(lsst.utils.tests.TestCase):
+    """Test batched registry inserts"""
+
+    def setUp(self):
+        config = RegisterConfig()
+        setRegisterConfig(config)
+        self.task = RegisterTask(config=config)
+        self.conn = sqlite3.connect(":memory:")
+        self.task.createTable(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+        del self.task
+
+    def getRows(self):
+        return self.conn.execute("SELECT id, visit, ccd FROM raw ORDER BY id").fetchall()
+
+    def testAddRows(self):
+        infoList = [dict(visit=1, ccd=ccd, filter="r") for ccd in range(3)]
+        self.task.addRows(self.conn, infoList)
+        self.assertEqual(self.getRows(), [(1, 1, 0), (2, 1, 1), (3, 1, 2)])
+        self.assertTrue(self.task.check(self.conn, infoList[1]))
+        self.assertFalse(self.task.check(self.conn, dict(visit=2, ccd=0)))
+
+        self.task.config.ignore = True
+        self.task.addRows(self.conn, [dict(visit=1, ccd=1, filter="r"), dict(visit=2, ccd=0, filter="r")])
+        self.assertEqual(self.getRows(), [(1, 1, 0), (2, 1, 1), (3, 1, 2), (4, 2, 0)])
+
+    def testPendingKeys(self):
+        info = dict(visit=1, ccd=2, filter="r")
+        pendingKeys = set([self.task.getUniqueKey(info)])
+        self.assertFalse(self.task.check(self.conn, info))
+        self.assertTrue(self.task.check(self.conn, info, pendingKeys=pendingKeys))
+
+    def getIndexes(self, table="raw"):
+        return [row[1] for row in self.conn.execute("PRAGMA index_list(%s)" % table)]
+
+    def testCreateUniqueIndex(self):
+        """A unique index is only created if the table doesn't already have one"""
+        indexes = self.getIndexes()
+        self.task.createUniqueIndex(self.conn)
+        self.assertEqual(self.getIndexes(), indexes)
+
+        self.conn.execute("CREATE TABLE other (id integer primary key autoincrement, "
+                          "visit int, ccd int, filter text)")
+        self.task.createUniqueIndex(self.conn, table="other")
+        self.assertEqual(self.getIndexes("other"), ["other_unique"])
+        self.task.createUniqueIndex(self.conn, table="other")
+        self.assertEqual(self.getIndexes("other"), ["other_unique"])
+
+    def testCreateVisitIndex(self):
+        """An index on visit is only created if the visits table doesn't already have one"""
+        indexes = self.getIndexes("raw_visit")
+        self.task.addRows(self.conn, [dict(visit=1, ccd=ccd, filter="r") for ccd in range(3)])
+        self.task.addVisits(self.conn)
+        self.assertEqual(self.getIndexes("raw_visit"), indexes)
+        self.assertEqual(self.conn.execute("SELECT visit, filter FROM raw_visit").fetchall(), [(1, "r")])
+
+        for name, visits in (("other", [(1, "r"), (2, "g")]), ("legacy", [(1, "r"), (1, "g")])):
+            self.conn.execute("CREATE TABLE %s_visit (visit int, filter text)" % name)
+            self.conn.executemany("INSERT INTO %s_visit VALUES (?, ?)" % name, visits)
+            self.task.createVisitIndex(self.conn, table=name)
+            self.assertEqual(self.getIndexes("%s_visit" % name), ["%s_visit_visit" % name])
+            isUnique = self.conn.execute("PRAGMA index_list(%s_visit)" % name).fetchone()[2]
+            self.assertEqual(bool(isUnique), name == "other")
+            self.task.createVisitIndex(self.conn, table=name)
+            self.assertEqual(self.getIndexes("%s_visit" % name), ["%s_visit_visit" % name])
+
+
+class IngestTestCase(lsst.utils.tests.TestCase):
+    """Test ingesting files into a registry"""
+
+    def setUp(self):
+        del parsedFiles[:]
+        self.directory = tempfile.mkdtemp()
+        self.root = os.path.join(self.directory, "repo")
+        os.makedirs(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def makeFile(self, name, visit, ccd):
+        filename = os.path.join(self.directory, name)
+        with open(filename, "w") as ff:
+            ff.write("%d %d\n" % (visit, ccd))
+        return filename
+
+    def makeTask(self, **kwargs):
+        config = IngestConfig()
+        config.parse.retarget(DummyParseTask)
+        setRegisterConfig(config.register)
+        for key, value in kwargs.items():
+            setattr(config, key, value)
+        return IngestTask(config=config)
+
+    def makeArgs(self, files, mode="link", ignoreIngested=False):
+        return pipeBase.Struct(files=files, input=self.root, butler=pipeBase.Struct(root=self.root),
+                               dryrun=False, create=False, mode=mode, badFile=[],
+                               badId=pipeBase.Struct(idList=[]), ignoreIngested=ignoreIngested)
+
+    def getRegistryRows(self):
+        conn = sqlite3.connect(os.path.join(self.root, "registry.sqlite3"))
+        try:
+            return conn.execute("SELECT visit, ccd FROM raw ORDER BY id").fetchall()
+        finally:
+            conn.close()
+
+    def testDuplicateInSameRun(self):
+        """A file with the same unique key as one earlier in the same ingest is skipped
+
+        The earlier file is still awaiting insertion into the registry when the later one is checked.
+        """
+        files = [self.makeFile("a.txt", 1, 1), self.makeFile("b.txt", 1, 1), self.makeFile("c.txt", 1, 2)]
+        for numProcesses in (1, 2):
+            registry = os.path.join(self.root, "registry.sqlite3")
+            if os.path.exists(registry):
+                os.unlink(registry)
+            task = self.makeTask(numProcesses=numProcesses)
+            task.run(self.makeArgs(files, mode="skip", ignoreIngested=True))
+            self.assertEqual(self.getRegistryRows(), [(1, 1), (1, 2)])
+
+    def testFailedTransfer(self):
+        """A file with the same unique key as one that failed to transfer is still ingested"""
+        with open(os.path.join(self.root, "blocker"), "w") as ff:
+            ff.write("blocker")
+        files = [self.makeFile("fail.txt", 1, 1), self.makeFile("a.txt", 1, 1), self.makeFile("b.txt", 1, 2)]
+        for numProcesses in (1, 2):
+            registry = os.path.join(self.root, "registry.sqlite3")
+            if os.path.exists(registry):
+                os.unlink(registry)
+            shutil.rmtree(os.path.join(self.root, "raw"), ignore_errors=True)
+            task = self.makeTask(numProcesses=numProcesses, allowError=True)
+            task.run(self.makeArgs(files, ignoreIngested=True))
+            self.assertEqual(self.getRegistryRows(), [(1, 1), (1, 2)])
+            self.assertTrue(os.path.islink(os.path.join(self.root, "raw", "1-1.fits")))
+
+    def testResume(self):
+        """An interrupted ingest is resumed without parsing or transferring files again"""
+        for clobber in (False, True):
+            shutil.rmtree(self.root)
+            os.makedirs(self.root)
+            del parsedFiles[:]
+            files = [self.makeFile("a.txt", 1, 1), self.makeFile("b.txt", 1, 2)]
+            task = self.makeTask(journal="ingest.journal", clobber=clobber)
+
+            def interrupt(*args, **kwargs):
+                raise RuntimeError("Interrupted")
+
+            task.register.addVisits = interrupt
+            with self.assertRaises(RuntimeError):
+                task.run(self.makeArgs(files))
+            self.assertFalse(os.path.exists(os.path.join(self.root, "registry.sqlite3")))
+            self.assertEqual(sorted(parsedFiles), ["a.txt", "b.txt"])
+
+            del parsedFiles[:]
+            files.append(self.makeFile("c.txt", 2, 1))
+            self.makeTask(journal="ingest.journal", clobber=clobber).run(self.makeArgs(files))
+            self.assertEqual(parsedFiles, ["c.txt"])
+            self.assertEqual(self.getRegistryRows(), [(1, 1), (1, 2), (2, 1)])
+
+            # Everything is now registered
+            del parsedFiles[:]
+            self.makeTask(journal="ingest.journal", clobber=clobber).run(self.makeArgs(files))
+            self.assertEqual(parsedFiles, [])
+            self.assertEqual(self.getRegistryRows(), [(1, 1), (1, 2), (2, 1)])
+
+    def testResumeAfterRegistration(self):
+        """An ingest interrupted after the registry was written, but before the journal was updated"""
+        files = [self.makeFile("a.txt", 1, 1), self.makeFile("b.txt", 1, 2)]
+
+        def interrupt(*args, **kwargs):
+            raise RuntimeError("Interrupted")
+
+        with unittest.mock.patch.object(IngestJournal, "finishRegistration", interrupt):
+            with self.assertRaises(RuntimeError):
+                self.makeTask(journal="ingest.journal").run(self.makeArgs(files))
+        self.assertEqual(self.getRegistryRows(), [(1, 1), (1, 2)])
+
+        for numRuns in range(2):
+            del parsedFiles[:]
+            self.makeTask(journal="ingest.journal").run(self.makeArgs(files))
+            self.assertEqual(parsedFiles, [])
+            self.assertEqual(self.getRegistryRows(), [(1, 1), (1, 2)])
+
+    def testReconcileIncompleteTransfer(self):
+        """The partial output of an interrupted transfer is removed, and the file ingested afresh"""
+        infile = self.makeFile("a.txt", 1, 1)
+        outfile = os.path.join(self.root, "raw", "1-1.fits")
+        os.makedirs(os.path.dirname(outfile))
+        journal = IngestJournal(os.path.join(self.root, "ingest.journal"))
+        try:
+            journal.startTransfer(infile, [dict(visit=1, ccd=1, filter="r")], outfile)
+            with open(outfile, "w") as ff:
+                ff.write("partial")
+            reconciled = journal.reconcile(self.makeTask().log)
+        finally:
+            journal.close()
+        self.assertEqual(reconciled.filenames, set())
+        self.assertEqual(reconciled.hduInfoList, [])
+        self.assertFalse(os.path.exists(outfile))
+
+        self.makeTask(journal="ingest.journal").run(self.makeArgs([infile]))
+        self.assertEqual(self.getRegistryRows(), [(1, 1)])
+        self.assertTrue(os.path.islink(outfile))
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,93 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import sqlite3
+import unittest
+
+import lsst.utils.tests
+from lsst.pipe.tasks.ingestCalibs import CalibsRegisterConfig, CalibsRegisterTask
+
+
+class ValidityRangesTestCase(lsst.utils.tests.TestCase):
+    """Test that incremental updates of the validity ranges match a full recalculation"""
+
+    def setUp(self):
+        config = CalibsRegisterConfig()
+        config.columns = {"filter": "text", "ccd": "int", "calibDate": "text",
+                          "validStart": "text", "validEnd": "text"}
+        config.unique = ["filter", "ccd", "calibDate"]
+        config.visit = ["calibDate", "filter"]
+        config.tables = ["flat", "defect"]
+        self.task = CalibsRegisterTask(config=config)
+        self.conn = sqlite3.connect(":memory:")
+        self.task.createTable(self.conn)
+
+    def tearDown(self):
+        self.conn.close()
+        del self.task
+
+    def ingest(self, table, filterName, ccd, dates, validity):
+        """Add calibs for a detector, and update the validity ranges incrementally"""
+        infoList = [dict(filter=filterName, ccd=ccd, calibDate=date) for date in dates]
+        self.task.addRows(self.conn, infoList, table=table)
+        detectors = set(self.task.getDetectorData(info) for info in infoList)
+        self.task.updateValidityRanges(self.conn, validity, {table: detectors})
+
+    def getValidity(self, table):
+        return [tuple(row) for row in
+                self.conn.execute("SELECT id, validStart, validEnd FROM %s ORDER BY id" % table)]
+
+    def checkFullRecalculation(self, validity):
+        """Check that recalculating all the validity ranges from scratch makes no difference"""
+        expected = {table: self.getValidity(table) for table in self.task.config.tables}
+        for table in self.task.config.tables:
+            self.conn.execute("UPDATE %s SET validStart=NULL, validEnd=NULL" % table)
+        self.task.updateValidityRanges(self.conn, validity)
+        for table in self.task.config.tables:
+            self.assertEqual(self.getValidity(table), expected[table])
+
+    def testIncremental(self):
+        for table in ("flat", "defect"):
+            self.ingest(table, "r", 1, ["2018-01-01", "2018-01-15"], 10)
+            self.ingest(table, "r", 2, ["2018-01-03"], 10)
+        self.checkFullRecalculation(10)
+
+        # Same validity: only detector 1 is updated
+        self.ingest("flat", "r", 1, ["2018-02-01"], 10)
+        self.checkFullRecalculation(10)
+
+        # New validity: all detectors are updated
+        self.ingest("flat", "g", 3, ["2018-01-20"], 30)
+        self.assertEqual(self.task.getRecordedValidity(self.conn), 30)
+        self.checkFullRecalculation(30)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
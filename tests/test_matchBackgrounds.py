@@ -304,6 +304,22 @@ class MatchBackgroundsTestCase(unittest.TestCase):
         self.matcher.config.binSize = 64
         self.checkAccuracy(self.vanilla, self.lowCover)
 
+    def testGridMethods(self):
+        """Test the vectorized grid statistics agree with afw.math.makeStatistics on each bin"""
+        maskedImage = self.chipGap.getMaskedImage()
+        mask = maskedImage.getMask()
+        mask.getArray()[100:120, :] = mask.getPlaneBitMask('SAT')
+        maskedImage.getImage().getArray()[350:360, 400:410] = 1000.0
+        self.matcher.sctrl.setNumSigmaClip(self.matcher.config.numSigmaClip)
+        self.matcher.sctrl.setNumIter(self.matcher.config.numIter)
+        for statistic in ("MEAN", "MEDIAN", "MEANCLIP"):
+            statsFlag = getattr(afwMath, statistic)
+            for binSize in (64, 256):
+                expected = self.matcher._gridImagePerBin(maskedImage, binSize, statsFlag)
+                result = self.matcher._gridImageVectorized(maskedImage, binSize, statsFlag)
+                for resultArr, expectedArr in zip(result, expected):
+                    np.testing.assert_allclose(resultArr, expectedArr, rtol=1e-6)
+
 
 def setup_module(module):
     lsst.utils.tests.init()
@@ -0,0 +1,118 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDetect
+import lsst.afw.geom as afwGeom
+import lsst.afw.image as afwImage
+import lsst.afw.table as afwTable
+from lsst.meas.base.tests import TestDataset
+from lsst.pipe.tasks.multiBand import (MeasureMergedCoaddSourcesConfig, MeasureMergedCoaddSourcesTask,
+                                       PsfEvaluationRecorder)
+
+
+class ParallelMeasurementTestCase(lsst.utils.tests.TestCase):
+    """Test that measuring parent groups in parallel matches a serial measurement"""
+
+    def setUp(self):
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(200, 160))
+        dataset = TestDataset(bbox)
+        dataset.addSource(100000.0, afwGeom.Point2D(30.2, 40.7))
+        with dataset.addBlend() as family:
+            family.addChild(80000.0, afwGeom.Point2D(100.4, 60.3))
+            family.addChild(60000.0, afwGeom.Point2D(107.8, 64.1))
+        with dataset.addBlend() as family:
+            family.addChild(50000.0, afwGeom.Point2D(60.1, 120.9))
+            family.addChild(70000.0, afwGeom.Point2D(66.5, 116.2))
+            family.addChild(40000.0, afwGeom.Point2D(63.0, 125.5))
+        dataset.addSource(90000.0, afwGeom.Point2D(160.6, 130.3))
+        self.exposure, catalog = dataset.realize(10.0, TestDataset.makeMinimalSchema(), randomSeed=5)
+
+        config = MeasureMergedCoaddSourcesConfig()
+        config.doDeblend = False
+        config.doMatchSources = False
+        config.doPropagateFlags = False
+        config.doApCorr = False
+        config.doRunCatalogCalculation = False
+        config.measurement.plugins.names.discard("base_InputCount")  # Needs coadd inputs
+        config.measurement.plugins.names |= ["base_Blendedness"]
+        config.measurementProcesses = 2
+        config.measurementChunksPerProcess = 2
+        self.task = MeasureMergedCoaddSourcesTask(schema=catalog.schema, config=config)
+        self.sources = afwTable.SourceCatalog(self.task.schema)
+        self.sources.extend(catalog, self.task.schemaMapper)
+
+    def tearDown(self):
+        del self.exposure
+        del self.task
+        del self.sources
+
+    def testParallelMeasurement(self):
+        self.assertTrue(self.task.measurement.doBlendedness)
+        serial = self.sources.copy(deep=True)
+        self.task.measurement.run(serial, afwImage.ExposureF(self.exposure, True), exposureId=12345)
+        parallel = self.sources.copy(deep=True)
+        self.task.runParallelMeasurement(parallel, afwImage.ExposureF(self.exposure, True), 12345)
+
+        childFields = [name for name in serial.schema.getNames() if
+                       name.startswith("base_Blendedness") and "child" in name]
+        self.assertGreater(len(childFields), 0)
+        for name in childFields:
+            self.assertTrue(np.any(np.isfinite(serial[name])), name)
+        for name in serial.schema.getNames():
+            np.testing.assert_array_equal(parallel[name], serial[name], err_msg=name)
+
+
+class PsfEvaluationRecorderTestCase(lsst.utils.tests.TestCase):
+    """Test the counting of PSF evaluations and modelled cache hits"""
+
+    def testRecorder(self):
+        psf = afwDetect.GaussianPsf(15, 15, 2.0)
+        recorder = PsfEvaluationRecorder(psf, 2)
+        points = [afwGeom.Point2D(10.0, 20.0), afwGeom.Point2D(30.5, 40.5), afwGeom.Point2D(50.0, 60.0)]
+        for point, isHit in [(points[0], False), (points[0], True), (points[1], False),
+                             (points[2], False), (points[0], False), (points[2], True)]:
+            hits = recorder.hits
+            self.assertImagesEqual(recorder.computeImage(point), psf.computeImage(point))
+            self.assertEqual(recorder.hits - hits, int(isHit))
+        recorder.computeKernelImage(points[2])  # Separate cache from computeImage
+        self.assertEqual(recorder.hits, 2)
+        self.assertEqual(recorder.count, 7)
+        self.assertEqual(recorder.computeShape(points[0]).getDeterminantRadius(),
+                         psf.computeShape(points[0]).getDeterminantRadius())
+        self.assertEqual(recorder.count, 7)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
@@ -0,0 +1,256 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDetect
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+import lsst.pipe.base as pipeBase
+from lsst.afw.image.utils import defineFilter, resetFilters
+from lsst.pipe.tasks.multiBand import MergeDetectionsConfig, MergeDetectionsTask, _dilateGrid
+
+
+def cullPeaksLoop(task, catalog):
+    """Cull peaks as the original per-peak implementation of MergeDetectionsTask.cullPeaks did
+
+    @return list of the ids of the kept peaks, for each source
+    """
+    keys = [item.key for item in task.merged.getPeakSchema().extract("merge_peak_*").values()]
+    config = task.config.cullPeaks
+    kept = []
+    for parentSource in catalog:
+        oldPeaks = list(parentSource.getFootprint().getPeaks())
+        familySize = len(oldPeaks)
+        keptIds = []
+        for rank, peak in enumerate(oldPeaks):
+            if ((rank < config.rankSufficient) or
+                (sum([peak.get(k) for k in keys]) >= config.nBandsSufficient) or
+                (rank < config.rankConsidered and
+                 rank < config.rankNormalizedConsidered * familySize)):
+                keptIds.append(peak.getId())
+        kept.append(keptIds)
+    return kept
+
+
+class CullPeaksTestCase(lsst.utils.tests.TestCase):
+    """Test that cullPeaks keeps the same peaks as the original per-peak implementation"""
+
+    def setUp(self):
+        resetFilters()
+        for name, wavelength in (("g", 487), ("r", 625), ("i", 770)):
+            defineFilter(name, wavelength)
+        config = MergeDetectionsConfig()
+        config.priorityList = ["i", "r", "g"]
+        config.cullPeaks.rankSufficient = 3
+        config.cullPeaks.rankConsidered = 8
+        config.cullPeaks.rankNormalizedConsidered = 0.5
+        config.cullPeaks.nBandsSufficient = 2
+        self.task = MergeDetectionsTask(schema=afwTable.SourceTable.makeMinimalSchema(), config=config)
+
+    def tearDown(self):
+        del self.task
+        resetFilters()
+
+    def makeCatalog(self, familySizes, seed=12345):
+        """Make a merged catalog with a footprint of each of the given numbers of peaks
+
+        Peaks are flagged as detected in random bands (including the sky "band" of new peaks), and
+        peak values are drawn from a few levels so that many peaks in a family tie.
+        """
+        rng = np.random.RandomState(seed)
+        peakSchema = self.task.merged.getPeakSchema()
+        keys = [item.key for item in peakSchema.extract("merge_peak_*").values()]
+        catalog = afwTable.SourceCatalog(self.task.schema)
+        peakId = 1
+        for size in familySizes:
+            bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(50, 50))
+            footprint = afwDetect.Footprint(afwGeom.SpanSet(bbox), peakSchema)
+            for i in range(size):
+                footprint.addPeak(rng.randint(50), rng.randint(50), float(rng.choice([10.0, 5.0, 5.0])))
+                peak = footprint.getPeaks()[-1]
+                peak.setId(peakId)
+                peakId += 1
+                for k in keys:
+                    peak.set(k, bool(rng.uniform() < 0.4))
+            catalog.addNew().setFootprint(footprint)
+        return catalog
+
+    def checkCull(self, familySizes):
+        catalog = self.makeCatalog(familySizes)
+        expected = cullPeaksLoop(self.task, catalog)
+        self.task.cullPeaks(catalog)
+        self.assertEqual([[peak.getId() for peak in source.getFootprint().getPeaks()] for source in catalog],
+                         expected)
+        return expected
+
+    def testCullPeaks(self):
+        # Family sizes of 16 put rankNormalizedConsidered*familySize exactly at rankConsidered, and
+        # sizes of 6 and 7 put it at and just above the rank of a peak.
+        familySizes = [0, 1, 2, 3, 4, 6, 7, 10, 15, 16, 17, 30, 45]
+        expected = self.checkCull(familySizes)
+        self.assertLess(sum(len(ids) for ids in expected), sum(familySizes))  # Some peaks were culled
+
+    def testNoPeaks(self):
+        self.checkCull([0, 0])
+        self.checkCull([])
+
+    def testNoneCulled(self):
+        self.checkCull([1, 2, 3])
+
+
+class DummyPatchInfo(object):
+    """Just enough of a PatchInfo for placing sky objects"""
+
+    def __init__(self, outerBBox):
+        self.outerBBox = outerBBox
+
+    def getOuterBBox(self):
+        return self.outerBBox
+
+
+class BinnedSkyObjectsTestCase(lsst.utils.tests.TestCase):
+    """Test the placement of sky objects with a binned occupancy grid"""
+
+    def setUp(self):
+        resetFilters()
+        defineFilter("r", 625)
+        config = MergeDetectionsConfig()
+        config.priorityList = ["r"]
+        config.doBinnedSkyObjects = True
+        config.skyObjectsBinSize = 8
+        config.skyObjects.nSources = 30
+        config.skyObjects.sourceRadius = 6
+        config.skyObjects.growMask = 3
+        config.skyObjects.nTrialSources = 2000
+        self.task = MergeDetectionsTask(schema=afwTable.SourceTable.makeMinimalSchema(), config=config)
+        # Not aligned with the grid, so partial cells are exercised
+        self.bbox = afwGeom.Box2I(afwGeom.Point2I(100, 200), afwGeom.Extent2I(403, 301))
+        self.skyInfo = pipeBase.Struct(patchInfo=DummyPatchInfo(self.bbox))
+
+    def tearDown(self):
+        del self.task
+        resetFilters()
+
+    def makeMergedList(self, shapes):
+        """Make a catalog of sources with Footprints of the given (radius, x, y) circles"""
+        catalog = afwTable.SourceCatalog(self.task.schema)
+        for radius, x, y in shapes:
+            footprint = afwDetect.Footprint(afwGeom.SpanSet.fromShape(radius, offset=(x, y)),
+                                            self.task.merged.getPeakSchema())
+            footprint.addPeak(x, y, 1.0)
+            catalog.addNew().setFootprint(footprint)
+        return catalog
+
+    def makeMergedListRandom(self, num, maxRadius=25, seed=12345):
+        rng = np.random.RandomState(seed)
+        return self.makeMergedList([(int(rng.randint(1, maxRadius)),
+                                     int(rng.randint(self.bbox.getMinX() - 20, self.bbox.getMaxX() + 20)),
+                                     int(rng.randint(self.bbox.getMinY() - 20, self.bbox.getMaxY() + 20)))
+                                    for _ in range(num)])
+
+    def testOccupancyGrid(self):
+        """The occupancy grid matches binning a rasterized mask of the Footprints"""
+        mergedList = self.makeMergedListRandom(40)
+        binSize = self.task.config.skyObjectsBinSize
+        grid = self.task.makeOccupancyGrid(mergedList, self.bbox, binSize)
+        pixels = np.zeros((self.bbox.getHeight(), self.bbox.getWidth()), dtype=bool)
+        for source in mergedList:
+            for span in source.getFootprint().spans:
+                y = span.getY() - self.bbox.getMinY()
+                if y < 0 or y >= self.bbox.getHeight():
+                    continue
+                pixels[y, max(span.getMinX() - self.bbox.getMinX(), 0):
+                       max(span.getMaxX() - self.bbox.getMinX() + 1, 0)] = True
+        ny, nx = grid.shape
+        self.assertEqual(grid.shape, ((self.bbox.getHeight() + binSize - 1)//binSize,
+                                      (self.bbox.getWidth() + binSize - 1)//binSize))
+        expected = np.array([[pixels[j*binSize:(j + 1)*binSize, i*binSize:(i + 1)*binSize].any()
+                              for i in range(nx)] for j in range(ny)])
+        self.assertTrue(np.all(grid == expected))
+        self.assertFalse(np.any(self.task.makeOccupancyGrid(self.makeMergedList([]), self.bbox, binSize)))
+
+    def testDilateGrid(self):
+        """_dilateGrid matches a brute-force dilation by a square"""
+        rng = np.random.RandomState(12345)
+        grid = rng.uniform(size=(23, 31)) < 0.03
+        grid[0, 0] = grid[-1, -1] = True
+        for nGrow in (0, 1, 2, 5, 40):
+            expected = np.zeros_like(grid)
+            for j, i in zip(*np.nonzero(grid)):
+                expected[max(j - nGrow, 0):j + nGrow + 1, max(i - nGrow, 0):i + nGrow + 1] = True
+            self.assertTrue(np.all(_dilateGrid(grid, nGrow) == expected))
+        dilated = _dilateGrid(grid, 0)
+        dilated[:] = False
+        self.assertTrue(grid.any())  # A copy, not a view
+
+    def checkSkyObjects(self, mergedList, seed=1):
+        """Check that sky objects avoid the (grown) detections and each other
+
+        @return list of sky object Footprints
+        """
+        skyConfig = self.task.config.skyObjects
+        footprints = self.task.getSkySourceFootprints(mergedList, self.skyInfo, seed)
+        self.assertLessEqual(len(footprints), skyConfig.nSources)
+        detected = [source.getFootprint().spans.dilated(skyConfig.growMask) for source in mergedList]
+        for i, footprint in enumerate(footprints):
+            self.assertEqual(len(footprint.getPeaks()), 1)
+            self.assertTrue(footprint.getPeaks()[0].get("merge_peak_%s" % self.task.config.skyFilterName))
+            self.assertTrue(self.bbox.contains(footprint.getBBox()))
+            for spans in detected:
+                self.assertFalse(footprint.spans.overlaps(spans))
+            for other in footprints[:i]:
+                self.assertFalse(footprint.spans.overlaps(other.spans))
+        return footprints
+
+    def testSkyObjects(self):
+        mergedList = self.makeMergedListRandom(15, maxRadius=15)
+        footprints = self.checkSkyObjects(mergedList)
+        self.assertEqual(len(footprints), self.task.config.skyObjects.nSources)
+        # More requested than fit between the detections
+        self.task.config.skyObjects.nSources = 1000
+        footprints = self.checkSkyObjects(mergedList, seed=2)
+        self.assertGreater(len(footprints), 0)
+        self.assertLess(len(footprints), 1000)
+
+    def testFullyOccupied(self):
+        """No sky objects are placed on a patch covered by detections"""
+        center = afwGeom.Box2D(self.bbox).getCenter()
+        mergedList = self.makeMergedList([(400, int(center.getX()), int(center.getY()))])
+        self.assertTrue(self.task.makeOccupancyGrid(mergedList, self.bbox,
+                                                    self.task.config.skyObjectsBinSize).all())
+        self.assertEqual(self.checkSkyObjects(mergedList), [])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
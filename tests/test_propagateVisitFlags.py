@@ -0,0 +1,321 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.detection as afwDetect
+import lsst.afw.geom as afwGeom
+import lsst.afw.table as afwTable
+from lsst.pipe.tasks.propagateVisitFlags import (PropagateVisitFlagsConfig, PropagateVisitFlagsTask,
+                                                 countInputOverlaps)
+
+
+def makeWcs(crval, orientation, distortion=0.0):
+    """Make a TAN WCS, or a TAN-SIP WCS with quadratic distortion if distortion is non-zero"""
+    cdMatrix = afwGeom.makeCdMatrix(scale=0.2*afwGeom.arcseconds, orientation=orientation*afwGeom.degrees)
+    crpix = afwGeom.Point2D(100, 100)
+    if distortion == 0.0:
+        return afwGeom.makeSkyWcs(crpix=crpix, crval=crval, cdMatrix=cdMatrix)
+    sipA = np.zeros((3, 3))
+    sipB = np.zeros((3, 3))
+    sipA[0, 2] = distortion  # x offset proportional to y**2, so edges of constant x are curved
+    sipB[2, 0] = -distortion
+    sipA[1, 1] = 0.5*distortion
+    return afwGeom.makeTanSipWcs(crpix, crval, cdMatrix, sipA, sipB)
+
+
+class CountInputOverlapsTestCase(lsst.utils.tests.TestCase):
+    """Test that countInputOverlaps matches ExposureCatalog.subsetContaining"""
+
+    def setUp(self):
+        np.random.seed(12345)
+        center = afwGeom.SpherePoint(150, 2, afwGeom.degrees)
+        self.coaddWcs = makeWcs(center, 0.0)
+        self.ccdInputs = afwTable.ExposureCatalog(afwTable.ExposureTable.makeMinimalSchema())
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(200, 200))
+        for i, (offset, orientation) in enumerate([((0, 0), 0.0), ((30, 20), 15.0), ((-40, 10), -30.0)]):
+            record = self.ccdInputs.addNew()
+            record.setId(i)
+            record.setBBox(bbox)
+            crval = afwGeom.SpherePoint(150 + offset[0]*0.2/3600, 2 + offset[1]*0.2/3600, afwGeom.degrees)
+            record.setWcs(makeWcs(crval, orientation))
+            if i > 0:
+                # Cut off one corner of the CCD
+                vertices = [afwGeom.Point2D(0, 0), afwGeom.Point2D(200, 0), afwGeom.Point2D(200, 120),
+                            afwGeom.Point2D(120, 200), afwGeom.Point2D(0, 200)]
+                record.setValidPolygon(afwGeom.Polygon(vertices))
+        self.x = np.random.uniform(-150, 350, 2000)
+        self.y = np.random.uniform(-150, 350, 2000)
+
+    def tearDown(self):
+        del self.coaddWcs
+        del self.ccdInputs
+
+    def testOverlaps(self):
+        for includeValidPolygon in (True, False):
+            counts = countInputOverlaps(self.ccdInputs, self.coaddWcs, self.x, self.y,
+                                        includeValidPolygon=includeValidPolygon)
+            expected = [len(self.ccdInputs.subsetContaining(afwGeom.Point2D(x, y), self.coaddWcs,
+                                                            includeValidPolygon))
+                        for x, y in zip(self.x, self.y)]
+            self.assertEqual(counts.tolist(), expected)
+
+    def testDistortedWcs(self):
+        """Points close to the edges of inputs with distorted WCSs are counted exactly"""
+        ccdPoints = []
+        for i, record in enumerate(self.ccdInputs):
+            record.setWcs(makeWcs(record.getWcs().getSkyOrigin(), 10.0*i, distortion=3.0e-4))
+            # Points within a fraction of a pixel of the edges of the bounding box
+            along = np.random.uniform(0, 200, 1000)
+            across = np.random.uniform(-0.3, 0.3, 1000)
+            side = np.random.randint(0, 4, 1000)
+            xCcd = np.where(side == 0, across, np.where(side == 1, 200 + across, along))
+            yCcd = np.where(side == 2, across, np.where(side == 3, 200 + across, along))
+            coaddPoints = self.coaddWcs.skyToPixel(record.getWcs().pixelToSky(
+                [afwGeom.Point2D(xx, yy) for xx, yy in zip(xCcd, yCcd)]))
+            ccdPoints += [tuple(point) for point in coaddPoints]
+        x = np.concatenate([self.x, [point[0] for point in ccdPoints]])
+        y = np.concatenate([self.y, [point[1] for point in ccdPoints]])
+        for includeValidPolygon in (True, False):
+            expected = [len(self.ccdInputs.subsetContaining(afwGeom.Point2D(xx, yy), self.coaddWcs,
+                                                            includeValidPolygon))
+                        for xx, yy in zip(x, y)]
+            counts = countInputOverlaps(self.ccdInputs, self.coaddWcs, x, y,
+                                        includeValidPolygon=includeValidPolygon)
+            self.assertEqual(counts.tolist(), expected)
+            # Without the exact test, the polygons don't follow the distortion well enough
+            counts = countInputOverlaps(self.ccdInputs, self.coaddWcs, x, y,
+                                        includeValidPolygon=includeValidPolygon,
+                                        edgeSubdivisions=1, edgeMargin=0.0)
+            self.assertNotEqual(counts.tolist(), expected)
+
+    def testEmpty(self):
+        counts = countInputOverlaps(self.ccdInputs, self.coaddWcs, [], [])
+        self.assertEqual(len(counts), 0)
+
+
+class DataIdButler(object):
+    """A butler that only serves the "src" catalogs of a dict indexed by (visit, ccd)
+
+    The data IDs and flags of all reads are recorded in "reads".  Catalogs read with
+    afwTable.SOURCE_IO_NO_FOOTPRINTS have no footprints.
+    """
+
+    def __init__(self, catalogs):
+        self.catalogs = catalogs
+        self.reads = []
+
+    def get(self, datasetType, visit, ccd, immediate=False, flags=0):
+        assert datasetType == "src"
+        self.reads.append((visit, ccd, flags))
+        catalog = self.catalogs[(visit, ccd)].copy(deep=True)
+        if flags & afwTable.SOURCE_IO_NO_FOOTPRINTS:
+            for source in catalog:
+                source.setFootprint(None)
+        return catalog
+
+
+def propagateVisitFlagsLoop(task, butler, coaddSources, ccdInputs, coaddWcs):
+    """Return the flags set by the original implementation of PropagateVisitFlagsTask.run,
+    which matched each input catalog once per flag
+
+    @return list of tuples of the flags (in the order of task.config.flags) for each source
+    """
+    flags = list(task.config.flags.keys())
+    radius = task.config.matchRadius*afwGeom.arcseconds
+    counts = dict((f, np.zeros(len(coaddSources), dtype=int)) for f in flags)
+    indices = np.array([s.getId() for s in coaddSources])
+    for ccdRecord in ccdInputs:
+        ccdSources = butler.get("src", visit=int(ccdRecord.get("visit")), ccd=int(ccdRecord.get("ccd")),
+                                immediate=True)
+        for sourceRecord in ccdSources:
+            sourceRecord.updateCoord(ccdRecord.getWcs())
+        for flag in flags:
+            mc = afwTable.MatchControl()
+            mc.findOnlyClosest = False
+            matches = afwTable.matchRaDec(coaddSources, ccdSources[ccdSources.get(flag)], radius, mc)
+            for m in matches:
+                index = (np.where(indices == m.first.getId()))[0][0]
+                counts[flag][index] += 1
+    results = []
+    for i, s in enumerate(coaddSources):
+        numOverlaps = len(ccdInputs.subsetContaining(s.getCentroid(), coaddWcs, True))
+        results.append(tuple(bool(counts[f][i] > numOverlaps*task.config.flags[f]) for f in flags))
+    return results
+
+
+class PropagateVisitFlagsTestCase(lsst.utils.tests.TestCase):
+    """Test PropagateVisitFlagsTask on simulated coadd and input catalogs"""
+
+    def setUp(self):
+        rng = np.random.RandomState(12345)
+        center = afwGeom.SpherePoint(150, 2, afwGeom.degrees)
+        self.coaddWcs = makeWcs(center, 0.0)
+        self.flags = {"calib_psfCandidate": 0.2, "calib_psfUsed": 0.5}
+
+        ccdSchema = afwTable.ExposureTable.makeMinimalSchema()
+        ccdSchema.addField("visit", type=np.int64, doc="visit identifier")
+        ccdSchema.addField("ccd", type=np.int32, doc="ccd identifier")
+        self.ccdInputs = afwTable.ExposureCatalog(ccdSchema)
+        bbox = afwGeom.Box2I(afwGeom.Point2I(0, 0), afwGeom.Extent2I(200, 200))
+        inputs = [(1, 1, (0, 0), 0.0), (1, 2, (30, 20), 15.0), (2, 1, (-40, 10), -30.0)]
+        for i, (visit, ccd, offset, orientation) in enumerate(inputs):
+            record = self.ccdInputs.addNew()
+            record.setId(i)
+            record.set("visit", visit)
+            record.set("ccd", ccd)
+            record.setBBox(bbox)
+            crval = afwGeom.SpherePoint(150 + offset[0]*0.2/3600, 2 + offset[1]*0.2/3600, afwGeom.degrees)
+            record.setWcs(makeWcs(crval, orientation))
+
+        # Coadd sources, with non-contiguous ids in no particular order
+        coaddSchema = afwTable.SourceTable.makeMinimalSchema()
+        centroidKey = afwTable.Point2DKey.addFields(coaddSchema, "centroid", "centroid", "pixel")
+        coaddSchema.getAliasMap().set("slot_Centroid", "centroid")
+        self.coaddSchema = coaddSchema
+        self.coaddSources = afwTable.SourceCatalog(coaddSchema)
+        for sourceId in rng.permutation(np.arange(300)*3 + 1000):
+            source = self.coaddSources.addNew()
+            source.setId(int(sourceId))
+            position = afwGeom.Point2D(rng.uniform(-100, 300), rng.uniform(-100, 300))
+            source.set(centroidKey, position)
+            source.setCoord(self.coaddWcs.pixelToSky(position))
+
+        # Input sources at the positions of the coadd sources they overlap (sometimes twice), plus some
+        # flagged sources that don't match anything
+        inputSchema = afwTable.SourceTable.makeMinimalSchema()
+        inputCentroidKey = afwTable.Point2DKey.addFields(inputSchema, "centroid", "centroid", "pixel")
+        inputSchema.getAliasMap().set("slot_Centroid", "centroid")
+        flagKeys = [inputSchema.addField(f, type="Flag", doc="flag to propagate") for f in sorted(self.flags)]
+        inputSchema.addField("calib_other", type="Flag", doc="flag not propagated")
+        catalogs = {}
+        for ccdRecord in self.ccdInputs:
+            wcs = ccdRecord.getWcs()
+            catalog = afwTable.SourceCatalog(inputSchema)
+            positions = [wcs.skyToPixel(coaddSource.getCoord()) for coaddSource in self.coaddSources]
+            positions += [afwGeom.Point2D(x, y) for x, y in rng.uniform(0, 200, (20, 2))]
+            for position in positions:
+                if not afwGeom.Box2D(ccdRecord.getBBox()).contains(position):
+                    continue
+                for _ in range(2 if rng.uniform() < 0.2 else 1):
+                    source = catalog.addNew()
+                    source.set(inputCentroidKey, position + afwGeom.Extent2D(*rng.uniform(-0.3, 0.3, 2)))
+                    for key in flagKeys:
+                        source.set(key, bool(rng.uniform() < 0.3))
+                    source.setFootprint(afwDetect.Footprint(afwGeom.SpanSet.fromShape(
+                        3, offset=afwGeom.Point2I(source.getCentroid()))))
+            catalogs[(int(ccdRecord.get("visit")), int(ccdRecord.get("ccd")))] = catalog
+        self.butler = DataIdButler(catalogs)
+
+    def tearDown(self):
+        del self.coaddWcs
+        del self.ccdInputs
+        del self.coaddSources
+        del self.butler
+
+    def makeTask(self, **kwargs):
+        config = PropagateVisitFlagsConfig()
+        config.flags = self.flags
+        for name, value in kwargs.items():
+            setattr(config, name, value)
+        return PropagateVisitFlagsTask(schema=afwTable.Schema(self.coaddSchema), config=config)
+
+    def runTask(self, task):
+        """Run the task on a copy of the coadd sources, and return their propagated flags"""
+        coaddSources = self.coaddSources.copy(deep=True)
+        mapper = afwTable.SchemaMapper(coaddSources.schema)
+        mapper.addMinimalSchema(coaddSources.schema, True)
+        outputSources = afwTable.SourceCatalog(task.schema)
+        outputSources.extend(coaddSources, mapper=mapper)
+        task.run(self.butler, outputSources, self.ccdInputs, self.coaddWcs)
+        return [tuple(source.get(f) for f in task.config.flags.keys()) for source in outputSources]
+
+    def testMatchOnce(self):
+        """Matching once per input catalog sets the same flags as matching once per flag"""
+        task = self.makeTask()
+        expected = propagateVisitFlagsLoop(task, self.butler, self.coaddSources, self.ccdInputs,
+                                           self.coaddWcs)
+        self.assertEqual(self.runTask(task), expected)
+        for i in range(len(self.flags)):
+            values = set(flags[i] for flags in expected)
+            self.assertEqual(values, set([True, False]))
+
+    def testProjectedRead(self):
+        """Projected reads without footprints set the same flags as full reads"""
+        expected = self.runTask(self.makeTask())
+        self.assertTrue(all(flags == 0 for _, _, flags in self.butler.reads))
+        self.butler.reads = []
+        self.assertEqual(self.runTask(self.makeTask(doProjectedRead=True)), expected)
+        self.assertEqual(len(self.butler.reads), len(self.ccdInputs))
+        self.assertTrue(all(flags & afwTable.SOURCE_IO_NO_FOOTPRINTS for _, _, flags in self.butler.reads))
+
+    def readProjected(self, task, dataIds):
+        """Read the projected catalogs of the given (visit, ccd) in turn
+
+        @return list of the (visit, ccd) that were read through the butler
+        """
+        flags = list(task.config.flags.keys())
+        wcs = self.ccdInputs[0].getWcs()
+        self.butler.reads = []
+        for visit, ccd in dataIds:
+            catalog = task.readProjectedSources(self.butler, visit, ccd, wcs, flags)
+            self.assertEqual(set(catalog.schema.getNames()),
+                             set(afwTable.SourceTable.makeMinimalSchema().getNames()) | set(flags))
+        return [(visit, ccd) for visit, ccd, _ in self.butler.reads]
+
+    def testCcdCache(self):
+        """Projected catalogs are cached, evicting the least recently used"""
+        task = self.makeTask(doProjectedRead=True, ccdCacheSize=2)
+        reads = self.readProjected(task, [(1, 1), (1, 2), (1, 1), (2, 1)])
+        self.assertEqual(reads, [(1, 1), (1, 2), (2, 1)])
+        # (1, 1) was used more recently than (1, 2), so (1, 2) was evicted
+        self.assertEqual(list(task._ccdCache.keys()), [(1, 1), (2, 1)])
+        self.assertEqual(self.readProjected(task, [(2, 1), (1, 1), (1, 2)]), [(1, 2)])
+        self.assertEqual(list(task._ccdCache.keys()), [(1, 1), (1, 2)])
+
+        # Cached catalogs give the same results for subsequent patches
+        task = self.makeTask(doProjectedRead=True, ccdCacheSize=len(self.ccdInputs))
+        expected = self.runTask(task)
+        self.butler.reads = []
+        self.assertEqual(self.runTask(task), expected)
+        self.assertEqual(self.butler.reads, [])
+
+    def testNoCcdCache(self):
+        """Nothing is cached with ccdCacheSize=0"""
+        task = self.makeTask(doProjectedRead=True, ccdCacheSize=0)
+        self.assertEqual(self.readProjected(task, [(1, 1), (1, 1), (1, 2)]), [(1, 1), (1, 1), (1, 2)])
+        self.assertEqual(len(task._ccdCache), 0)
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
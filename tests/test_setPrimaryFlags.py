@@ -0,0 +1,173 @@
+#
+# LSST Data Management System
+# Copyright 2018 LSST Corporation.
+#
+# This product includes software developed by the
+# LSST Project (http://www.lsst.org/).
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the LSST License Statement and
+# the GNU General Public License along with this program.  If not,
+# see <http://www.lsstcorp.org/LegalNotices/>.
+#
+import unittest
+
+import numpy as np
+
+import lsst.utils.tests
+import lsst.afw.table as afwTable
+from lsst.afw.geom import Box2D, Point2D, SpherePoint, degrees, radians
+from lsst.skymap import DiscreteSkyMap
+from lsst.pipe.tasks.setPrimaryFlags import SetPrimaryFlagsTask, findTractIds
+
+
+class ReversedSkyMap(DiscreteSkyMap):
+    """A sky map that overrides findTract, resolving ties in favor of the last tract"""
+
+    def findTract(self, coord):
+        distances = [tractInfo.getCtrCoord().separation(coord).asRadians() for tractInfo in self]
+        return self[len(distances) - 1 - int(np.argmin(distances[::-1]))]
+
+
+class FindTractIdsTestCase(lsst.utils.tests.TestCase):
+    """Test that findTractIds matches skyMap.findTract"""
+
+    def setUp(self):
+        self.config = DiscreteSkyMap.ConfigClass()
+        # Tracts 0 and 1 are at the same declination, so positions at ra=11 are equidistant from them,
+        # and (12, 1) is equidistant from tracts 1 and 3.
+        self.config.raList = [10.0, 12.0, 14.0, 12.0]
+        self.config.decList = [0.0, 0.0, 1.0, 2.0]
+        self.config.radiusList = [1.5]*4
+
+        np.random.seed(12345)
+        ra = list(np.random.uniform(9.0, 15.0, 500))
+        dec = list(np.random.uniform(-1.5, 3.0, 500))
+        for d in (-1.0, -0.3, 0.0, 0.4, 1.2):
+            ra.append(11.0)
+            dec.append(d)
+        # Midpoints between pairs of tract centers
+        center = [SpherePoint(r, d, degrees) for r, d in zip(self.config.raList, self.config.decList)]
+        for i, j in ((1, 3), (2, 3), (1, 2)):
+            midpoint = center[i].offset(center[i].bearingTo(center[j]), 0.5*center[i].separation(center[j]))
+            ra.append(midpoint.getRa().asDegrees())
+            dec.append(midpoint.getDec().asDegrees())
+        ra.append(12.0)
+        dec.append(1.0)
+        self.ra = np.radians(ra)
+        self.dec = np.radians(dec)
+
+    def checkSkyMap(self, skyMap, maxPairs=10000000):
+        tractIds = findTractIds(skyMap, self.ra, self.dec, maxPairs=maxPairs)
+        expected = [skyMap.findTract(SpherePoint(r, d, radians)).getId() for r, d in zip(self.ra, self.dec)]
+        self.assertEqual(list(tractIds), expected)
+        return tractIds
+
+    def testDiscreteSkyMap(self):
+        skyMap = DiscreteSkyMap(self.config)
+        tractIds = self.checkSkyMap(skyMap)
+        self.assertEqual(set(tractIds), set(range(len(skyMap))))
+        self.checkSkyMap(skyMap, maxPairs=len(skyMap)*7)  # Several chunks
+
+    def testOverriddenFindTract(self):
+        self.checkSkyMap(ReversedSkyMap(self.config))
+
+    def testSingleTract(self):
+        config = DiscreteSkyMap.ConfigClass()
+        config.raList = [12.0]
+        config.decList = [1.0]
+        config.radiusList = [3.0]
+        self.assertEqual(set(findTractIds(DiscreteSkyMap(config), self.ra, self.dec)), set([0]))
+
+
+def setPrimaryFlagsLoop(task, sources, skyMap, tractInfo, patchInfo):
+    """Return the flags set by the original per-source implementation of SetPrimaryFlagsTask.run
+
+    @return list of (isPatchInner, isTractInner, isPrimary) for each source
+    """
+    innerFloatBBox = Box2D(patchInfo.getInnerBBox())
+    shrunkInnerFloatBBox = Box2D(innerFloatBBox)
+    shrunkInnerFloatBBox.grow(-1)
+    nChildKey = task.schema.find(task.config.nChildKeyName).key
+    flags = []
+    for source in sources:
+        centroidPos = source.getCentroid()
+        if np.any(np.isnan(centroidPos)):
+            flags.append((False, False, False))
+            continue
+        if source.getCentroidFlag():
+            isPatchInner = shrunkInnerFloatBBox.contains(centroidPos)
+        else:
+            isPatchInner = innerFloatBBox.contains(centroidPos)
+        isTractInner = skyMap.findTract(source.getCoord()).getId() == tractInfo.getId()
+        isPrimary = source.get(nChildKey) == 0 and isPatchInner and isTractInner
+        flags.append((isPatchInner, isTractInner, isPrimary))
+    return flags
+
+
+class SetPrimaryFlagsTestCase(lsst.utils.tests.TestCase):
+    """Test that SetPrimaryFlagsTask sets the same flags as the original per-source implementation"""
+
+    def testFlags(self):
+        config = DiscreteSkyMap.ConfigClass()
+        config.raList = [10.0, 10.8]
+        config.decList = [0.0, 0.0]
+        config.radiusList = [0.5, 0.5]
+        config.patchInnerDimensions = [2000, 2000]
+        skyMap = DiscreteSkyMap(config)
+        tractInfo = skyMap[0]
+        wcs = tractInfo.getWcs()
+        patchInfo = tractInfo.getPatchInfo(tractInfo.findPatch(tractInfo.getCtrCoord()).getIndex())
+        inner = Box2D(patchInfo.getInnerBBox())
+
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        centroidKey = afwTable.Point2DKey.addFields(schema, "centroid", "centroid", "pixel")
+        flagKey = schema.addField("centroid_flag", type="Flag", doc="centroid failed")
+        schema.getAliasMap().set("slot_Centroid", "centroid")
+        nChildKey = schema.addField("deblend_nChild", type=np.int32, doc="number of children")
+        task = SetPrimaryFlagsTask(schema=schema)
+        sources = afwTable.SourceCatalog(schema)
+
+        center = inner.getCenter()
+        positions = [center, Point2D(inner.getMinX(), center.getY()), Point2D(inner.getMaxX(), center.getY()),
+                     Point2D(inner.getMinX() + 0.5, center.getY()), Point2D(np.inf, center.getY()),
+                     Point2D(center.getX(), -np.inf), Point2D(np.nan, center.getY())]
+        for position in positions:
+            for centroidFlag in (False, True):
+                for nChild in (0, 2):
+                    for coord in (wcs.pixelToSky(center), skyMap[1].getCtrCoord()):
+                        source = sources.addNew()
+                        source.set(centroidKey, position)
+                        source.set(flagKey, centroidFlag)
+                        source.set(nChildKey, nChild)
+                        source.setCoord(coord)
+
+        expected = setPrimaryFlagsLoop(task, sources, skyMap, tractInfo, patchInfo)
+        task.run(sources, skyMap, tractInfo, patchInfo)
+        flags = [(source.get(task.isPatchInnerKey), source.get(task.isTractInnerKey),
+                  source.get(task.isPrimaryKey)) for source in sources]
+        self.assertEqual(flags, expected)
+        # Infinite centroids are flagged as tract inner, but not patch inner
+        self.assertIn((False, True, False), flags[4*8:6*8])
+
+
+class MemoryTester(lsst.utils.tests.MemoryTestCase):
+    pass
+
+
+def setup_module(module):
+    lsst.utils.tests.init()
+
+
+if __name__ == "__main__":
+    lsst.utils.tests.init()
+    unittest.main()
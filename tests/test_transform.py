@@ -51,11 +51,13 @@ import lsst.afw.table as afwTable
 import lsst.afw.geom as afwGeom
 import lsst.daf.persistence as dafPersist
 import lsst.meas.base as measBase
+import lsst.pipe.base as pipeBase
 import lsst.utils.tests
 from lsst.pipe.tasks.multiBand import MeasureMergedCoaddSourcesConfig
 from lsst.pipe.tasks.processCcd import ProcessCcdTask, ProcessCcdConfig
 from lsst.pipe.tasks.transformMeasurement import (TransformConfig, TransformTask, SrcTransformTask,
-                                                  RunTransformConfig, CoaddSrcTransformTask)
+                                                  RunTransformConfig, RunTransformTaskBase,
+                                                  CoaddSrcTransformTask)
 
 PLUGIN_NAME = "base_TrivialMeasurement"
 
@@ -186,6 +188,37 @@ class TransformTestCase(lsst.utils.tests.TestCase):
                                       inputSchema=sfmTask.schema, outputDataset="src")
         self._transformAndCheck(sfmConfig, sfmTask.schema, transformTask)
 
+    def testBatchTransform(self):
+        """Test transforming several catalogs at once into a single contiguous catalog."""
+        schema = afwTable.SourceTable.makeMinimalSchema()
+        sfmConfig = measBase.SingleFrameMeasurementConfig(plugins=[PLUGIN_NAME])
+        for key in sfmConfig.slots:
+            setattr(sfmConfig.slots, key, None)
+        sfmTask = measBase.SingleFrameMeasurementTask(schema, config=sfmConfig)
+        transformTask = TransformTask(measConfig=sfmConfig,
+                                      inputSchema=sfmTask.schema, outputDataset="src")
+
+        inputs = []
+        for numSources in (3, 0, 5):
+            inCat = afwTable.SourceCatalog(sfmTask.schema)
+            for i in range(numSources):
+                r = inCat.addNew()
+                r.setCoord(afwGeom.SpherePoint(0.1*i, 11.19, afwGeom.degrees))
+                r[PLUGIN_NAME] = float(len(inputs) + i)
+            inputs.append((inCat, Placeholder(), Placeholder()))
+
+        outCat = transformTask.runBatch(inputs)
+        self.assertTrue(outCat.isContiguous())
+        inSrcs = [inSrc for inCat, _, _ in inputs for inSrc in inCat]
+        self.assertEqual(len(outCat), len(inSrcs))
+        for inSrc, outSrc in zip(inSrcs, outCat):
+            self.assertEqual(outSrc[PLUGIN_NAME], inSrc[PLUGIN_NAME])
+            self.assertEqual(outSrc[PLUGIN_NAME + "_transform"], inSrc[PLUGIN_NAME] * -1.0)
+            self.assertEqual(outSrc.get("id"), inSrc.get("id"))
+        for _, wcs, calib in inputs:
+            self.assertEqual(wcs.count, len(transformTask.transforms))
+            self.assertEqual(calib.count, len(transformTask.transforms))
+
     def testForcedMeasurementTransform(self):
         """Test applying a transform task to the results of forced measurement."""
         schema = afwTable.SourceTable.makeMinimalSchema()
@@ -250,6 +283,10 @@ class RunTransformTestCase(lsst.utils.tests.TestCase):
             # configuration/metadata persistence.
             trResult = SrcTransformTask.parseAndRun(args=trArgs, doReturnResults=True)
 
+            # Reading the full calexp rather than only its header should make no difference.
+            fullArgs = trArgs + ["--clobber-config", "-c", "doReadCalexpHeader=False"]
+            fullResult = SrcTransformTask.parseAndRun(args=fullArgs, doReturnResults=True)
+
         measSrcs = measResult.resultList[0].result.calibRes.sourceCat
         trSrcs = trResult.resultList[0].result
 
@@ -270,6 +307,74 @@ class RunTransformTestCase(lsst.utils.tests.TestCase):
             self.assertAlmostEqual(measSrc.getCoord().getLongitude(), trCoord.getLongitude())
             self.assertAlmostEqual(measSrc.getCoord().getLatitude(), trCoord.getLatitude())
 
+        fullSrcs = fullResult.resultList[0].result
+        self.assertEqual(len(fullSrcs), len(trSrcs))
+        for fullSrc, trSrc in zip(fullSrcs, trSrcs):
+            fullCoord = afwTable.CoordKey(fullSrcs.schema["base_SdssCentroid"]).get(fullSrc)
+            trCoord = afwTable.CoordKey(trSrcs.schema["base_SdssCentroid"]).get(trSrc)
+            self.assertAlmostEqual(fullCoord.getLongitude(), trCoord.getLongitude())
+            self.assertAlmostEqual(fullCoord.getLatitude(), trCoord.getLatitude())
+
+
+class DataIdButler:
+    """A minimal butler whose data references are their data IDs"""
+
+    def dataRef(self, datasetType, dataId):
+        return dataId
+
+
+class DummyTransformTask(RunTransformTaskBase):
+    """A transform task which writes a file for each data ID, and fails for some of them
+
+    Visit 2 raises an exception, and visit 3 kills its process (as if it were killed for running out
+    of memory).
+    """
+    _DefaultName = "dummyTransform"
+    sourceType = "src"
+
+    def __init__(self, outputDir):
+        pipeBase.CmdLineTask.__init__(self, config=RunTransformConfig())
+        self.butler = DataIdButler()
+        self.outputDir = outputDir
+
+    def run(self, dataRef):
+        if dataRef["visit"] == 2:
+            raise RuntimeError("Transform failed")
+        if dataRef["visit"] == 3:
+            os._exit(1)
+        with open(os.path.join(self.outputDir, "%(visit)d.txt" % dataRef), "w") as ff:
+            ff.write("transformed")
+        return [None]*dataRef["visit"]
+
+
+class RunDataIdsTestCase(lsst.utils.tests.TestCase):
+    """Test that failures to transform some data IDs don't prevent the transformation of others"""
+
+    def checkRunDataIds(self, visits, numProcesses, maxTasksPerChild=None):
+        with tempDirectory() as tempDir:
+            task = DummyTransformTask(tempDir)
+            results = task.runDataIds([dict(visit=visit) for visit in visits], numProcesses=numProcesses,
+                                      maxTasksPerChild=maxTasksPerChild)
+            self.assertEqual([result.dataId["visit"] for result in results], visits)
+            for visit, result in zip(visits, results):
+                exists = os.path.exists(os.path.join(tempDir, "%d.txt" % visit))
+                if visit in (2, 3):
+                    self.assertIsNone(result.numSources)
+                    self.assertIsNotNone(result.error)
+                    self.assertFalse(exists)
+                else:
+                    self.assertEqual(result.numSources, visit)
+                    self.assertIsNone(result.error)
+                    self.assertTrue(exists)
+
+    def testSerial(self):
+        self.checkRunDataIds([1, 2, 4, 5], 1)
+
+    def testPool(self):
+        visits = [1, 2, 3, 4, 5, 6, 7, 8]
+        self.checkRunDataIds(visits, 2)
+        self.checkRunDataIds(visits, 3, maxTasksPerChild=1)
+
 
 class CoaddTransformTestCase(lsst.utils.tests.TestCase):
     """Check that CoaddSrcTransformTask is set up properly.